@@ -2,7 +2,21 @@
 
 import datetime as dt
 from abc import ABC, abstractmethod
-from typing import Optional, NamedTuple, Tuple, List
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Optional, NamedTuple, Tuple, List, Dict, Iterable, \
+    Iterator, Sequence, Union
+
+BUCKETS = ('day', 'week', 'month')
+"""Granularities that durations can be aggregated at"""
+
+DEFAULT_DAY_START_TIME = dt.time(6, 0)
+
+RECORDS_EPOCH = dt.datetime(1970, 1, 2)
+RECORDS_END = dt.datetime(9999, 1, 1)
+"""Bounds of a window that contains every record"""
 
 
 class Record(NamedTuple):
@@ -15,14 +29,103 @@ class Record(NamedTuple):
     end: dt.datetime
 
 
-class Day(List[Record]):
+class RecordBatch(Sequence[Record]):
+    """
+    A compact, column-wise sequence of records.
+
+    Category names are interned: names holds an index into categories for
+    each record, and starts and ends hold epoch timestamps. Records, with
+    their datetime objects, are only created when they are accessed.
+    """
+
+    def __init__(self, categories: List[str] = None, names: array = None,
+                 starts: array = None, ends: array = None):
+        self.categories = categories if categories is not None else []
+        self.names = names if names is not None else array('I')
+        self.starts = starts if starts is not None else array('d')
+        self.ends = ends if ends is not None else array('d')
+        self._category_index = None
+
+    @classmethod
+    def from_records(cls, records: Iterable[Record]):
+        batch = cls()
+        batch.extend(records)
+        return batch
+
+    def intern(self, name: str) -> int:
+        """Get the index of the category name, adding it if it is new."""
+        if self._category_index is None:
+            self._category_index = {c: i
+                                    for i, c in enumerate(self.categories)}
+        if name not in self._category_index:
+            self._category_index[name] = len(self.categories)
+            self.categories.append(name)
+        return self._category_index[name]
+
+    def append(self, record: Record):
+        self.names.append(self.intern(record.name))
+        self.starts.append(record.start.timestamp())
+        self.ends.append(record.end.timestamp())
+
+    def extend(self, records: Iterable[Record]):
+        if isinstance(records, RecordBatch):
+            self.names.extend(self.intern(records.categories[i])
+                              for i in records.names)
+            self.starts.extend(records.starts)
+            self.ends.extend(records.ends)
+        else:
+            for record in records:
+                self.append(record)
+
+    def get_durations(self) -> defaultdict:
+        """Sum the seconds per category without creating any datetimes."""
+        seconds = [0] * len(self.categories)
+        for name, start, end in zip(self.names, self.starts, self.ends):
+            seconds[name] += end - start
+        durations = defaultdict(int)
+        for name in dict.fromkeys(self.names):
+            durations[self.categories[name]] = seconds[name]
+        return durations
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return RecordBatch(self.categories, self.names[item],
+                               self.starts[item], self.ends[item])
+        return Record(self.categories[self.names[item]],
+                      dt.datetime.fromtimestamp(self.starts[item]),
+                      dt.datetime.fromtimestamp(self.ends[item]))
+
+    def __iter__(self):
+        for name, start, end in zip(self.names, self.starts, self.ends):
+            yield Record(self.categories[name],
+                         dt.datetime.fromtimestamp(start),
+                         dt.datetime.fromtimestamp(end))
+
+    def __eq__(self, other):
+        if isinstance(other, Sequence):
+            return len(self) == len(other) and list(self) == list(other)
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'RecordBatch({!r})'.format(list(self))
+
+
+class Day(Sequence[Record]):
     """
     A collection of records that has a defined start and end datetime
+
+    The records are kept in a list, or in a RecordBatch when one is given.
     """
 
-    def __init__(self, day_start: dt.datetime):
-        super().__init__()
+    def __init__(self, day_start: dt.datetime,
+                 records: Union[List[Record], RecordBatch] = None):
         self.day_start = day_start
+        self.records = records if records is not None else []
 
     @property
     def work_start(self):
@@ -36,6 +139,143 @@ class Day(List[Record]):
             return self[-1].end
         return None
 
+    def append(self, record: Record):
+        self.records.append(record)
+
+    def extend(self, records: Iterable[Record]):
+        self.records.extend(records)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, item):
+        return self.records[item]
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __eq__(self, other):
+        if isinstance(other, Sequence):
+            return len(self) == len(other) and list(self) == list(other)
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'Day({!r}, {!r})'.format(self.day_start, list(self))
+
+
+def partition_into_days(records: Union[List[Record], RecordBatch],
+                        first_day_start: dt.datetime,
+                        num_days: int) -> List[Day]:
+    """Split records sorted by start time into consecutive days.
+
+    Each day boundary is located with a binary search over the start times, so
+    the records are walked once no matter how many days there are. The days
+    of a RecordBatch wrap slices of it.
+    """
+    one_day = dt.timedelta(days=1)
+    if isinstance(records, RecordBatch):
+        starts = records.starts
+        key = dt.datetime.timestamp
+    else:
+        starts = [record.start for record in records]
+        key = None
+    days = []
+    day_start = first_day_start
+    lo = bisect_left(starts, key(day_start) if key else day_start)
+    for i in range(num_days):
+        day_end = day_start + one_day
+        hi = bisect_left(starts, key(day_end) if key else day_end, lo)
+        days.append(Day(day_start, records[lo:hi]))
+        day_start, lo = day_end, hi
+    return days
+
+
+def get_bucket(time: dt.datetime, bucket: str,
+               day_start_time: dt.time = DEFAULT_DAY_START_TIME) -> dt.date:
+    """Get the date labelling the bucket that the given time falls in.
+
+    Days begin at day_start_time, weeks are labelled by their Monday and
+    months by their first day.
+    """
+    offset = dt.timedelta(hours=day_start_time.hour,
+                          minutes=day_start_time.minute,
+                          seconds=day_start_time.second)
+    date = (time - offset).date()
+    if bucket == 'day':
+        return date
+    elif bucket == 'week':
+        return date - dt.timedelta(days=date.weekday())
+    elif bucket == 'month':
+        return date.replace(day=1)
+    raise ValueError('Unknown bucket: {}'.format(bucket))
+
+
+def get_next_bucket(date: dt.date, bucket: str) -> dt.date:
+    """Get the label of the bucket following the one labelled by date."""
+    if bucket == 'day':
+        return date + dt.timedelta(days=1)
+    elif bucket == 'week':
+        return date + dt.timedelta(days=7)
+    elif bucket == 'month':
+        return (date.replace(day=28) + dt.timedelta(days=4)).replace(day=1)
+    raise ValueError('Unknown bucket: {}'.format(bucket))
+
+
+class CategoryDurations(NamedTuple):
+    """
+    The seconds spent on each category, aggregated into consecutive buckets.
+
+    seconds is a bucket by category matrix; an entry is None if the category
+    has no records in that bucket. work_starts and work_ends hold the start of
+    the first and the end of the last record of each bucket.
+    """
+    buckets: List[dt.date]
+    categories: List[str]
+    seconds: List[List[Optional[float]]]
+    work_starts: List[Optional[dt.datetime]]
+    work_ends: List[Optional[dt.datetime]]
+
+    def get_bucket_durations(self, index: int) -> Dict[str, float]:
+        """Get the durations of the index-th bucket as a defaultdict."""
+        durations = defaultdict(int)
+        for category, seconds in zip(self.categories, self.seconds[index]):
+            if seconds is not None:
+                durations[category] = seconds
+        return durations
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[tuple], start: dt.datetime,
+                  end: dt.datetime, bucket: str,
+                  day_start_time: dt.time = DEFAULT_DAY_START_TIME):
+        """Build the matrix from (bucket, category, seconds, first start,
+        last end) rows, including a bucket for every period in the window.
+        """
+        rows = list(rows)
+        buckets = []
+        date = get_bucket(start, bucket, day_start_time)
+        last = get_bucket(end - dt.timedelta.resolution, bucket,
+                          day_start_time)
+        while date <= last:
+            buckets.append(date)
+            date = get_next_bucket(date, bucket)
+        bucket_index = {b: i for i, b in enumerate(buckets)}
+        categories = sorted({row[1] for row in rows})
+        category_index = {c: i for i, c in enumerate(categories)}
+
+        seconds = [[None] * len(categories) for _ in buckets]
+        work_starts = [None] * len(buckets)
+        work_ends = [None] * len(buckets)
+        for date, name, total, first_start, last_end in rows:
+            i = bucket_index[date]
+            seconds[i][category_index[name]] = total
+            if work_starts[i] is None or first_start < work_starts[i]:
+                work_starts[i] = first_start
+            if work_ends[i] is None or last_end > work_ends[i]:
+                work_ends[i] = last_end
+        return cls(buckets, categories, seconds, work_starts, work_ends)
+
 
 class Session(NamedTuple):
     """
@@ -111,6 +351,142 @@ class AbstractDataHandler(ABC):
         """
         pass
 
+    def iter_records_between(self, start: dt.datetime, end: dt.datetime,
+                             chunk_size: int = None) -> Iterator[Record]:
+        """Lazily yield the records between the two times.
+
+        Records are selected and ordered like in get_records_between, but
+        backends may stream them instead of building the whole list, so
+        memory stays flat however long the range is.
+
+        :param start: the beginning datetime
+        :param end: the ending datetime
+        :param chunk_size: the number of records to fetch from the backend at
+            a time, or None for the backend's default
+        :return: an iterator of the records
+        """
+        yield from self.get_records_between(start, end)
+
+    def get_days(self, first_day_start: dt.datetime, num_days: int) \
+            -> List[Day]:
+        """Get the records of consecutive days, one Day per day.
+
+        The whole window is fetched with a single call to get_record_batch
+        and then partitioned by day boundary. Backends with a cheaper way to
+        do this may override it.
+
+        :param first_day_start: the datetime at which the first day begins
+        :param num_days: the number of days to get
+        :return: a list of num_days Day objects
+        """
+        window_end = first_day_start + dt.timedelta(days=num_days)
+        records = self.get_record_batch(first_day_start, window_end)
+        return partition_into_days(records, first_day_start, num_days)
+
+    def get_record_batch(self, start: dt.datetime, end: dt.datetime) \
+            -> RecordBatch:
+        """Get the records between the two times as a compact RecordBatch.
+
+        Records are selected and ordered like in get_records_between.
+        Backends should override this to fill the batch without creating
+        datetime objects.
+        """
+        return RecordBatch.from_records(self.iter_records_between(start, end))
+
+    def iter_record_batches(self, start: dt.datetime, end: dt.datetime,
+                            chunk_size: int = None) -> Iterator[RecordBatch]:
+        """Lazily yield the records between the two times as RecordBatches
+        of at most chunk_size records each.
+
+        Records are selected and ordered like in get_records_between. Only
+        one chunk needs to be held in memory at a time; chunk_size defaults
+        to 1000.
+        """
+        if chunk_size is None:
+            chunk_size = 1000
+        batch = RecordBatch()
+        for record in self.iter_records_between(start, end, chunk_size):
+            batch.append(record)
+            if len(batch) == chunk_size:
+                yield batch
+                batch = RecordBatch()
+        if batch:
+            yield batch
+
+    def get_record_span(self) \
+            -> Optional[Tuple[dt.datetime, dt.datetime]]:
+        """Get the start of the first record and the latest end of any
+        record, or None if there are no records.
+
+        Backends should override this; the default walks every record.
+        """
+        span = None
+        for record in self.iter_records_between(RECORDS_EPOCH, RECORDS_END):
+            if span is None:
+                span = (record.start, record.end)
+            elif record.end > span[1]:
+                span = (span[0], record.end)
+        return span
+
+    def get_category_durations(self, start: dt.datetime, end: dt.datetime,
+                               bucket: str = 'day',
+                               day_start_time: dt.time = None) \
+            -> CategoryDurations:
+        """Get the seconds spent per category in each bucket of the window.
+
+        Records are assigned to buckets by their start time, like in
+        get_records_between. Backends that can aggregate without
+        materializing records should override this.
+
+        :param start: the beginning datetime
+        :param end: the ending datetime
+        :param bucket: one of 'day', 'week' or 'month'
+        :param day_start_time: the time at which days begin
+        :return: the bucket by category matrix
+        """
+        if day_start_time is None:
+            day_start_time = DEFAULT_DAY_START_TIME
+        if bucket not in BUCKETS:
+            raise ValueError('Unknown bucket: {}'.format(bucket))
+        groups = self._group_records(start, end, bucket, day_start_time)
+        rows = (key + value for key, value in groups.items())
+        return CategoryDurations.from_rows(rows, start, end, bucket,
+                                           day_start_time)
+
+    def iter_daily_totals(self, start: dt.datetime, end: dt.datetime,
+                          day_start_time: dt.time = None,
+                          chunk_size: int = None) -> Iterator[tuple]:
+        """Lazily yield the seconds spent per day and category.
+
+        Rows are (day, category, seconds, first start, last end) tuples like
+        the ones CategoryDurations.from_rows takes, ordered by day and then
+        by category; days without records are left out. The default groups
+        every record of the window in memory; backends that can stream the
+        totals should override this.
+        """
+        if day_start_time is None:
+            day_start_time = DEFAULT_DAY_START_TIME
+        groups = self._group_records(start, end, 'day', day_start_time)
+        for key in sorted(groups):
+            yield key + groups[key]
+
+    def _group_records(self, start: dt.datetime, end: dt.datetime,
+                       bucket: str, day_start_time: dt.time) -> dict:
+        """Map (bucket, category) to (seconds, first start, last end)."""
+        groups = dict()
+        for record in self.iter_records_between(start, end):
+            key = (get_bucket(record.start, bucket, day_start_time),
+                   record.name)
+            seconds = (record.end - record.start).total_seconds()
+            if key in groups:
+                total, first_start, last_end = groups[key]
+                groups[key] = (total + seconds,
+                               min(first_start, record.start),
+                               max(last_end, record.end))
+            else:
+                groups[key] = (seconds, record.start, record.end)
+        return groups
+
     @abstractmethod
     def rename_category(self, old_name: str, new_name: str):
         """Change the name of the category.
@@ -118,6 +494,30 @@ class AbstractDataHandler(ABC):
         """
         pass
 
+    @contextmanager
+    def transaction(self):
+        """Group the writes made inside the with block.
+
+        Backends that commit each write may defer those commits until the
+        block exits and make the grouped writes atomic.
+        """
+        yield self
+
+    def batch(self):
+        """Alias of transaction."""
+        return self.transaction()
+
+    @property
+    def data_version(self):
+        """A hashable token that changes whenever the stored data changes.
+
+        Results derived from the data may be cached for as long as the token
+        stays the same. None means that the backend cannot tell, and nothing
+        should be cached; backends return it inside a transaction, whose
+        writes may still be rolled back.
+        """
+        return None
+
     @abstractmethod
     def get_most_recent_session(self) -> Session:
         """Return a namedtuple with the contents from the most recent session"""
@@ -0,0 +1,212 @@
+"""An asyncio front end to the SQLite data handler.
+
+Every call runs on a thread that owns its own SQLDataHandler, so the event
+loop never blocks on the database. Writes are queued to a single writer
+thread and run one at a time, in the order they were made. Reads are spread
+over a pool of reader threads with a connection each; with write-ahead
+logging they neither wait for the writer nor for each other.
+"""
+import asyncio
+import datetime as dt
+import functools
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, List, Optional, Tuple
+
+from anpy import CategoryDurations, Record, RecordBatch, Session
+from anpy_lib import data_analysis, table_generator
+from anpy_lib.data_handling import SQLDataHandler
+
+DEFAULT_READERS = 4
+"""Number of reader threads, and so of reader connections"""
+
+
+class _HandlerThreads:
+    """A thread pool in which every thread has a handler of its own."""
+
+    def __init__(self, connect: Callable[[], SQLDataHandler],
+                 num_threads: int, name: str):
+        self._connect = connect
+        self._local = threading.local()
+        self._handlers = []
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(num_threads, name,
+                                            initializer=self._open)
+
+    def _open(self):
+        handler = self._connect()
+        self._local.handler = handler
+        with self._lock:
+            self._handlers.append(handler)
+
+    def _call(self, function, args):
+        return function(self._local.handler, *args)
+
+    def run(self, function, *args) -> asyncio.Future:
+        """Call function(handler, *args) on one of the threads."""
+        return asyncio.get_running_loop().run_in_executor(
+            self._executor, self._call, function, args)
+
+    def close(self):
+        """Wait for the queued calls and close the connections."""
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            for handler in self._handlers:
+                handler.db.close()
+            self._handlers.clear()
+
+
+class AsyncDataHandler:
+    """Awaitable counterparts of the AbstractDataHandler methods, plus
+    reports.
+
+    A write is committed by the time it has been awaited, so reads made
+    after it see it. Identical reports requested while one is being
+    computed share its result, unless a write was made in between.
+
+    Use it as an async context manager, or call close when done.
+    """
+
+    def __init__(self, database_path: str, readers: int = DEFAULT_READERS,
+                 **handler_options):
+        """
+        :param database_path: the SQLite database file; every thread opens
+            its own connection to it
+        :param readers: the number of reader threads
+        :param handler_options: passed on to each SQLDataHandler
+        """
+        def connect():
+            return SQLDataHandler(
+                sqlite3.Connection(database_path, check_same_thread=False),
+                **handler_options)
+
+        self._writer = _HandlerThreads(connect, 1, 'anpy-writer')
+        self._readers = _HandlerThreads(connect, readers, 'anpy-reader')
+        self._writes = 0
+        self._pending_reports = dict()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def close(self):
+        """Finish the queued calls and close every connection."""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._writer.close)
+        await loop.run_in_executor(None, self._readers.close)
+
+    def _write(self, function, *args) -> asyncio.Future:
+        self._writes += 1
+        return self._writer.run(function, *args)
+
+    async def new_category(self, name: str):
+        await self._write(SQLDataHandler.new_category, name)
+
+    async def set_category_activation(self, name: str, status: bool):
+        await self._write(SQLDataHandler.set_category_activation, name,
+                          status)
+
+    async def rename_category(self, old_name: str, new_name: str):
+        await self._write(SQLDataHandler.rename_category, old_name,
+                          new_name)
+
+    async def start(self, name: str, start: Optional[dt.datetime] = None):
+        """Record the beginning of a working session, at the time of the
+        call unless start is given."""
+        if start is None:
+            start = dt.datetime.now()
+        await self._write(SQLDataHandler.start, name, start)
+
+    async def complete(self, end: dt.datetime = None):
+        """Record the end of the current working session, at the time of
+        the call unless end is given."""
+        if end is None:
+            end = dt.datetime.now()
+        await self._write(SQLDataHandler.complete, end)
+
+    async def cancel(self):
+        await self._write(SQLDataHandler.cancel)
+
+    async def import_records(self, records: Iterable[Record],
+                             **options) -> int:
+        """Insert completed records in bulk; see
+        SQLDataHandler.import_records. The records are consumed on the
+        writer thread."""
+        return await self._write(functools.partial(
+            SQLDataHandler.import_records, **options), records)
+
+    async def get_active_categories(self) -> Tuple[str]:
+        return await self._readers.run(
+            lambda handler: handler.active_categories)
+
+    async def get_all_categories(self) -> Tuple[str]:
+        return await self._readers.run(lambda handler: handler.all_categories)
+
+    async def is_active_session(self) -> bool:
+        return await self._readers.run(SQLDataHandler.is_active_session)
+
+    async def get_most_recent_session(self) -> Optional[Session]:
+        return await self._readers.run(SQLDataHandler.get_most_recent_session)
+
+    async def get_records_between(self, start: dt.datetime,
+                                  end: dt.datetime) -> List[Record]:
+        return await self._readers.run(SQLDataHandler.get_records_between,
+                                       start, end)
+
+    async def get_record_batch(self, start: dt.datetime,
+                               end: dt.datetime) -> RecordBatch:
+        return await self._readers.run(SQLDataHandler.get_record_batch,
+                                       start, end)
+
+    async def get_record_span(self) \
+            -> Optional[Tuple[dt.datetime, dt.datetime]]:
+        return await self._readers.run(SQLDataHandler.get_record_span)
+
+    async def get_category_durations(self, start: dt.datetime,
+                                     end: dt.datetime, bucket: str = 'day',
+                                     day_start_time: dt.time = None) \
+            -> CategoryDurations:
+        return await self._readers.run(SQLDataHandler.get_category_durations,
+                                       start, end, bucket, day_start_time)
+
+    async def get_day_summaries(self, first_day_start: dt.datetime,
+                                num_days: int) \
+            -> List[data_analysis.DaySummary]:
+        return await self._readers.run(data_analysis.get_day_summaries,
+                                       first_day_start, num_days)
+
+    async def report(self, num_days: int = data_analysis.DAYS_IN_A_WEEK,
+                     bucket: str = 'day',
+                     reference_datetime: dt.datetime = None,
+                     day_start_time: dt.time = None) \
+            -> Tuple[List[list], List[str]]:
+        """Build the status table of the num_days days ending with the
+        current day, like cli.py status.
+
+        :return: the rows, each a list of cell values, and the headers
+        """
+        if reference_datetime is None:
+            key_datetime = data_analysis.get_window_start(
+                1, time=day_start_time)
+        else:
+            key_datetime = reference_datetime
+        key = (num_days, bucket, key_datetime, day_start_time, self._writes)
+        pending = self._pending_reports.get(key)
+        if pending is None:
+            pending = self._readers.run(_make_report, num_days, bucket,
+                                        reference_datetime, day_start_time)
+            self._pending_reports[key] = pending
+            pending.add_done_callback(
+                lambda _: self._pending_reports.pop(key, None))
+        return await asyncio.shield(pending)
+
+
+def _make_report(handler: SQLDataHandler, num_days: int, bucket: str,
+                 reference_datetime: Optional[dt.datetime],
+                 day_start_time: Optional[dt.time]):
+    table, headers = table_generator.create_table_iterable_and_headers(
+        handler, reference_datetime, day_start_time, num_days, bucket)
+    return [list(row) for row in table], headers
@@ -1,70 +1,123 @@
 #!/usr/bin/env python3
 
-import itertools as it
+import datetime as dt
+import functools
+from abc import ABC, abstractmethod
+from typing import Dict, List, NamedTuple, Optional, Sequence
 
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.utils import get_column_letter
 from openpyxl.worksheet.cell_range import CellRange
 
 NUM_BODY_ITEMS = 7
 """Number of rows in a column between the header row and the footer row"""
 
+NUM_TITLES = 6
+"""Number of columns before the category columns"""
+
+CELL_MODES = ('formulas', 'values', 'both')
+"""What derived cells hold: Excel formulas, values computed when exporting,
+or values with the formulas kept on a hidden sheet"""
+
+FORMULAS_SHEET_SUFFIX = ' formulas'
+"""Appended to the title of a week sheet to name its hidden formula sheet"""
+
+
+class WeekData(NamedTuple):
+    """The values of one week sheet.
+
+    starts and ends hold the time the first session of each day started and
+    the last one ended, and categories the minutes per day of each category.
+    """
+    first: dt.datetime
+    starts: List[Optional[dt.time]]
+    ends: List[Optional[dt.time]]
+    categories: Dict[str, List[Optional[float]]]
+
 
 class Column:
-    col_order = []
+    body_format = None
+    """Number format of the body cells, if not the default"""
+
+    footer_format = None
+    """Number format of the footer cell, if not the default"""
+
+    uses_data = False
+    """Whether the cells depend on the week, or only on the layout"""
 
     def __init__(self, title: str, dependencies=None):
         '''A column in an Excel spreadsheet.
 
-        A column has a title row, several body rows, and a footer row.
+        A column has a title row, several body rows, and a footer row. Its
+        position and the positions of the columns it depends upon are set
+        when a SheetLayout is compiled from it.
         '''
         self.title = title
-        Column.col_order.append(self)
-        self.column = len(Column.col_order)
+        self.column = None
+        self.layout = None
         if not dependencies:
             dependencies = []
-        self._dep = dict(zip(dependencies, it.repeat(-1)))
+        self._dep = dict.fromkeys(dependencies, -1)
+
+    def compile(self, layout: 'SheetLayout', column: int):
+        '''Place this column in the layout and find the columns needed upon.
 
-    def _satisfy_dependencies(self):
-        '''Find the columns needed upon and store internally.'''
+        Called by SheetLayout.
+        '''
+        self.layout = layout
+        self.column = column
         for col_type in self._dep:
-            self._dep[col_type] = Column.find_column_of_type(col_type)
-
-    def make(self, ws):
-        '''Makes this column in the given worksheet'''
-        self._satisfy_dependencies()
-        ws.cell(row=1, column=self.column, value=self.title)
-        for row, item in enumerate(self._get_body(NUM_BODY_ITEMS), 2):
-            cell = ws.cell(row=row, column=self.column, value=item)
-            self._body_cell_op(cell)
-        fc = ws.cell(row=row + 1, column=self.column, value=self._get_footer())
-        self._footer_body_op(fc)
-
-    def _get_body_item(self, item_num):
-        '''Get the item_num-th body item'''
-        return item_num
+            self._dep[col_type] = layout.find_column_of_type(col_type)
+
+    def get_values(self, week: Optional[WeekData]):
+        '''Get the values of this column from title to footer.'''
+        return ([self.title]
+                + list(self._get_body(NUM_BODY_ITEMS, week))
+                + [self._get_footer()])
+
+    def get_formats(self):
+        '''Get the number formats of this column from title to footer.'''
+        return ([None]
+                + [self.body_format] * NUM_BODY_ITEMS
+                + [self.footer_format])
 
-    def _body_cell_op(self, cell):
-        '''Callback function that is called when body cell is made.
+    def get_body_values(self, week: WeekData, body):
+        '''Get the body cells as values instead of formulas.
+
+        Args:
+            week: the data of the week
+            body: the body values of the columns computed so far, by
+                position; SheetLayout computes the columns that use data
+                first, then the others from left to right
+        '''
+        return list(self._get_body(NUM_BODY_ITEMS, week))
 
-        To be overriden by subclasses.
+    def get_footer_value(self, body):
+        '''Get the footer cell as a value instead of a formula.
 
         Args:
-            cell: the body cell that was just created
+            body: the body values of every column, by position
         '''
-        pass
+        footer = self._get_footer()
+        if isinstance(footer, str) and footer.startswith('='):
+            return _average(body[self.column])
+        return footer
 
-    def _footer_body_op(self, cell):
-        pass
+    def _get_body_item(self, item_num, week):
+        '''Get the item_num-th body item'''
+        return item_num
 
-    def _get_body(self, num_items):
+    def _get_body(self, num_items, week):
         '''Yield the body cells.
 
         Args:
             num_items: the number of body items
+            week: the data of the week, or None if the column does not use
+                data
         '''
         i = 1
         while i <= num_items:
-            yield self._get_body_item(i)
+            yield self._get_body_item(i, week)
             i += 1
 
     def _get_footer(self):
@@ -77,95 +130,216 @@ class Column:
     def __str__(self):
         return type(self).__name__
 
-    @staticmethod
-    def find_column_of_type(col_type):
-        return [isinstance(c, col_type)
-                for c in Column.col_order].index(True) + 1
-
-    @staticmethod
-    def make_all(worksheet):
-        for c in Column.col_order:
-            c.make(worksheet)
-        Column.clean_up()
-
-    @staticmethod
-    def get_column_strings():
-        return [str(c) for c in Column.col_order]
 
-    @staticmethod
-    def clean_up():
-        Column.col_order = []
+class SheetLayout:
+    '''The columns of a week sheet, compiled once and reused across weeks.
+
+    Positions, dependencies and every cell that does not depend on the week,
+    such as the formulas, are computed when the layout is created. A layout
+    is not modified afterwards, so it can render any number of weeks at the
+    same time, on threads or, through render_week, on processes.
+    '''
+
+    def __init__(self, columns: Sequence[Column]):
+        self.columns = list(columns)
+        self._column_of_type = dict()
+        for index, column in enumerate(self.columns, 1):
+            for col_type in type(column).__mro__:
+                self._column_of_type.setdefault(col_type, index)
+        for index, column in enumerate(self.columns, 1):
+            column.compile(self, index)
+        self._formats = [c.get_formats() for c in self.columns]
+        self._static_values = [None if c.uses_data else c.get_values(None)
+                               for c in self.columns]
+        self._value_order = sorted(self.columns, key=lambda c: not c.uses_data)
+
+    @classmethod
+    @functools.lru_cache(maxsize=64)
+    def for_categories(cls, categories: Sequence[str]) -> 'SheetLayout':
+        '''Get the layout of a week sheet with the given category columns.
+
+        Layouts are cached, so weeks with the same categories share one.
+        '''
+        return cls([DateColumn(),
+                    TimeStartedColumn(),
+                    TimeEndedColumn(),
+                    TimeTotalColumn(),
+                    TimeWorkingColumn(),
+                    EfficiencyColumn()]
+                   + [CategoryTimeColumn(c) for c in categories])
+
+    def __len__(self):
+        return len(self.columns)
+
+    def find_column_of_type(self, col_type):
+        '''Get the position of the first column of the type, or None.'''
+        return self._column_of_type.get(col_type)
+
+    def get_column_strings(self):
+        return [str(c) for c in self.columns]
+
+    def render(self, week: WeekData, values=False):
+        '''Get the rows of the week's sheet as lists of (value, number
+        format) pairs, without touching any worksheet.
+
+        If values is set, derived cells hold the values that their formulas
+        would compute instead of the formulas.
+        '''
+        if values:
+            columns = self._compute_values(week)
+        else:
+            columns = [static if static is not None
+                       else column.get_values(week)
+                       for column, static in zip(self.columns,
+                                                 self._static_values)]
+        return [list(zip(values, formats))
+                for values, formats in zip(zip(*columns),
+                                           zip(*self._formats))]
+
+    def _compute_values(self, week: WeekData):
+        body = dict()
+        for column in self._value_order:
+            body[column.column] = column.get_body_values(week, body)
+        return [[column.title]
+                + body[column.column]
+                + [column.get_footer_value(body)]
+                for column in self.columns]
+
+    def make(self, ws, week: WeekData, values=False):
+        '''Makes the week's sheet in the given worksheet'''
+        write_rows(ws, self.render(week, values))
+
+
+def render_week(week: WeekData, values=False):
+    '''Render the week with the layout of its categories.
+
+    A module-level function, so that it can be sent to a process pool.
+    '''
+    layout = SheetLayout.for_categories(tuple(week.categories))
+    return layout.render(week, values)
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _average(values):
+    '''Average the numbers like Excel's AVERAGE, which skips text.
+
+    Returns None where Excel would give #DIV/0!.
+    '''
+    numbers = [v for v in values if _is_number(v)]
+    if not numbers:
+        return None
+    return sum(numbers) / len(numbers)
+
+
+def write_rows(ws, rows):
+    '''Write rendered rows to the worksheet.
+
+    Write-only worksheets cannot be written cell by cell, so their rows are
+    appended in order instead.
+    '''
+    if ws.parent.write_only:
+        for row in rows:
+            cells = []
+            for value, number_format in row:
+                cell = WriteOnlyCell(ws, value=value)
+                if number_format is not None:
+                    cell.number_format = number_format
+                cells.append(cell)
+            ws.append(cells)
+        return
+    for row_num, row in enumerate(rows, 1):
+        for col_num, (value, number_format) in enumerate(row, 1):
+            cell = ws.cell(row=row_num, column=col_num, value=value)
+            if number_format is not None:
+                cell.number_format = number_format
 
 
 class DateColumn(Column):
-    def __init__(self, start_date):
-        self.start_date = start_date
+    body_format = 'YYYY-MM-DD'
+    uses_data = True
+
+    def __init__(self):
         super().__init__('Date')
 
-    def _get_body_item(self, item_num):
+    def _get_body_item(self, item_num, week):
         if item_num == 1:
-            return self.start_date
+            return week.first
         else:
             return '={}{} + 1'.format(get_column_letter(self.column), item_num)
 
-    def _body_cell_op(self, cell):
-        cell.number_format = 'YYYY-MM-DD'
+    def get_body_values(self, week, body):
+        return [week.first + dt.timedelta(days=i)
+                for i in range(NUM_BODY_ITEMS)]
 
     def _get_footer(self):
         return 'Averages:'
 
 
-class DataColumn(Column):
-    def __init__(self, title, data, default_value=0):
+class DataColumn(Column, ABC):
+    uses_data = True
+
+    def __init__(self, title, default_value=0):
         super().__init__(title)
-        self.data = data
         self.default_value = default_value
 
-    def _get_body_item(self, item_num):
-        if self.data[item_num - 1] is not None:
-            return self.data[item_num - 1]
+    @abstractmethod
+    def _get_data(self, week):
+        '''Get the values of this column in the week'''
+
+    def _get_body_item(self, item_num, week):
+        data = self._get_data(week)
+        if data[item_num - 1] is not None:
+            return data[item_num - 1]
         else:
             return self.default_value
 
 
 class CategoryTimeColumn(DataColumn):
-    def _body_cell_op(self, cell):
-        cell.number_format = '0'
+    body_format = '0'
+    footer_format = '0'
 
-    def _footer_body_op(self, cell):
-        cell.number_format = '0'
+    def _get_data(self, week):
+        return week.categories[self.title]
 
 
 class TimeStartedColumn(DataColumn):
-    def __init__(self, data, default_value='N/A'):
-        super().__init__('Time Started', data, default_value)
+    body_format = 'h:mm AM/PM'
+
+    def __init__(self, default_value='N/A'):
+        super().__init__('Time Started', default_value)
+
+    def _get_data(self, week):
+        return week.starts
 
     def _get_footer(self):
         return 'N/A'
 
-    def _body_cell_op(self, cell):
-        cell.number_format = 'h:mm AM/PM'
-
 
 class TimeEndedColumn(DataColumn):
-    def __init__(self, data, default_value='N/A'):
-        super().__init__('Time Ended', data, default_value)
+    body_format = 'h:mm AM/PM'
+
+    def __init__(self, default_value='N/A'):
+        super().__init__('Time Ended', default_value)
+
+    def _get_data(self, week):
+        return week.ends
 
     def _get_footer(self):
         return 'N/A'
 
-    def _body_cell_op(self, cell):
-        cell.number_format = 'h:mm AM/PM'
-
 
 class TimeTotalColumn(Column):
+    body_format = '0.0'
+    footer_format = '0.0'
+
     def __init__(self):
         dep = [TimeStartedColumn, TimeEndedColumn]
-        # self.time_started_col = get_column_letter(time_started_col)
-        # self.time_ended_col = get_column_letter(time_ended_col)
         super().__init__('Time Total (H)', dependencies=dep)
 
-    def _get_body_item(self, item_num):
+    def _get_body_item(self, item_num, week):
         row = item_num + 1
         time_started_col = get_column_letter(self._dep[TimeStartedColumn])
         time_ended_col = get_column_letter(self._dep[TimeEndedColumn])
@@ -174,21 +348,33 @@ class TimeTotalColumn(Column):
                    + ' + MINUTE({2}{1}) - MINUTE({0}{1})) / 60, 24)))'
         return template.format(time_started_col, row, time_ended_col)
 
-    def _body_cell_op(self, cell):
-        cell.number_format = '0.0'
-
-    def _footer_body_op(self, cell):
-        cell.number_format = '0.0'
+    def get_body_values(self, week, body):
+        values = []
+        for start, end in zip(body[self._dep[TimeStartedColumn]],
+                              body[self._dep[TimeEndedColumn]]):
+            if start == 'N/A':
+                values.append('N/A')
+            else:
+                minutes = (60 * end.hour - 60 * start.hour
+                           + end.minute - start.minute)
+                values.append((24 + minutes / 60) % 24)
+        return values
 
 
 class TimeWorkingColumn(Column):
+    body_format = '0.0'
+    footer_format = '0.0'
+
     def __init__(self):
         dep = [CategoryTimeColumn]
         super().__init__('Time Working (H)', dependencies=dep)
 
-    def _get_body_item(self, item_num):
+    def _get_body_item(self, item_num, week):
         data_start_idx = self._dep[CategoryTimeColumn]
-        data_end_idx = len(Column.col_order)
+        if data_start_idx is None:
+            # No categories: sum the empty column after the last one
+            data_start_idx = len(self.layout) + 1
+        data_end_idx = max(len(self.layout), data_start_idx)
         row = item_num + 1
         template = '=IF(SUM({0})=0,"N/A",SUM({0})/60)'
         cell_range = CellRange(min_col=data_start_idx,
@@ -197,19 +383,28 @@ class TimeWorkingColumn(Column):
                                max_row=row)
         return template.format(cell_range)
 
-    def _body_cell_op(self, cell):
-        cell.number_format = '0.0'
-
-    def _footer_body_op(self, cell):
-        cell.number_format = '0.0'
+    def get_body_values(self, week, body):
+        data_start_idx = self._dep[CategoryTimeColumn]
+        if data_start_idx is None:
+            return ['N/A'] * NUM_BODY_ITEMS
+        values = []
+        for item in range(NUM_BODY_ITEMS):
+            total = sum(body[i][item]
+                        for i in range(data_start_idx, len(self.layout) + 1)
+                        if _is_number(body[i][item]))
+            values.append('N/A' if total == 0 else total / 60)
+        return values
 
 
 class EfficiencyColumn(Column):
+    body_format = '0.0%'
+    footer_format = '0.0%'
+
     def __init__(self):
         dep = [TimeTotalColumn, TimeWorkingColumn]
         super().__init__('% Efficiency', dependencies=dep)
 
-    def _get_body_item(self, item_num):
+    def _get_body_item(self, item_num, week):
         row = item_num + 1
         time_total_col = self._dep[TimeTotalColumn]
         time_working_col = self._dep[TimeWorkingColumn]
@@ -232,11 +427,28 @@ class EfficiencyColumn(Column):
         template = '=SUMPRODUCT({0},{1}) / SUM({0})'
         return template.format(total_range, my_range)
 
-    def _body_cell_op(self, cell):
-        cell.number_format = '0.0%'
-
-    def _footer_body_op(self, cell):
-        cell.number_format = '0.0%'
+    def get_body_values(self, week, body):
+        values = []
+        for total, working in zip(body[self._dep[TimeTotalColumn]],
+                                  body[self._dep[TimeWorkingColumn]]):
+            if working == 'N/A':
+                values.append('N/A')
+            elif not _is_number(total) or total == 0:
+                # IFERROR of a division by zero or by text
+                values.append(0)
+            else:
+                values.append(working / (total * 0.75))
+        return values
+
+    def get_footer_value(self, body):
+        # SUMPRODUCT and SUM skip text
+        pairs = [(t, e) for t, e in zip(body[self._dep[TimeTotalColumn]],
+                                        body[self.column])
+                 if _is_number(t)]
+        total = sum(t for t, _ in pairs)
+        if total == 0:
+            return None
+        return sum(t * e for t, e in pairs if _is_number(e)) / total
 
 
 def get_subjects(ws, num_titles):
@@ -248,4 +460,3 @@ def get_subjects(ws, num_titles):
         index += 1
         cell = ws.cell(row=1, column=index)
     return subjects
-
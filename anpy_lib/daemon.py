@@ -0,0 +1,120 @@
+"""A line-based JSON protocol between cli.py and the anpyd daemon.
+
+The client sends the command line arguments as {"argv": [...]} on one line
+and the daemon answers with {"output": "..."} or {"error": "..."}.
+"""
+import json
+import os
+import socket
+import socketserver
+from typing import Callable, List, Optional
+
+COMMANDS = ('start', 'end', 'cancel', 'status')
+"""Commands that the CLI forwards to the daemon if it is running"""
+
+READ_ONLY_COMMANDS = ('status',)
+"""Commands that do not change the data, so that the CLI may run them itself
+if the daemon does not answer"""
+
+DEFAULT_TIMEOUT = 10.0
+"""Seconds the client waits for the daemon to answer"""
+
+
+def request(argv: List[str], socket_path: str,
+            timeout: float = DEFAULT_TIMEOUT,
+            read_only: bool = False) -> Optional[str]:
+    """Ask the daemon to run the command.
+
+    Once the command has been sent, the daemon may run it even if it does
+    not answer in time, so the caller can only safely run it again itself if
+    it does not change the data.
+
+    :param read_only: whether the command leaves the data alone
+    :return: the output of the command, or None if no daemon is listening,
+        or if a read-only command went unanswered
+    :raises RuntimeError: if the daemon reports an error, or does not answer
+        a command that is not read-only
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    with sock:
+        try:
+            sock.connect(socket_path)
+        except OSError:
+            return None
+        try:
+            with sock.makefile('rwb') as stream:
+                stream.write(json.dumps({'argv': argv}).encode() + b'\n')
+                stream.flush()
+                response = json.loads(stream.readline().decode())
+        except (OSError, ValueError) as e:
+            if read_only:
+                return None
+            raise RuntimeError('anpyd did not answer ({}); the command may '
+                               'still have been run'.format(e)) from e
+    if 'error' in response:
+        raise RuntimeError('anpyd: {}'.format(response['error']))
+    return response['output']
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def setup(self):
+        self.timeout = self.server.client_timeout
+        super().setup()
+
+    def handle(self):
+        try:
+            for line in self.rfile:
+                try:
+                    argv = json.loads(line.decode())['argv']
+                    response = {'output': self.server.respond(argv)}
+                except Exception as e:
+                    response = {'error': '{}: {}'.format(type(e).__name__,
+                                                         e)}
+                self.wfile.write(json.dumps(response).encode() + b'\n')
+                self.wfile.flush()
+        except OSError:
+            # The client went away or stopped sending; drop it so that the
+            # next client is served
+            pass
+
+
+class DaemonServer(socketserver.UnixStreamServer):
+    """Serves requests one at a time, so respond is never run concurrently.
+
+    idle, if given, is called between requests to do background work.
+    A client that sends nothing for client_timeout seconds is disconnected.
+    """
+
+    def __init__(self, socket_path: str, respond: Callable[[List[str]], str],
+                 idle: Callable[[], None] = None,
+                 client_timeout: float = DEFAULT_TIMEOUT):
+        self.respond = respond
+        self.idle = idle
+        self.client_timeout = client_timeout
+        if os.path.exists(socket_path):
+            if is_running(socket_path):
+                raise RuntimeError('A daemon is already listening on {}'
+                                   .format(socket_path))
+            os.remove(socket_path)
+        super().__init__(socket_path, _RequestHandler)
+
+    def service_actions(self):
+        if self.idle is not None:
+            self.idle()
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+def is_running(socket_path: str) -> bool:
+    """Check whether a daemon is listening on the socket."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    with sock:
+        try:
+            sock.connect(socket_path)
+            return True
+        except (FileNotFoundError, ConnectionRefusedError):
+            return False
@@ -1,29 +1,195 @@
 import datetime as dt
-from collections import defaultdict
-from typing import List, Iterable, Dict
+import re
+import weakref
+from collections import OrderedDict, defaultdict
+from typing import List, Iterable, Iterator, Dict, NamedTuple, Optional
 
-from anpy import AbstractDataHandler, Record, Day
+from anpy import AbstractDataHandler, Record, RecordBatch, Day, get_bucket
 
 DAYS_IN_A_WEEK = 7
+DAYS_IN_A_YEAR = 365
 
+WINDOW_UNITS = {'d': 1, 'w': DAYS_IN_A_WEEK, 'y': DAYS_IN_A_YEAR}
+"""Days in each unit that a report window can be given in"""
+
+DEFAULT_CACHE_SIZE = 1024
+"""Number of results about closed days kept per handler"""
+
+
+class DaySummary(NamedTuple):
+    """The aggregated figures of one day"""
+    day_start: dt.datetime
+    work_start: Optional[dt.datetime]
+    work_end: Optional[dt.datetime]
+    durations: Dict[str, float]
+
+
+class AnalysisCache:
+    """An LRU cache of results about closed days of one handler.
+
+    Entries are only valid for the handler data_version they were computed
+    at; when the version changes, the whole cache is dropped.
+    """
+
+    def __init__(self, maxsize: int = DEFAULT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, version, key, default=None):
+        if version != self.version:
+            self._entries.clear()
+            self.version = version
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+        self.misses += 1
+        return default
+
+    def put(self, version, key, value):
+        if version != self.version:
+            return
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_caches = weakref.WeakKeyDictionary()
+
+
+def get_analysis_cache(handler: AbstractDataHandler) -> AnalysisCache:
+    if handler not in _caches:
+        _caches[handler] = AnalysisCache()
+    return _caches[handler]
+
+
+def _is_closed(day_start: dt.datetime, now: dt.datetime = None):
+    if now is None:
+        now = dt.datetime.now()
+    return day_start + dt.timedelta(days=1) <= now
+
+
+def get_day(handler: AbstractDataHandler, day_start: dt.datetime,
+            now: dt.datetime = None):
+    """Get the records of the day beginning at day_start.
+
+    Days that have ended are memoized until the handler's data changes, so
+    the returned Day must not be modified.
+    """
+    version = handler.data_version
+    cacheable = version is not None and _is_closed(day_start, now)
+    if cacheable:
+        day = get_analysis_cache(handler).get(version, ('day', day_start))
+        if day is not None:
+            return day
 
-def get_day(handler: AbstractDataHandler, day_start: dt.datetime):
-    day = Day(day_start)
     day_end = day_start + dt.timedelta(days=1)
-    day.extend(handler.get_records_between(day_start, day_end))
+    day = Day(day_start, handler.get_record_batch(day_start, day_end))
+    if cacheable:
+        get_analysis_cache(handler).put(version, ('day', day_start), day)
     return day
 
 
+def get_day_durations(handler: AbstractDataHandler, day_start: dt.datetime,
+                      now: dt.datetime = None) -> defaultdict:
+    """Get the seconds spent per category on the day beginning at day_start.
+
+    Like get_day, results for days that have ended are memoized.
+    """
+    version = handler.data_version
+    cacheable = version is not None and _is_closed(day_start, now)
+    if cacheable:
+        durations = get_analysis_cache(handler).get(
+            version, ('durations', day_start))
+        if durations is not None:
+            return defaultdict(int, durations)
+
+    durations = get_per_category_durations(get_day(handler, day_start, now))
+    if cacheable:
+        get_analysis_cache(handler).put(version, ('durations', day_start),
+                                        dict(durations))
+    return durations
+
+
+def get_day_summaries(handler: AbstractDataHandler,
+                      first_day_start: dt.datetime,
+                      num_days: int,
+                      now: dt.datetime = None) -> List[DaySummary]:
+    """Get the summaries of consecutive days.
+
+    Summaries of days that have ended are memoized, so once they are cached
+    only the current, open day is aggregated again. Days missing from the
+    cache are aggregated together with one get_category_durations call.
+    """
+    one_day = dt.timedelta(days=1)
+    day_starts = [first_day_start + one_day * i for i in range(num_days)]
+    version = handler.data_version
+    cache = get_analysis_cache(handler) if version is not None else None
+
+    summaries = [cache.get(version, ('summary', day_start))
+                 if cache is not None else None
+                 for day_start in day_starts]
+    missing = [i for i, summary in enumerate(summaries) if summary is None]
+    if not missing:
+        return summaries
+
+    lo, hi = missing[0], missing[-1] + 1
+    durations = handler.get_category_durations(
+        day_starts[lo], day_starts[lo] + one_day * (hi - lo), 'day',
+        first_day_start.time())
+    for j, i in enumerate(range(lo, hi)):
+        summary = DaySummary(day_starts[i], durations.work_starts[j],
+                             durations.work_ends[j],
+                             dict(durations.get_bucket_durations(j)))
+        summaries[i] = summary
+        if cache is not None and _is_closed(day_starts[i], now):
+            cache.put(version, ('summary', day_starts[i]), summary)
+    return summaries
+
+
 def get_days(handler: AbstractDataHandler,
              first_day_start: dt.datetime,
-             num_days: int):
+             num_days: int) -> List[Day]:
+    return handler.get_days(first_day_start, num_days)
+
+
+def iter_days(handler: AbstractDataHandler,
+              first_day_start: dt.datetime,
+              num_days: int) -> Iterator[Day]:
+    """Yield consecutive days while streaming the window's records.
+
+    Only the day being yielded is held in memory.
+    """
     one_day = dt.timedelta(days=1)
-    days = []
-    day_start = first_day_start
-    for i in range(num_days):
-        days.append(get_day(handler, day_start=day_start))
-        day_start += one_day
-    return days
+    window_end = first_day_start + one_day * num_days
+    day = Day(first_day_start)
+    day_end = first_day_start + one_day
+    yielded = 0
+    for record in handler.iter_records_between(first_day_start, window_end):
+        while record.start >= day_end:
+            yield day
+            yielded += 1
+            day = Day(day_end)
+            day_end += one_day
+        day.append(record)
+    while yielded < num_days:
+        yield day
+        yielded += 1
+        day = Day(day_end)
+        day_end += one_day
+
+
+def get_durations_between(handler: AbstractDataHandler,
+                          start: dt.datetime,
+                          end: dt.datetime) -> defaultdict:
+    return get_per_category_durations(handler.iter_records_between(start, end))
 
 
 # TODO: refactor usages to use Day version
@@ -36,12 +202,7 @@ def get_records_on_day(handler: AbstractDataHandler,
 # TODO: refactor usages to use Day version
 def get_records_on_week(handler: AbstractDataHandler,
                         day_start: dt.datetime) -> List[Iterable[Record]]:
-    one_day = dt.timedelta(days=1)
-    records = []
-    for i in range(DAYS_IN_A_WEEK):
-        records.append(get_records_on_day(handler, day_start))
-        day_start += one_day
-    return records
+    return get_days(handler, day_start, DAYS_IN_A_WEEK)
 
 
 # TODO: refactor usages to use Day version
@@ -53,9 +214,47 @@ def get_total_subject_breakdown(list_of_records: List[Iterable[Record]]) \
 
 def get_per_category_durations(records: Iterable[Record]) \
         -> defaultdict:
+    if isinstance(records, Day):
+        records = records.records
+    if isinstance(records, RecordBatch):
+        return records.get_durations()
     record_dict = defaultdict(int)
     for record in records:
         seconds = (record.end - record.start).total_seconds()
         record_dict[record.name] = record_dict.get(
             record.name, 0) + seconds
     return record_dict
+
+
+def parse_window(window: str) -> int:
+    """Get the number of days in a window such as '30d', '12w' or '1y'."""
+    match = re.fullmatch(r'([1-9][0-9]*)([{}])'.format(''.join(WINDOW_UNITS)),
+                         window.strip().lower())
+    if not match:
+        raise ValueError('Invalid window: {}'.format(window))
+    return int(match.group(1)) * WINDOW_UNITS[match.group(2)]
+
+
+def get_window_start(num_days: int, datetime: dt.datetime = None,
+                     time: dt.time = None) -> dt.datetime:
+    """Get the start of the first of num_days days ending with the current
+    day."""
+    if not datetime:
+        datetime = dt.datetime.now()
+    if not time:
+        time = dt.time(6, 0)
+    today = get_bucket(datetime, 'day', time)
+    return dt.datetime.combine(today - dt.timedelta(days=num_days - 1), time)
+
+
+def get_most_recent_day(isoweekday: int, time: dt.time = None,
+                        datetime: dt.datetime = None):
+    if not datetime:
+        datetime = dt.datetime.today()
+    if not time:
+        time = dt.time(6, 0)
+    datetime = datetime - dt.timedelta(
+        hours=time.hour) + dt.timedelta.resolution
+    datetime = datetime - dt.timedelta(
+        days=(datetime.isoweekday() - isoweekday) % 7)
+    return dt.datetime.combine(datetime.date(), dt.time(6, 0))
@@ -1,14 +1,22 @@
 import datetime as dt
+import functools
+import os
+from concurrent.futures import Executor
 from typing import List, Iterable, Dict, Optional
 
 from openpyxl import Workbook, load_workbook
 
 from anpy import AbstractDataHandler
+from anpy import CategoryDurations
 from anpy import Record
-from anpy_lib import column_creation as cc, data_analysis
+from anpy_lib import column_creation as cc, data_analysis, file_management, \
+    xlsx_patch
+from anpy_lib.data_analysis import get_most_recent_day
 
 TEMP_SHEET_NAME = 'ANPY_TEMP_SHEET_DO_NOT_TOUCH'
 
+LAYOUTS = file_management.EXPORT_LAYOUTS
+
 
 def enter_week_data(first: dt.datetime, handler: AbstractDataHandler, ws):
     """
@@ -18,31 +26,48 @@ def enter_week_data(first: dt.datetime, handler: AbstractDataHandler, ws):
     :param handler: data handler to extract data from
     :param ws: excel worksheet to add data to
     """
-    weekly_record_list = data_analysis.get_records_on_week(handler, first)
-    dicts = [data_analysis.get_per_category_durations(r) for r in
-             weekly_record_list]
-    make_cols(first, weekly_record_list, dicts)
-    cc.Column.make_all(ws)
+    summaries = data_analysis.get_day_summaries(
+        handler, first, data_analysis.DAYS_IN_A_WEEK)
+    enter_week_summaries(first, summaries, ws)
+
+
+def enter_week_summaries(first: dt.datetime,
+                         summaries: List[data_analysis.DaySummary], ws):
+    """
+    Insert the summaries of the week's days into the given worksheet
+    :param first: datetime of the first session of the week
+    :param summaries: the summary of each day of the week
+    :param ws: excel worksheet to add data to
+    """
+    layout, week = make_cols(*get_week_columns(first, summaries))
+    layout.make(ws, week)
 
 
-def make_cols(first: dt.datetime, weekly_record_list, dicts):
+def get_week_columns(first: dt.datetime,
+                     summaries: List[data_analysis.DaySummary]):
+    """
+    Get the arguments of make_cols from the summaries of the week's days
+    """
+    dicts = [summary.durations for summary in summaries]
+    starts = [s.work_start.time() if s.work_start else None
+              for s in summaries]
+    ends = [s.work_end.time() if s.work_end else None for s in summaries]
+    return first, starts, ends, dicts
+
+
+def make_cols(first: dt.datetime, starts, ends, dicts):
     """
     Create the data make the columns
     :param first: the first
-    :param weekly_record_list:
+    :param starts: the time the first session of each day started
+    :param ends: the time the last session of each day ended
     :param dicts:
-    :return:
+    :return: the layout of the week's sheet and the data to fill it with
     """
-    starts, ends = get_time_started_ended(weekly_record_list)
-    cc.DateColumn(first)
-    cc.TimeStartedColumn(starts)
-    cc.TimeEndedColumn(ends)
-    cc.TimeTotalColumn()
-    cc.TimeWorkingColumn()
-    cc.EfficiencyColumn()
-    a = list(get_data_column_data(dicts).items())
-    for sub, times in get_data_column_data(dicts).items():
-        cc.CategoryTimeColumn(sub, [t / 60 if t else t for t in times])
+    categories = {sub: [t / 60 if t else t for t in times]
+                  for sub, times in get_data_column_data(dicts).items()}
+    week = cc.WeekData(first, starts, ends, categories)
+    return cc.SheetLayout.for_categories(tuple(categories)), week
 
 
 def get_time_started_ended(weekly_record_list: List[Iterable[Record]]):
@@ -50,14 +75,13 @@ def get_time_started_ended(weekly_record_list: List[Iterable[Record]]):
     ends = []
 
     for records in weekly_record_list:
-        records = list(records)
-        if records:
-            start, end = records[0].start, records[-1].end
-            starts.append(start.time() if start else None)
-            ends.append(end.time() if start else None)
-        else:
-            starts.append(None)
-            ends.append(None)
+        start = end = None
+        for record in records:
+            if start is None:
+                start = record.start
+            end = record.end
+        starts.append(start.time() if start else None)
+        ends.append(end.time() if start else None)
     return starts, ends
 
 
@@ -88,19 +112,6 @@ def get_most_recent_monday(datetime: dt.datetime = None):
     '''
 
 
-# TODO move to data analysis
-def get_most_recent_day(isoweekday: int, time: dt.time = None,
-                        datetime: dt.datetime = None):
-    if not datetime:
-        datetime = dt.datetime.today()
-    if not time:
-        time = dt.time(6, 0)
-    datetime = datetime - dt.timedelta(
-        hours=time.hour) + dt.timedelta.resolution
-    datetime = datetime - dt.timedelta(
-        days=(datetime.isoweekday() - isoweekday) % 7)
-    return dt.datetime.combine(datetime.date(), dt.time(6, 0))
-
 def load_excel_workbook(path):
     try:
         wb = load_workbook(path)
@@ -112,12 +123,198 @@ def load_excel_workbook(path):
 
 def get_relevant_worksheet(workbook: Workbook, datetime=None):
     reference_date = str(get_most_recent_monday(datetime).date())
-    if reference_date not in workbook.sheetnames:
-        workbook.create_sheet(title=reference_date)
+    return (replace_worksheet(workbook, reference_date),
+            get_most_recent_monday(datetime))
+
+
+def replace_worksheet(workbook: Workbook, title):
+    """Create an empty sheet with the title, replacing any existing one."""
+    if title not in workbook.sheetnames:
+        workbook.create_sheet(title=title)
     else:
-        workbook[reference_date].title = TEMP_SHEET_NAME
-        workbook.create_sheet(title=reference_date)
+        workbook[title].title = TEMP_SHEET_NAME
+        workbook.create_sheet(title=title)
 
     if TEMP_SHEET_NAME in workbook.sheetnames:
         del workbook[TEMP_SHEET_NAME]
-    return workbook[reference_date], get_most_recent_monday(datetime)
+    return workbook[title]
+
+
+def get_week(handler: AbstractDataHandler, first: dt.datetime):
+    """Get the data of the week sheet beginning at first."""
+    summaries = data_analysis.get_day_summaries(
+        handler, first, data_analysis.DAYS_IN_A_WEEK)
+    return make_cols(*get_week_columns(first, summaries))[1]
+
+
+def render_week_sheets(week: cc.WeekData, mode='formulas'):
+    """
+    Render the sheets of the week for the cell mode.
+
+    In the values and both modes, the week's sheet holds computed values;
+    the both mode adds a hidden sheet with the formulas.
+    :return: a list of (title, rows, hidden) tuples
+    """
+    if mode not in cc.CELL_MODES:
+        raise ValueError('Unknown cell mode: {}'.format(mode))
+    title = str(week.first.date())
+    if mode == 'formulas':
+        return [(title, cc.render_week(week), False)]
+    sheets = [(title, cc.render_week(week, values=True), False)]
+    if mode == 'both':
+        sheets.append((title + cc.FORMULAS_SHEET_SUFFIX,
+                       cc.render_week(week), True))
+    return sheets
+
+
+def write_week_sheets(workbook: Workbook, sheets):
+    """Write sheets rendered by render_week_sheets to the workbook."""
+    for title, rows, hidden in sheets:
+        if workbook.write_only:
+            ws = workbook.create_sheet(title)
+        else:
+            ws = replace_worksheet(workbook, title)
+        if hidden:
+            ws.sheet_state = 'hidden'
+        cc.write_rows(ws, rows)
+    if not workbook.write_only:
+        for title in get_stale_sheets(sheets):
+            if title in workbook.sheetnames:
+                del workbook[title]
+
+
+def get_stale_sheets(sheets):
+    """Get the titles of sheets that a previous export of the week may have
+    written but the given rendered sheets of the week replace."""
+    # The formulas left over from an export in the both mode
+    formulas = sheets[0][0] + cc.FORMULAS_SHEET_SUFFIX
+    if formulas in (title for title, _, _ in sheets):
+        return []
+    return [formulas]
+
+
+def get_period_path(path, layout, monday: dt.datetime):
+    """Get the file that the week beginning on monday is exported to."""
+    if layout == 'single':
+        return path
+    root, extension = os.path.splitext(path)
+    if layout == 'week':
+        return '{}-{}{}'.format(root, monday.date(), extension)
+    elif layout == 'month':
+        return '{}-{:%Y-%m}{}'.format(root, monday, extension)
+    raise ValueError('Unknown layout: {}'.format(layout))
+
+
+def get_period_mondays(layout, monday: dt.datetime) -> List[dt.datetime]:
+    """Get the weeks that share a file with the week beginning on monday,
+    up to and including that week."""
+    if layout != 'month':
+        return [monday]
+    mondays = [monday]
+    while (mondays[0] - dt.timedelta(days=7)).month == monday.month:
+        mondays.insert(0, mondays[0] - dt.timedelta(days=7))
+    return mondays
+
+
+def export_week(handler: AbstractDataHandler, path, layout='single',
+                datetime: dt.datetime = None, mode='formulas', patch=True):
+    """
+    Export the current week to Excel.
+
+    The single layout replaces the week's sheet in the log file. If patch is
+    set and the file exists, only that sheet's part of the file is rewritten
+    (see xlsx_patch), and nothing is written if it has not changed;
+    otherwise the whole workbook is loaded and saved. The week and month
+    layouts stream the sheets of only the current period into a write-only
+    workbook, so the cost does not grow with history.
+    :param mode: one of column_creation.CELL_MODES
+    :return: the path of the file written
+    """
+    monday = get_most_recent_monday(datetime)
+    if layout == 'single':
+        sheets = render_week_sheets(get_week(handler, monday), mode)
+        if patch and os.path.exists(path):
+            xlsx_patch.patch_sheets(path, sheets, get_stale_sheets(sheets))
+            return path
+        wb = load_excel_workbook(path)
+        write_week_sheets(wb, sheets)
+        wb.save(path)
+        return path
+
+    period_path = get_period_path(path, layout, monday)
+    wb = Workbook(write_only=True)
+    for first in get_period_mondays(layout, monday):
+        write_week_sheets(wb, render_week_sheets(get_week(handler, first),
+                                                 mode))
+    wb.save(period_path)
+    return period_path
+
+
+def iter_week_summaries(durations: CategoryDurations, first: dt.datetime):
+    """
+    Group daily durations into weeks in one pass
+    :param durations: durations bucketed by day, starting on a Monday
+    :param first: datetime at which the first day begins
+    :return: an iterator of (first datetime of the week, day summaries)
+    """
+    week = []
+    for i, date in enumerate(durations.buckets):
+        week.append(data_analysis.DaySummary(
+            dt.datetime.combine(date, first.time()),
+            durations.work_starts[i], durations.work_ends[i],
+            dict(durations.get_bucket_durations(i))))
+        if len(week) == data_analysis.DAYS_IN_A_WEEK:
+            yield week[0].day_start, week
+            week = []
+
+
+def export_weeks(handler: AbstractDataHandler, path, first: dt.datetime,
+                 num_weeks: int, layout='single', rebuild=False,
+                 executor: Executor = None, mode='formulas', patch=True):
+    """
+    Export consecutive weeks, fetching them with one query and saving each
+    file once.
+
+    With the single layout, the weeks' sheets replace those in the log file
+    unless rebuild is set, in which case the log file is written from
+    scratch with only these weeks. If patch is set, the sheets are replaced
+    with a single xlsx_patch pass instead of loading the log file. Files of
+    the week and month layouts are always written from scratch.
+    :param first: the Monday the first week begins on
+    :param executor: if given, the sheets are rendered on it, for instance
+        on a process pool, and only written in this thread
+    :param mode: one of column_creation.CELL_MODES
+    """
+    end = first + dt.timedelta(weeks=num_weeks)
+    durations = handler.get_category_durations(first, end, 'day',
+                                               first.time())
+    weeks = [make_cols(*get_week_columns(monday, summaries))[1]
+             for monday, summaries in iter_week_summaries(durations, first)]
+    render = functools.partial(render_week_sheets, mode=mode)
+    if executor is None:
+        sheets = map(render, weeks)
+    else:
+        sheets = executor.map(render, weeks)
+
+    if layout == 'single' and not rebuild and patch \
+            and os.path.exists(path):
+        sheets = list(sheets)
+        xlsx_patch.patch_sheets(
+            path, [sheet for week_sheets in sheets for sheet in week_sheets],
+            [title for week_sheets in sheets
+             for title in get_stale_sheets(week_sheets)])
+        return
+
+    workbooks = dict()
+    for week, week_sheets in zip(weeks, sheets):
+        monday = week.first
+        period_path = get_period_path(path, layout, monday)
+        if period_path not in workbooks:
+            if layout == 'single' and not rebuild:
+                workbooks[period_path] = load_excel_workbook(period_path)
+            else:
+                workbooks[period_path] = Workbook(write_only=True)
+        write_week_sheets(workbooks[period_path], week_sheets)
+
+    for period_path, wb in workbooks.items():
+        wb.save(period_path)
@@ -0,0 +1,181 @@
+"""Streaming export of records and daily totals to CSV, JSONL and Parquet.
+
+Rows go from the database cursor to the output file one chunk at a time, so
+memory stays flat however many records are exported. Parquet files need
+pyarrow, which is only imported when one is written.
+"""
+import csv
+import datetime as dt
+import json
+from typing import Iterator, List, TextIO, Tuple
+
+from anpy import AbstractDataHandler, DEFAULT_DAY_START_TIME, get_bucket
+
+FORMATS = ('csv', 'jsonl', 'parquet')
+
+TABLES = ('records', 'days')
+"""What can be exported: every record, or the seconds per day and category"""
+
+FIELDS = {
+    'records': (('name', 'string'), ('start', 'timestamp'),
+                ('end', 'timestamp')),
+    'days': (('day', 'date'), ('name', 'string'), ('seconds', 'double'),
+             ('first_start', 'timestamp'), ('last_end', 'timestamp')),
+}
+"""Names and types of the columns of each table"""
+
+DEFAULT_CHUNK_SIZE = 10000
+"""Number of rows read from the database and written at a time"""
+
+Chunk = Tuple[list, ...]
+"""The columns of consecutive rows, in the order of the table's FIELDS"""
+
+
+def get_day_range(since: dt.datetime, until: dt.datetime,
+                  day_start_time: dt.time = DEFAULT_DAY_START_TIME) \
+        -> Tuple[dt.datetime, dt.datetime]:
+    """Get the start of the day containing since and the end of the day
+    containing until."""
+    first = get_bucket(since, 'day', day_start_time)
+    last = get_bucket(until, 'day', day_start_time)
+    return (dt.datetime.combine(first, day_start_time),
+            dt.datetime.combine(last + dt.timedelta(days=1), day_start_time))
+
+
+def iter_record_chunks(handler: AbstractDataHandler, start: dt.datetime,
+                       end: dt.datetime, chunk_size: int = DEFAULT_CHUNK_SIZE) \
+        -> Iterator[Chunk]:
+    """Lazily yield the records between the two times as columns."""
+    for batch in handler.iter_record_batches(start, end, chunk_size):
+        categories = batch.categories
+        yield ([categories[i] for i in batch.names],
+               list(map(dt.datetime.fromtimestamp, batch.starts)),
+               list(map(dt.datetime.fromtimestamp, batch.ends)))
+
+
+def iter_day_chunks(handler: AbstractDataHandler, start: dt.datetime,
+                    end: dt.datetime, chunk_size: int = DEFAULT_CHUNK_SIZE) \
+        -> Iterator[Chunk]:
+    """Lazily yield the daily totals between the two times as columns."""
+    rows = []
+    for row in handler.iter_daily_totals(start, end, chunk_size=chunk_size):
+        rows.append(row)
+        if len(rows) == chunk_size:
+            yield tuple(map(list, zip(*rows)))
+            rows = []
+    if rows:
+        yield tuple(map(list, zip(*rows)))
+
+
+def iter_chunks(handler: AbstractDataHandler, table: str, start: dt.datetime,
+                end: dt.datetime, chunk_size: int = DEFAULT_CHUNK_SIZE) \
+        -> Iterator[Chunk]:
+    if table == 'records':
+        return iter_record_chunks(handler, start, end, chunk_size)
+    elif table == 'days':
+        return iter_day_chunks(handler, start, end, chunk_size)
+    raise ValueError('Unknown table: {}'.format(table))
+
+
+def _get_formatters(fields: Tuple[Tuple[str, str], ...]) -> list:
+    """Get a function per column that makes its values fit for text."""
+    return [(lambda values: [v.isoformat() for v in values])
+            if field_type in ('date', 'timestamp') else None
+            for _, field_type in fields]
+
+
+def _format_columns(chunk: Chunk, formatters: list) -> List[list]:
+    return [formatter(column) if formatter else column
+            for column, formatter in zip(chunk, formatters)]
+
+
+def write_csv(stream: TextIO, fields: Tuple[Tuple[str, str], ...],
+              chunks: Iterator[Chunk]) -> int:
+    """Write a header row and then the rows of every chunk.
+
+    :return: the number of rows written
+    """
+    writer = csv.writer(stream)
+    writer.writerow([name for name, _ in fields])
+    formatters = _get_formatters(fields)
+    count = 0
+    for chunk in chunks:
+        rows = list(zip(*_format_columns(chunk, formatters)))
+        writer.writerows(rows)
+        count += len(rows)
+    return count
+
+
+def write_jsonl(stream: TextIO, fields: Tuple[Tuple[str, str], ...],
+                chunks: Iterator[Chunk]) -> int:
+    """Write one JSON object per row.
+
+    :return: the number of rows written
+    """
+    names = [name for name, _ in fields]
+    formatters = _get_formatters(fields)
+    count = 0
+    for chunk in chunks:
+        rows = list(zip(*_format_columns(chunk, formatters)))
+        stream.writelines(json.dumps(dict(zip(names, row))) + '\n'
+                          for row in rows)
+        count += len(rows)
+    return count
+
+
+def write_parquet(path, fields: Tuple[Tuple[str, str], ...],
+                  chunks: Iterator[Chunk]) -> int:
+    """Write every chunk as a row group of a Parquet file.
+
+    Timestamps are stored without a time zone, in local time like everywhere
+    else in AnPy.
+
+    :param path: the path or binary file object to write to
+    :return: the number of rows written
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError('pyarrow is required to export Parquet files')
+
+    types = {'string': pa.string(), 'date': pa.date32(),
+             'double': pa.float64(), 'timestamp': pa.timestamp('us')}
+    schema = pa.schema([(name, types[field_type])
+                        for name, field_type in fields])
+    count = 0
+    with pq.ParquetWriter(path, schema) as writer:
+        for chunk in chunks:
+            writer.write_table(pa.Table.from_arrays(
+                [pa.array(column, type=field.type)
+                 for column, field in zip(chunk, schema)], schema=schema))
+            count += len(chunk[0])
+    return count
+
+
+def export_table(handler: AbstractDataHandler, file, file_format: str,
+                 table: str, start: dt.datetime, end: dt.datetime,
+                 chunk_size: int = DEFAULT_CHUNK_SIZE) -> int:
+    """Stream a table of the window into file.
+
+    :param file: a text stream for csv and jsonl, a path or binary stream
+        for parquet
+    :return: the number of rows written
+    """
+    chunks = iter_chunks(handler, table, start, end, chunk_size)
+    if file_format == 'csv':
+        return write_csv(file, FIELDS[table], chunks)
+    elif file_format == 'jsonl':
+        return write_jsonl(file, FIELDS[table], chunks)
+    elif file_format == 'parquet':
+        return write_parquet(file, FIELDS[table], chunks)
+    raise ValueError('Unknown format: {}'.format(file_format))
+
+
+def guess_format(path: str, default: str = None) -> str:
+    for file_format in FORMATS:
+        if path.endswith('.' + file_format):
+            return file_format
+    if path.endswith('.json'):
+        return 'jsonl'
+    return default
@@ -1,121 +1,476 @@
 import datetime as dt
+import itertools as it
 import sqlite3
-from typing import Optional, Tuple
+from contextlib import contextmanager
+from typing import Optional, Tuple, Iterator, Iterable, NamedTuple, Dict
 
 from anpy import AbstractDataHandler
+from anpy import BUCKETS
+from anpy import CategoryDurations
+from anpy import DEFAULT_DAY_START_TIME
 from anpy import Record
+from anpy import RecordBatch
 from anpy import Session
 
 
+def _table_names(db: sqlite3.Connection):
+    cur = db.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    return {tup[0] for tup in cur.fetchall()}
+
+
+def _migrate_to_v1(db: sqlite3.Connection):
+    """Give every column a type and index the columns used by range queries.
+
+    Databases created before schema versioning have untyped tables, so they
+    are rebuilt and their rows copied over.
+    """
+    legacy = _table_names(db) & {'categories', 'beginnings', 'records'}
+    for table in legacy:
+        db.execute('ALTER TABLE {0} RENAME TO {0}_v0'.format(table))
+
+    db.execute('CREATE TABLE categories('
+               'name TEXT UNIQUE, active INTEGER DEFAULT 1)')
+    db.execute('CREATE TABLE beginnings('
+               'name TEXT, time_start REAL, done_or_canceled INTEGER DEFAULT 0)')
+    db.execute('CREATE TABLE records('
+               'name TEXT, time_start REAL, time_end REAL, '
+               'ignored INTEGER DEFAULT 0)')
+
+    if 'categories' in legacy:
+        db.execute('INSERT INTO categories(name, active) '
+                   'SELECT name, COALESCE(active, 1) FROM categories_v0')
+    if 'beginnings' in legacy:
+        db.execute('INSERT INTO beginnings(name, time_start, done_or_canceled) '
+                   'SELECT name, time_start, COALESCE(done_or_canceled, 0) '
+                   'FROM beginnings_v0')
+    if 'records' in legacy:
+        db.execute('INSERT INTO records(name, time_start, time_end, ignored) '
+                   'SELECT name, time_start, time_end, COALESCE(ignored, 0) '
+                   'FROM records_v0')
+    for table in legacy:
+        db.execute('DROP TABLE {}_v0'.format(table))
+
+    db.execute('CREATE INDEX records_time_start ON records(time_start)')
+    db.execute('CREATE INDEX records_name_time_start '
+               'ON records(name, time_start)')
+    db.execute('CREATE INDEX categories_active_name '
+               'ON categories(active, name)')
+
+
+def _migrate_to_v2(db: sqlite3.Connection):
+    """Key categories by integer id and reference them by id.
+
+    Joins become integer comparisons and renaming a category no longer
+    rewrites its history. Existing category rowids become the ids.
+    """
+    for table in ('categories', 'beginnings', 'records'):
+        db.execute('ALTER TABLE {0} RENAME TO {0}_v1'.format(table))
+
+    db.execute('CREATE TABLE categories('
+               'id INTEGER PRIMARY KEY, name TEXT UNIQUE, '
+               'active INTEGER DEFAULT 1)')
+    db.execute('CREATE TABLE beginnings('
+               'category_id INTEGER REFERENCES categories(id), '
+               'time_start REAL, done_or_canceled INTEGER DEFAULT 0)')
+    db.execute('CREATE TABLE records('
+               'category_id INTEGER REFERENCES categories(id), '
+               'time_start REAL, time_end REAL, ignored INTEGER DEFAULT 0)')
+
+    db.execute('INSERT INTO categories(id, name, active) '
+               'SELECT rowid, name, active FROM categories_v1')
+    db.execute('INSERT INTO beginnings(category_id, time_start, '
+               'done_or_canceled) '
+               'SELECT c.id, b.time_start, b.done_or_canceled '
+               'FROM beginnings_v1 AS b LEFT JOIN categories AS c '
+               'ON c.name = b.name')
+    db.execute('INSERT INTO records(category_id, time_start, time_end, '
+               'ignored) '
+               'SELECT c.id, r.time_start, r.time_end, r.ignored '
+               'FROM records_v1 AS r LEFT JOIN categories AS c '
+               'ON c.name = r.name ORDER BY r.time_start')
+    for table in ('categories', 'beginnings', 'records'):
+        db.execute('DROP TABLE {}_v1'.format(table))
+
+    db.execute('CREATE INDEX records_time_start ON records(time_start)')
+    db.execute('CREATE INDEX records_category_time_start '
+               'ON records(category_id, time_start)')
+    db.execute('CREATE INDEX categories_active_name '
+               'ON categories(active, name)')
+
+
+ROLLUP_DAY_START_TIME = DEFAULT_DAY_START_TIME
+"""Time at which the days of the daily_totals rollup begin"""
+
+
+def _day_expression(column: str,
+                    day_start_time: dt.time = ROLLUP_DAY_START_TIME) -> str:
+    """SQL for the local date of the day that a timestamp column falls in."""
+    offset = (day_start_time.hour * 3600 + day_start_time.minute * 60
+              + day_start_time.second)
+    return "date({}, 'unixepoch', 'localtime', '-{:d} seconds')".format(
+        column, offset)
+
+
+def _parse_duration_row(row: tuple) -> tuple:
+    """Convert the dates and timestamps of a row of summed durations."""
+    return (dt.date.fromisoformat(row[0]), row[1], row[2],
+            dt.datetime.fromtimestamp(row[3]),
+            dt.datetime.fromtimestamp(row[4]))
+
+
+# Records migrated from version 1 without a matching category have no
+# category_id; they are never read back, so they stay out of the rollup.
+_ROLLUP_SELECT = (
+    'SELECT ' + _day_expression('time_start') + ' AS day, category_id, '
+    'SUM(time_end - time_start), MIN(time_start), MAX(time_end) '
+    'FROM records WHERE category_id IS NOT NULL GROUP BY day, category_id')
+
+_ROLLUP_UPSERT = (
+    'INSERT INTO daily_totals(day, category_id, seconds, first_start, '
+    'last_end) VALUES (' + _day_expression(':start') + ', :category_id, '
+    ':end - :start, :start, :end) '
+    'ON CONFLICT(day, category_id) DO UPDATE SET '
+    'seconds = seconds + excluded.seconds, '
+    'first_start = MIN(first_start, excluded.first_start), '
+    'last_end = MAX(last_end, excluded.last_end)')
+
+
+def _migrate_to_v3(db: sqlite3.Connection):
+    """Add the daily_totals rollup and fill it from the existing records."""
+    db.execute('CREATE TABLE daily_totals('
+               'day TEXT, category_id INTEGER REFERENCES categories(id), '
+               'seconds REAL, first_start REAL, last_end REAL, '
+               'PRIMARY KEY (day, category_id)) WITHOUT ROWID')
+    db.execute('INSERT INTO daily_totals ' + _ROLLUP_SELECT)
+
+
+_BUCKET_MODIFIERS = {
+    'day': '',
+    'week': ", 'weekday 0', '-6 days'",
+    'month': ", 'start of month'",
+}
+"""Date modifiers taking a local date to the label of its bucket"""
+
+MIGRATIONS = [_migrate_to_v1, _migrate_to_v2, _migrate_to_v3]
+"""Schema migrations; running MIGRATIONS[i] upgrades version i to i + 1."""
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+DEFAULT_CHUNK_SIZE = 1000
+"""Number of rows fetched at a time when streaming records"""
+
+DEFAULT_BATCH_SIZE = 10000
+"""Number of records inserted per transaction by bulk imports"""
+
+DEFAULT_BUSY_TIMEOUT = 5.0
+"""Seconds to wait for another connection's lock before giving up"""
+
+
+class CacheInfo(NamedTuple):
+    """Hit and miss counts of a handler's category cache"""
+    hits: int
+    misses: int
+
+
+class _Categories(NamedTuple):
+    """A snapshot of the categories table"""
+    all: Tuple[str]
+    active: Tuple[str]
+    ids: Dict[str, int]
+    active_ids: Dict[str, int]
+
+
 class SQLDataHandler(AbstractDataHandler):
 
-    def __init__(self, db: sqlite3.Connection):
+    def __init__(self, db: sqlite3.Connection,
+                 chunk_size: int = DEFAULT_CHUNK_SIZE,
+                 busy_timeout: float = DEFAULT_BUSY_TIMEOUT,
+                 wal: bool = True):
+        """Wrap the connection, upgrading its schema if needed.
+
+        With wal set, the database is switched to write-ahead logging so that
+        readers and the writer do not block each other. Writers wait up to
+        busy_timeout seconds for a competing writer to finish.
+        """
         self.db: sqlite3.Connection = db
-        self._create_tables()
-        db.commit()
+        self.chunk_size = chunk_size
+        self._transaction_depth = 0
+        self._write_locked = False
+        self._categories: Optional[_Categories] = None
+        self._data_version = None
+        self._commits = 0
+        self._rollbacks = 0
+        self._cache_hits = 0
+        self._cache_misses = 0
+        db.execute('PRAGMA busy_timeout = {:d}'.format(
+            int(busy_timeout * 1000)))
+        if wal:
+            db.execute('PRAGMA journal_mode = WAL')
+        self._migrate()
 
     def new_category(self, name: str):
         name = name.strip()
         if not name:
             raise ValueError
-        probe = self.db.execute(
-            'SELECT name FROM categories WHERE name = ? AND active',
-            [name]).fetchone()
-        if probe:
-            raise RuntimeError('Active category with that name exists')
-
-        self.db.execute(
-            'INSERT OR REPLACE INTO categories(name) VALUES (?)',
-            [name]
-        )
-        self.db.commit()
+        with self.transaction():
+            if name in self._get_categories().active_ids:
+                raise RuntimeError('Active category with that name exists')
+
+            self._invalidate_categories()
+            # Reactivate an archived category of the same name, keeping its
+            # id so that its history stays attached to it.
+            cur = self.db.execute(
+                'UPDATE categories SET active = 1 WHERE name = ?', [name])
+            if not cur.rowcount:
+                self.db.execute('INSERT INTO categories(name) VALUES (?)',
+                                [name])
 
     def set_category_activation(self, name: str, status: bool):
-        if name in self.all_categories:
-            self.db.execute('UPDATE categories SET active = ? where name = ?',
-                            [status, name])
-        else:
-            raise ValueError('Does not exist')
+        with self.transaction():
+            if name in self._get_categories().ids:
+                self._invalidate_categories()
+                self.db.execute(
+                    'UPDATE categories SET active = ? where name = ?',
+                    [status, name])
+            else:
+                raise ValueError('Does not exist')
 
     @property
     def all_categories(self) -> Tuple[str]:
-        cur = self.db.execute('SELECT name FROM categories')
-        return tuple(str(tup[0]) for tup in cur.fetchall())
+        return self._get_categories().all
 
     @property
     def active_categories(self) -> Tuple[str]:
-        cur = self.db.execute(
-            'SELECT name FROM categories WHERE active')
-        return tuple(str(tup[0]) for tup in cur.fetchall())
+        return self._get_categories().active
+
+    def cache_info(self) -> CacheInfo:
+        """Get the hit and miss counts of the category cache."""
+        return CacheInfo(self._cache_hits, self._cache_misses)
+
+    def _get_categories(self) -> _Categories:
+        """Get the categories, reading them only if they may have changed.
+
+        The handler's own writes drop the cached snapshot, and writes by other
+        connections are detected through PRAGMA data_version. That check is
+        skipped while this handler holds the write lock, since nobody else
+        can commit then.
+        """
+        if not self._write_locked:
+            self._check_data_version()
+        if self._categories is not None:
+            self._cache_hits += 1
+            return self._categories
+
+        self._cache_misses += 1
+        rows = self.db.execute(
+            'SELECT id, name, active FROM categories ORDER BY id').fetchall()
+        self._categories = _Categories(
+            tuple(str(name) for _, name, _ in rows),
+            tuple(str(name) for _, name, active in rows if active),
+            {name: id_ for id_, name, _ in rows},
+            {name: id_ for id_, name, active in rows if active})
+        return self._categories
+
+    def _invalidate_categories(self):
+        self._categories = None
+
+    def _check_data_version(self):
+        """Drop cached data if another connection committed since the last
+        check."""
+        version = self.db.execute('PRAGMA data_version').fetchone()[0]
+        if version != self._data_version:
+            self._data_version = version
+            self._invalidate_categories()
 
     def start(self, name: str, start: Optional[dt.datetime] = None):
         """Record the beginning of a working session.
 
         If there is no datetime object passed in, the datetime associated with
-        the current instant will be used instead.
+        the current instant will be used instead. The check for a running
+        session and the insert happen in one write transaction, so concurrent
+        calls cannot both start a session.
         """
         if start is None:
             start = dt.datetime.now()
 
-        if self.is_active_session():
-            raise RuntimeError('Current session still running')
+        with self.transaction():
+            if self.is_active_session():
+                raise RuntimeError('Current session still running')
 
-        if name not in self.active_categories:
-            raise ValueError('Given ID does not exist.')
+            category_id = self._get_categories().active_ids.get(name)
+            if category_id is None:
+                raise ValueError('Given ID does not exist.')
 
-        self.db.execute('INSERT OR REPLACE INTO beginnings(name, time_start) '
-                        + 'VALUES (?, ?)', [name, start.timestamp()])
-        self.db.commit()
+            self.db.execute(
+                'INSERT OR REPLACE INTO beginnings(category_id, time_start) '
+                + 'VALUES (?, ?)', [category_id, start.timestamp()])
 
     def cancel(self):
         """Cancel the current working session that is running"""
-        assert self.is_active_session(), 'No active session'
-        self._mark_done_or_cancel()
+        with self.transaction():
+            assert self.is_active_session(), 'No active session'
+            self._mark_done_or_cancel()
 
     def complete(self, end: dt.datetime = None):
         """Record the end of a current working session.
 
         If there is no datetime object passed in, the datetime associated with
-        the current instant will be used instead.
+        the current instant will be used instead. The session is closed and
+        its record written in one write transaction, so concurrent calls
+        cannot record it twice.
         """
         if end is None:
             end = dt.datetime.now()
 
-        if self.is_active_session():
-            session = self.get_most_recent_session()
+        with self.transaction():
+            if not self.is_active_session():
+                raise RuntimeError('No running session')
+            category_id, time_start = self.db.execute(
+                'SELECT category_id, time_start FROM beginnings '
+                + 'ORDER BY time_start DESC LIMIT 1').fetchone()
             self._mark_done_or_cancel()
-            self.db.execute('INSERT INTO records(name, time_start, time_end) '
-                            + 'VALUES (?, ?, ?)',
-                            [session.name,
-                             session.time_start.timestamp(),
-                             end.timestamp()])
-            self.db.commit()
-        else:
-            raise RuntimeError('No running session')
-        pass
+            self.db.execute('INSERT INTO records(category_id, time_start, '
+                            + 'time_end) VALUES (?, ?, ?)',
+                            [category_id, time_start, end.timestamp()])
+            self._add_to_daily_totals([(category_id, time_start,
+                                        end.timestamp())])
+
+    def import_records(self, records: Iterable[Record],
+                       batch_size: int = DEFAULT_BATCH_SIZE,
+                       create_categories: bool = False) -> int:
+        """Insert completed records in bulk.
+
+        The categories are looked up once, and the records are inserted with
+        executemany, committing once per batch_size records. Records naming an
+        unknown category raise a ValueError unless create_categories is set,
+        in which case the category is created. A batch that fails is rolled
+        back; batches before it stay imported unless the import runs inside
+        an enclosing transaction.
+
+        :return: the number of records imported
+        """
+        known = dict(self._get_categories().ids)
+        records = iter(records)
+        count = 0
+        while True:
+            batch = list(it.islice(records, batch_size))
+            if not batch:
+                return count
+            with self.transaction():
+                rows = []
+                for record in batch:
+                    if record.end < record.start:
+                        raise ValueError(
+                            'Record ends before it starts: {}'.format(record))
+                    if record.name not in known:
+                        if not create_categories or not record.name.strip():
+                            raise ValueError('Unknown category: {}'
+                                             .format(record.name))
+                        self._invalidate_categories()
+                        cur = self.db.execute(
+                            'INSERT INTO categories(name) VALUES (?)',
+                            [record.name])
+                        known[record.name] = cur.lastrowid
+                    rows.append((known[record.name],
+                                 record.start.timestamp(),
+                                 record.end.timestamp()))
+                self.db.executemany(
+                    'INSERT INTO records(category_id, time_start, time_end) '
+                    + 'VALUES (?, ?, ?)', rows)
+                self._add_to_daily_totals(rows)
+            count += len(batch)
 
     def rename_category(self, old_name: str, new_name: str):
-        if old_name in self.all_categories:
+        with self.transaction():
+            ids = self._get_categories().ids
+            if old_name not in ids:
+                raise ValueError('Given category does not exist')
+            if new_name != old_name and new_name in ids:
+                raise ValueError('Category with that name exists')
+            self._invalidate_categories()
             self.db.execute('UPDATE categories SET name = ? WHERE name = ?',
                             [new_name, old_name])
-            self.db.execute('UPDATE beginnings SET name = ? WHERE name = ?',
-                            [new_name, old_name])
-            self.db.execute('UPDATE records SET name = ? WHERE name = ?',
-                            [new_name, old_name])
-        else:
-            raise ValueError('Given category does not exist')
 
-    def _create_tables(self):
-        self.db.execute(
-            'CREATE TABLE IF NOT EXISTS categories(name UNIQUE, active DEFAULT 1);'
-        )
-        self.db.execute(
-            'CREATE TABLE IF NOT EXISTS beginnings(name, time_start, done_or_canceled DEFAULT 0);'
-        )
-        self.db.execute(
-            'CREATE TABLE IF NOT EXISTS records(name, time_start, time_end, ignored DEFAULT 0);'
-        )
-        self.db.commit()
+    def rebuild_daily_totals(self):
+        """Recreate the daily_totals rollup from the records table."""
+        with self.transaction():
+            self.db.execute('DELETE FROM daily_totals')
+            self.db.execute('INSERT INTO daily_totals ' + _ROLLUP_SELECT)
+
+    def _add_to_daily_totals(self, rows: Iterable[Tuple[int, float, float]]):
+        """Fold (category id, start, end) records into the rollup."""
+        self.db.executemany(_ROLLUP_UPSERT,
+                            ({'category_id': category_id,
+                              'start': time_start,
+                              'end': time_end}
+                             for category_id, time_start, time_end in rows))
+
+    @contextmanager
+    def transaction(self):
+        """Group the writes made inside the with block into one transaction.
+
+        The per-call commits of the handler's methods are suspended, and a
+        single commit is made when the outermost transaction exits. If it
+        exits with an exception, all of the grouped writes are rolled back.
+        Nested transactions join the enclosing one.
+
+        The outermost transaction takes the write lock up front with BEGIN
+        IMMEDIATE, so reads made inside it cannot be invalidated by another
+        connection's write before the transaction commits.
+        """
+        if not self._transaction_depth and not self.db.in_transaction:
+            self.db.execute('BEGIN IMMEDIATE')
+            self._check_data_version()
+            self._write_locked = True
+        self._transaction_depth += 1
+        try:
+            yield self
+        except BaseException:
+            self._transaction_depth -= 1
+            if not self._transaction_depth:
+                self._write_locked = False
+                self._invalidate_categories()
+                self.db.rollback()
+                self._rollbacks += 1
+            raise
+        self._transaction_depth -= 1
+        if not self._transaction_depth:
+            self._write_locked = False
+            self.db.commit()
+            self._commits += 1
+
+    @property
+    def data_version(self):
+        """A token that changes whenever the stored data may have changed,
+        whether by this handler or by another connection, or None inside a
+        transaction."""
+        if self._transaction_depth:
+            return None
+        self._check_data_version()
+        return self._data_version, self._commits, self._rollbacks
+
+    @property
+    def schema_version(self) -> int:
+        return self.db.execute('PRAGMA user_version').fetchone()[0]
+
+    def _migrate(self):
+        """Bring the database schema up to SCHEMA_VERSION.
+
+        The version is tracked in PRAGMA user_version, so an up-to-date
+        database costs a single PRAGMA read and nothing is written.
+        """
+        version = self.schema_version
+        if version == SCHEMA_VERSION:
+            return
+        if version > SCHEMA_VERSION:
+            raise RuntimeError('Database schema version {} is newer than '
+                               'supported version {}'.format(version,
+                                                             SCHEMA_VERSION))
+        with self.transaction():
+            # Another process may have migrated while we waited for the lock.
+            for migration in MIGRATIONS[self.schema_version:]:
+                migration(self.db)
+            self.db.execute('PRAGMA user_version = {}'.format(SCHEMA_VERSION))
 
     def _mark_done_or_cancel(self):
         cur = self.db.execute(
@@ -125,7 +480,6 @@ class SQLDataHandler(AbstractDataHandler):
         # self.db.execute(
         #    'UPDATE beginnings SET done_or_canceled = 1 WHERE ROWID = ?',
         #    [row])
-        self.db.commit()
 
     def is_active_session(self):
         recent_session = self.get_most_recent_session()
@@ -136,7 +490,7 @@ class SQLDataHandler(AbstractDataHandler):
     def get_most_recent_session(self):
         cur = self.db.execute(
             'SELECT cat.name, b.time_start, b.done_or_canceled '
-            + 'FROM categories AS cat, beginnings as b WHERE cat.name = b.name ORDER BY time_start DESC LIMIT 1'
+            + 'FROM categories AS cat, beginnings as b WHERE cat.id = b.category_id ORDER BY time_start DESC LIMIT 1'
         )
         result = cur.fetchone()
 
@@ -147,16 +501,169 @@ class SQLDataHandler(AbstractDataHandler):
         else:
             return None
 
+    def get_record_span(self):
+        first_start, last_end = self.db.execute(
+            'SELECT MIN(time_start), MAX(time_end) FROM records').fetchone()
+        if first_start is None:
+            return None
+        return (dt.datetime.fromtimestamp(first_start),
+                dt.datetime.fromtimestamp(last_end))
+
     def get_records_between(self, start: dt.datetime, end: dt.datetime):
+        return list(self.iter_records_between(start, end))
+
+    def iter_records_between(self, start: dt.datetime, end: dt.datetime,
+                             chunk_size: int = None) -> Iterator[Record]:
+        """Stream the records between the two times from the cursor.
+
+        Rows are fetched chunk_size at a time, defaulting to the handler's
+        chunk_size.
+        """
         assert start < end, 'Invalid times'
-        records = self.db.execute(
+        if chunk_size is None:
+            chunk_size = self.chunk_size
+        cur = self.db.execute(
             'SELECT c.name, r.time_start, r.time_end '
             + 'FROM categories as c, records as r '
-            + 'WHERE c.name = r.name AND r.time_start >= ? '
+            + 'WHERE c.id = r.category_id AND r.time_start >= ? '
+            + 'AND r.time_start < ? ORDER BY r.time_start', [start.timestamp(),
+                                                             end.timestamp()]
+        )
+        try:
+            rows = cur.fetchmany(chunk_size)
+            while rows:
+                for tup in rows:
+                    yield Record(tup[0],
+                                 dt.datetime.fromtimestamp(tup[1]),
+                                 dt.datetime.fromtimestamp(tup[2]))
+                rows = cur.fetchmany(chunk_size)
+        finally:
+            cur.close()
+
+    def get_record_batch(self, start: dt.datetime, end: dt.datetime) \
+            -> RecordBatch:
+        """Read the records between the two times straight into arrays.
+
+        Category ids are mapped to indices of the batch's categories, and no
+        datetime objects are created.
+        """
+        batch = None
+        for chunk in self.iter_record_batches(start, end):
+            if batch is None:
+                batch = chunk
+            else:
+                batch.names.extend(chunk.names)
+                batch.starts.extend(chunk.starts)
+                batch.ends.extend(chunk.ends)
+        if batch is None:
+            batch = RecordBatch(list(self._get_categories().all))
+        return batch
+
+    def iter_record_batches(self, start: dt.datetime, end: dt.datetime,
+                            chunk_size: int = None) -> Iterator[RecordBatch]:
+        """Stream the records between the two times as RecordBatches.
+
+        Each batch holds the rows of one fetch from the cursor, and all of
+        them share the handler's list of categories.
+        """
+        assert start < end, 'Invalid times'
+        if chunk_size is None:
+            chunk_size = self.chunk_size
+        categories = self._get_categories()
+        position = {categories.ids[name]: i
+                    for i, name in enumerate(categories.all)}
+        names = list(categories.all)
+        cur = self.db.execute(
+            'SELECT r.category_id, r.time_start, r.time_end '
+            + 'FROM categories as c, records as r '
+            + 'WHERE c.id = r.category_id AND r.time_start >= ? '
             + 'AND r.time_start < ? ORDER BY r.time_start', [start.timestamp(),
                                                              end.timestamp()]
-        ).fetchall()
-        return [Record(tup[0],
-                       dt.datetime.fromtimestamp(tup[1]),
-                       dt.datetime.fromtimestamp(tup[2]))
-                for tup in records]
+        )
+        try:
+            rows = cur.fetchmany(chunk_size)
+            while rows:
+                batch = RecordBatch(names)
+                batch.names.extend(position[tup[0]] for tup in rows)
+                batch.starts.extend(tup[1] for tup in rows)
+                batch.ends.extend(tup[2] for tup in rows)
+                yield batch
+                rows = cur.fetchmany(chunk_size)
+        finally:
+            cur.close()
+
+    def get_category_durations(self, start: dt.datetime, end: dt.datetime,
+                               bucket: str = 'day',
+                               day_start_time: dt.time = None) \
+            -> CategoryDurations:
+        """Sum the durations per bucket and category inside SQLite.
+
+        Only one row per bucket and category leaves the database, so long
+        windows never materialize individual records. Windows made of whole
+        rollup days are summed from daily_totals, costing O(days x
+        categories) however many sessions there are.
+        """
+        assert start < end, 'Invalid times'
+        if day_start_time is None:
+            day_start_time = DEFAULT_DAY_START_TIME
+        if bucket not in BUCKETS:
+            raise ValueError('Unknown bucket: {}'.format(bucket))
+
+        cur = self._query_category_durations(start, end, bucket,
+                                             day_start_time)
+        rows = (_parse_duration_row(tup) for tup in cur.fetchall())
+        return CategoryDurations.from_rows(rows, start, end, bucket,
+                                           day_start_time)
+
+    def iter_daily_totals(self, start: dt.datetime, end: dt.datetime,
+                          day_start_time: dt.time = None,
+                          chunk_size: int = None) -> Iterator[tuple]:
+        """Stream the seconds per day and category from the cursor.
+
+        Like get_category_durations, windows of whole rollup days are read
+        from daily_totals.
+        """
+        assert start < end, 'Invalid times'
+        if day_start_time is None:
+            day_start_time = DEFAULT_DAY_START_TIME
+        if chunk_size is None:
+            chunk_size = self.chunk_size
+        cur = self._query_category_durations(start, end, 'day',
+                                             day_start_time, ordered=True)
+        try:
+            rows = cur.fetchmany(chunk_size)
+            while rows:
+                yield from map(_parse_duration_row, rows)
+                rows = cur.fetchmany(chunk_size)
+        finally:
+            cur.close()
+
+    def _query_category_durations(self, start: dt.datetime,
+                                  end: dt.datetime, bucket: str,
+                                  day_start_time: dt.time,
+                                  ordered: bool = False) -> sqlite3.Cursor:
+        """Execute the query of the (bucket, category, seconds, first start,
+        last end) rows of the window."""
+        order = ' ORDER BY bucket, c.name' if ordered else ''
+        if day_start_time == ROLLUP_DAY_START_TIME \
+                and start.time() == end.time() == ROLLUP_DAY_START_TIME:
+            return self.db.execute(
+                'SELECT date(t.day' + _BUCKET_MODIFIERS[bucket] + ') '
+                + 'AS bucket, c.name, SUM(t.seconds), MIN(t.first_start), '
+                + 'MAX(t.last_end) '
+                + 'FROM categories as c, daily_totals as t '
+                + 'WHERE c.id = t.category_id AND t.day >= ? AND t.day < ? '
+                + 'GROUP BY bucket, c.id' + order,
+                [start.date().isoformat(), end.date().isoformat()]
+            )
+        else:
+            day = _day_expression('r.time_start', day_start_time)
+            return self.db.execute(
+                'SELECT date(' + day + _BUCKET_MODIFIERS[bucket] + ') '
+                + 'AS bucket, c.name, SUM(r.time_end - r.time_start), '
+                + 'MIN(r.time_start), MAX(r.time_end) '
+                + 'FROM categories as c, records as r '
+                + 'WHERE c.id = r.category_id AND r.time_start >= ? '
+                + 'AND r.time_start < ? GROUP BY bucket, c.id' + order,
+                [start.timestamp(), end.timestamp()]
+            )
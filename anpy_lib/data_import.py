@@ -0,0 +1,213 @@
+import csv
+import datetime as dt
+import json
+import zipfile
+from typing import BinaryIO, Dict, Iterable, Iterator, List, Optional, \
+    TextIO, Tuple
+
+from anpy import AbstractDataHandler, Record, get_bucket
+
+FORMATS = ('csv', 'jsonl', 'xlsx')
+
+NAME_FIELDS = ('name', 'category', 'Project')
+"""Fields that may hold the category name, in order of preference"""
+
+
+def parse_time(value) -> dt.datetime:
+    """Parse an epoch timestamp or an ISO 8601 string into a datetime."""
+    if isinstance(value, (int, float)):
+        return dt.datetime.fromtimestamp(value)
+    value = value.strip()
+    try:
+        return dt.datetime.fromtimestamp(float(value))
+    except ValueError:
+        return dt.datetime.fromisoformat(value)
+
+
+def parse_record(fields: Dict[str, str]) -> Record:
+    """Make a record from the fields of one exported row.
+
+    Besides name/start/end, Toggl-style rows with a Project and separate
+    Start date, Start time, End date and End time fields are understood.
+    """
+    name = next((fields[f] for f in NAME_FIELDS if fields.get(f)), None)
+    if name is None:
+        raise ValueError('Row has no category name: {}'.format(fields))
+
+    if 'start' in fields:
+        start = parse_time(fields['start'])
+        end = parse_time(fields['end'])
+    else:
+        start = parse_time('{}T{}'.format(fields['Start date'],
+                                          fields['Start time']))
+        end = parse_time('{}T{}'.format(fields['End date'],
+                                        fields['End time']))
+    return Record(name.strip(), start, end)
+
+
+def read_csv_records(stream: TextIO) -> Iterator[Record]:
+    """Lazily read records from a CSV file with a header row."""
+    for fields in csv.DictReader(stream):
+        yield parse_record(fields)
+
+
+def read_jsonl_records(stream: TextIO) -> Iterator[Record]:
+    """Lazily read records from a file with one JSON object per line."""
+    for line in stream:
+        if line.strip():
+            yield parse_record(json.loads(line))
+
+
+def _get_time(value) -> Optional[dt.time]:
+    """Get the time of day of a cell value, or None if it has none."""
+    if isinstance(value, dt.datetime):
+        return value.time()
+    if isinstance(value, dt.time):
+        return value
+    return None
+
+
+def _get_day_time(day_start: dt.datetime, time: dt.time) -> dt.datetime:
+    """Get the datetime of a time of day in the day beginning at day_start.
+
+    Times earlier than the day's start time are past midnight.
+    """
+    datetime = dt.datetime.combine(day_start.date(), time)
+    if time < day_start.time():
+        datetime += dt.timedelta(days=1)
+    return datetime
+
+
+def get_day_records(day_start: dt.datetime, started, ended,
+                    minutes: Iterable[Tuple[str, float]]) -> List[Record]:
+    """Reconstruct records that add up to the minutes of one day of a week
+    sheet.
+
+    A week sheet only keeps the minutes per category and when work started
+    and ended, so the day gets one record per category, laid end to end in
+    column order from the time started. If there is time to spare, the last
+    one is moved to end at the time ended, so both times survive.
+    """
+    time = _get_time(started)
+    cursor = _get_day_time(day_start, time) if time else day_start
+    records = []
+    for name, value in minutes:
+        if isinstance(value, (int, float)) and value > 0:
+            end = cursor + dt.timedelta(minutes=value)
+            records.append(Record(name, cursor, end))
+            cursor = end
+
+    time = _get_time(ended)
+    if len(records) > 1 and time:
+        work_end = _get_day_time(day_start, time)
+        if work_end < records[0].start:
+            work_end += dt.timedelta(days=1)
+        if work_end > cursor:
+            name, start, end = records[-1]
+            records[-1] = Record(name, start + (work_end - end), work_end)
+    return records
+
+
+def read_xlsx_weeks(stream: BinaryIO) \
+        -> Iterator[Tuple[dt.datetime, List[Record]]]:
+    """Lazily reconstruct the records of each week sheet of a log file.
+
+    The workbook is opened read-only, so only the rows of the current sheet
+    are parsed at a time. Sheets that are not week sheets, and the hidden
+    copies holding formulas, are skipped.
+
+    :return: an iterator of (start of the week, records of the week)
+    :raises ValueError: if the stream does not hold a workbook
+    """
+    from openpyxl import load_workbook
+    from openpyxl.utils.exceptions import InvalidFileException
+    from anpy_lib import column_creation as cc
+
+    titles = tuple(column.title for column
+                   in cc.SheetLayout.for_categories(()).columns)
+    try:
+        workbook = load_workbook(stream, read_only=True)
+    except (zipfile.BadZipFile, InvalidFileException) as e:
+        raise ValueError('Not an xlsx workbook: {}'.format(e)) from e
+    try:
+        for ws in workbook.worksheets:
+            if ws.title.endswith(cc.FORMULAS_SHEET_SUFFIX):
+                continue
+            rows = ws.iter_rows(max_row=cc.NUM_BODY_ITEMS + 1,
+                                values_only=True)
+            header = next(rows, ())
+            if tuple(header[:cc.NUM_TITLES]) != titles:
+                continue
+            subjects = cc.get_subjects(ws, cc.NUM_TITLES)
+            first = None
+            records = []
+            for i, row in enumerate(rows):
+                if first is None:
+                    if not isinstance(row[0], dt.datetime):
+                        break
+                    first = row[0]
+                row = row + (None,) * (cc.NUM_TITLES + len(subjects)
+                                       - len(row))
+                records.extend(get_day_records(
+                    first + dt.timedelta(days=i), row[1], row[2],
+                    zip(subjects, row[cc.NUM_TITLES:])))
+            if first is not None:
+                yield first, records
+    finally:
+        workbook.close()
+
+
+def read_xlsx_records(stream: BinaryIO) -> Iterator[Record]:
+    """Lazily reconstruct the records of the week sheets of a log file."""
+    for _, records in read_xlsx_weeks(stream):
+        yield from records
+
+
+def _skip_recorded_days(handler: AbstractDataHandler,
+                        weeks: Iterable[Tuple[dt.datetime, List[Record]]]) \
+        -> Iterator[Record]:
+    """Leave out the records of days that already have records."""
+    for first, records in weeks:
+        durations = handler.get_category_durations(
+            first, first + dt.timedelta(days=7),
+            day_start_time=first.time())
+        recorded = {day for day, start in zip(durations.buckets,
+                                              durations.work_starts)
+                    if start is not None}
+        for record in records:
+            if get_bucket(record.start, 'day', first.time()) not in recorded:
+                yield record
+
+
+def import_workbook(handler: AbstractDataHandler, stream: BinaryIO,
+                    create_categories: bool = False) -> int:
+    """Import the week sheets of a log file in one transaction.
+
+    Days that already have records in the handler are skipped, so a log
+    exported from the database, or imported before, adds nothing.
+
+    :return: the number of records imported
+    """
+    with handler.transaction():
+        return handler.import_records(
+            _skip_recorded_days(handler, read_xlsx_weeks(stream)),
+            create_categories=create_categories)
+
+
+def read_records(stream, file_format: str) -> Iterable[Record]:
+    if file_format == 'csv':
+        return read_csv_records(stream)
+    elif file_format == 'jsonl':
+        return read_jsonl_records(stream)
+    elif file_format == 'xlsx':
+        return read_xlsx_records(stream)
+    raise ValueError('Unknown format: {}'.format(file_format))
+
+
+def guess_format(path: str, default: str = 'csv') -> str:
+    for file_format in FORMATS:
+        if path.endswith('.' + file_format):
+            return file_format
+    if path.endswith('.json'):
+        return 'jsonl'
+    return default
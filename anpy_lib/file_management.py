@@ -4,12 +4,24 @@ import os
 APP_PATH = os.path.expanduser(os.path.join('~', '.anpy'))
 DATABASE_PATH = os.path.join(APP_PATH, 'data.db')
 CONFIG_PATH = os.path.join(APP_PATH, 'config.ini')
+SOCKET_PATH = os.path.join(APP_PATH, 'anpyd.sock')
+DEFAULT_LOG_PATH = os.path.join(APP_PATH, 'log.xlsx')
+
+EXPORT_LAYOUTS = ('single', 'week', 'month')
+"""How exported weeks are spread over files: all in the log file, or one
+file per week or per month next to it"""
 
 
 def create_anpy_dir_if_not_exist(path=APP_PATH):
     os.makedirs(name=APP_PATH, exist_ok=True)
 
 
+def read_config(path=CONFIG_PATH):
+    config = configparser.ConfigParser()
+    config.read(path)
+    return config
+
+
 def create_config_file(excel_path, app_path=APP_PATH):
     excel_path = clean_excel_file(excel_path)
     config = configparser.ConfigParser()
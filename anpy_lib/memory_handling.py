@@ -0,0 +1,525 @@
+"""A data handler that keeps everything in memory.
+
+Records live in parallel arrays sorted by start time, so a range query is
+two binary searches and a slice, and categories live in dicts. Daily totals
+are rolled up as records arrive, like the daily_totals table of the SQLite
+backend. Nothing is saved; the handler is meant for tests, benchmarks and
+what-if analysis on a copy of the data.
+"""
+import datetime as dt
+import itertools as it
+from array import array
+from bisect import bisect_left, bisect_right
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from anpy import AbstractDataHandler
+from anpy import BUCKETS
+from anpy import CategoryDurations
+from anpy import DEFAULT_DAY_START_TIME
+from anpy import RECORDS_END
+from anpy import RECORDS_EPOCH
+from anpy import Record
+from anpy import RecordBatch
+from anpy import Session
+from anpy import get_bucket
+from anpy_lib.data_handling import DEFAULT_BATCH_SIZE, DEFAULT_CHUNK_SIZE, \
+    ROLLUP_DAY_START_TIME
+
+
+def _add_to_total(total: Optional[tuple], time_start: float,
+                  time_end: float) -> tuple:
+    """Fold a record into a (seconds, first start, last end) total."""
+    if total is None:
+        return time_end - time_start, time_start, time_end
+    seconds, first_start, last_end = total
+    return (seconds + (time_end - time_start), min(first_start, time_start),
+            max(last_end, time_end))
+
+
+class MemoryDataHandler(AbstractDataHandler):
+
+    def __init__(self, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        """Create an empty handler.
+
+        Writes are grouped into transactions like in SQLDataHandler; the
+        changes made by a transaction that fails are undone.
+        """
+        self.chunk_size = chunk_size
+        # Category ids are indices into _names, in order of creation.
+        self._names: List[str] = []
+        self._ids: Dict[str, int] = dict()
+        self._active: Dict[str, int] = dict()
+        self._active_names: Optional[Tuple[str]] = None
+        self._category_ids = array('I')
+        self._starts = array('d')
+        self._ends = array('d')
+        self._session: Optional[Tuple[int, float]] = None
+        # day -> category id -> (seconds, first start, last end)
+        self._totals: Dict[dt.date, Dict[int, tuple]] = dict()
+        self._days: List[dt.date] = []
+        self._transaction_depth = 0
+        self._undo: Optional[List[Callable[[], None]]] = None
+        self._version = 0
+
+    @classmethod
+    def from_handler(cls, handler: AbstractDataHandler,
+                     chunk_size: int = DEFAULT_CHUNK_SIZE) \
+            -> 'MemoryDataHandler':
+        """Copy the categories, records and running session of another
+        handler, so that changes can be tried out without touching it."""
+        copy = cls(chunk_size)
+        active = set(handler.active_categories)
+        with copy.transaction():
+            for name in handler.all_categories:
+                copy._add_category(name)
+                if name not in active:
+                    copy._set_active(name, False)
+            session = handler.get_most_recent_session()
+            if session is not None and not session.done_or_canceled:
+                copy._set_session((copy._ids[session.name],
+                                   session.time_start.timestamp()))
+        # The records need no undo log, since nobody else has seen the copy.
+        for batch in handler.iter_record_batches(RECORDS_EPOCH, RECORDS_END,
+                                                 chunk_size):
+            ids = array('I', (copy._ids[name] for name in batch.categories))
+            copy._category_ids.extend(ids[i] for i in batch.names)
+            copy._starts.extend(batch.starts)
+            copy._ends.extend(batch.ends)
+        copy._totals, copy._days = copy._sum_daily_totals()
+        copy._version = 0
+        return copy
+
+    def new_category(self, name: str):
+        name = name.strip()
+        if not name:
+            raise ValueError
+        with self.transaction():
+            if name in self._active:
+                raise RuntimeError('Active category with that name exists')
+            # Reactivate an archived category of the same name, keeping its
+            # id so that its history stays attached to it.
+            if name in self._ids:
+                self._set_active(name, True)
+            else:
+                self._add_category(name)
+
+    def set_category_activation(self, name: str, status: bool):
+        with self.transaction():
+            if name not in self._ids:
+                raise ValueError('Does not exist')
+            self._set_active(name, status)
+
+    @property
+    def all_categories(self) -> Tuple[str]:
+        return tuple(self._names)
+
+    @property
+    def active_categories(self) -> Tuple[str]:
+        if self._active_names is None:
+            self._active_names = tuple(sorted(self._active,
+                                              key=self._active.get))
+        return self._active_names
+
+    def rename_category(self, old_name: str, new_name: str):
+        with self.transaction():
+            if old_name not in self._ids:
+                raise ValueError('Given category does not exist')
+            if new_name == old_name:
+                return
+            if new_name in self._ids:
+                raise ValueError('Category with that name exists')
+            category_id = self._ids[old_name]
+            active = old_name in self._active
+
+            def undo():
+                del self._ids[new_name]
+                self._ids[old_name] = category_id
+                self._names[category_id] = old_name
+                if active:
+                    del self._active[new_name]
+                    self._active[old_name] = category_id
+                self._active_names = None
+
+            del self._ids[old_name]
+            self._ids[new_name] = category_id
+            self._names[category_id] = new_name
+            if active:
+                del self._active[old_name]
+                self._active[new_name] = category_id
+            self._active_names = None
+            self._undo.append(undo)
+
+    def _add_category(self, name: str) -> int:
+        category_id = len(self._names)
+
+        def undo():
+            self._names.pop()
+            del self._ids[name]
+            self._active.pop(name, None)
+            self._active_names = None
+
+        self._names.append(name)
+        self._ids[name] = category_id
+        self._active[name] = category_id
+        self._active_names = None
+        self._undo.append(undo)
+        return category_id
+
+    def _set_active(self, name: str, status: bool):
+        was_active = name in self._active
+        if bool(status) == was_active:
+            return
+
+        def undo():
+            self._toggle_active(name)
+
+        self._toggle_active(name)
+        self._undo.append(undo)
+
+    def _toggle_active(self, name: str):
+        if name in self._active:
+            del self._active[name]
+        else:
+            self._active[name] = self._ids[name]
+        self._active_names = None
+
+    def start(self, name: str, start: Optional[dt.datetime] = None):
+        """Record the beginning of a working session.
+
+        If there is no datetime object passed in, the datetime associated with
+        the current instant will be used instead.
+        """
+        if start is None:
+            start = dt.datetime.now()
+
+        with self.transaction():
+            if self.is_active_session():
+                raise RuntimeError('Current session still running')
+            category_id = self._active.get(name)
+            if category_id is None:
+                raise ValueError('Given ID does not exist.')
+            self._set_session((category_id, start.timestamp()))
+
+    def cancel(self):
+        """Cancel the current working session that is running"""
+        with self.transaction():
+            assert self.is_active_session(), 'No active session'
+            self._set_session(None)
+
+    def complete(self, end: dt.datetime = None):
+        """Record the end of a current working session.
+
+        If there is no datetime object passed in, the datetime associated with
+        the current instant will be used instead.
+        """
+        if end is None:
+            end = dt.datetime.now()
+
+        with self.transaction():
+            if not self.is_active_session():
+                raise RuntimeError('No running session')
+            category_id, time_start = self._session
+            self._set_session(None)
+            self._insert_record(category_id, time_start, end.timestamp())
+
+    def _set_session(self, session: Optional[Tuple[int, float]]):
+        previous = self._session
+
+        def undo():
+            self._session = previous
+
+        self._session = session
+        self._undo.append(undo)
+
+    def import_records(self, records: Iterable[Record],
+                       batch_size: int = DEFAULT_BATCH_SIZE,
+                       create_categories: bool = False) -> int:
+        """Insert completed records in bulk.
+
+        Records naming an unknown category raise a ValueError unless
+        create_categories is set, in which case the category is created.
+        Each batch of batch_size records is one transaction.
+
+        :return: the number of records imported
+        """
+        records = iter(records)
+        count = 0
+        while True:
+            batch = list(it.islice(records, batch_size))
+            if not batch:
+                return count
+            with self.transaction():
+                rows = []
+                for record in batch:
+                    if record.end < record.start:
+                        raise ValueError(
+                            'Record ends before it starts: {}'.format(record))
+                    if record.name not in self._ids:
+                        if not create_categories or not record.name.strip():
+                            raise ValueError('Unknown category: {}'
+                                             .format(record.name))
+                        self._add_category(record.name)
+                    rows.append((self._ids[record.name],
+                                 record.start.timestamp(),
+                                 record.end.timestamp()))
+                self._insert_records(rows)
+            count += len(batch)
+
+    def _insert_record(self, category_id: int, time_start: float,
+                       time_end: float):
+        i = bisect_right(self._starts, time_start)
+
+        def undo():
+            del self._category_ids[i]
+            del self._starts[i]
+            del self._ends[i]
+
+        self._category_ids.insert(i, category_id)
+        self._starts.insert(i, time_start)
+        self._ends.insert(i, time_end)
+        self._undo.append(undo)
+        self._add_to_daily_totals([(category_id, time_start, time_end)])
+
+    def _insert_records(self, rows: List[Tuple[int, float, float]]):
+        """Insert (category id, start, end) rows, appending them when they
+        all start after the last record and merging them in otherwise."""
+        rows.sort(key=lambda row: row[1])
+        previous = self._category_ids, self._starts, self._ends
+        if not self._starts or rows[0][1] >= self._starts[-1]:
+            length = len(self._starts)
+
+            def undo():
+                del self._category_ids[length:]
+                del self._starts[length:]
+                del self._ends[length:]
+
+            self._category_ids.extend(row[0] for row in rows)
+            self._starts.extend(row[1] for row in rows)
+            self._ends.extend(row[2] for row in rows)
+        else:
+            def undo():
+                self._category_ids, self._starts, self._ends = previous
+
+            # The sort is stable, so existing records stay ahead of new ones
+            # that start at the same time, like with _insert_record.
+            merged = sorted(it.chain(zip(*previous), rows),
+                            key=lambda row: row[1])
+            self._category_ids = array('I', (row[0] for row in merged))
+            self._starts = array('d', (row[1] for row in merged))
+            self._ends = array('d', (row[2] for row in merged))
+        self._undo.append(undo)
+        self._add_to_daily_totals(rows)
+
+    def rebuild_daily_totals(self):
+        """Recreate the rollup of daily totals from the records."""
+        with self.transaction():
+            previous = self._totals, self._days
+
+            def undo():
+                self._totals, self._days = previous
+
+            self._totals, self._days = self._sum_daily_totals()
+            self._undo.append(undo)
+
+    def _sum_daily_totals(self) \
+            -> Tuple[Dict[dt.date, Dict[int, tuple]], List[dt.date]]:
+        """Sum the records into a new rollup and its sorted list of days."""
+        totals = dict()
+        for category_id, time_start, time_end in zip(
+                self._category_ids, self._starts, self._ends):
+            day = get_bucket(dt.datetime.fromtimestamp(time_start), 'day',
+                             ROLLUP_DAY_START_TIME)
+            day_totals = totals.setdefault(day, dict())
+            day_totals[category_id] = _add_to_total(
+                day_totals.get(category_id), time_start, time_end)
+        return totals, sorted(totals)
+
+    def _add_to_daily_totals(self, rows: Iterable[Tuple[int, float, float]]):
+        """Fold (category id, start, end) records into the rollup."""
+        previous = dict()
+        days = self._days
+        for category_id, time_start, time_end in rows:
+            day = get_bucket(dt.datetime.fromtimestamp(time_start), 'day',
+                             ROLLUP_DAY_START_TIME)
+            totals = self._totals.get(day)
+            if totals is None:
+                totals = self._totals[day] = dict()
+                if days is self._days:
+                    self._days = list(days)
+                self._days.insert(bisect_left(self._days, day), day)
+            total = totals.get(category_id)
+            if (day, category_id) not in previous:
+                previous[day, category_id] = total
+            totals[category_id] = _add_to_total(total, time_start, time_end)
+
+        def undo():
+            for (day, category_id), total in previous.items():
+                if total is not None:
+                    self._totals[day][category_id] = total
+                    continue
+                del self._totals[day][category_id]
+                if not self._totals[day]:
+                    del self._totals[day]
+            self._days = days
+
+        self._undo.append(undo)
+
+    @contextmanager
+    def transaction(self):
+        """Group the writes made inside the with block.
+
+        If the outermost transaction exits with an exception, every write
+        made inside it is undone. Nested transactions join the enclosing
+        one.
+        """
+        if not self._transaction_depth:
+            self._undo = []
+        self._transaction_depth += 1
+        try:
+            yield self
+        except BaseException:
+            self._transaction_depth -= 1
+            if not self._transaction_depth:
+                for undo in reversed(self._undo):
+                    undo()
+                if self._undo:
+                    self._version += 1
+                self._undo = None
+            raise
+        self._transaction_depth -= 1
+        if not self._transaction_depth:
+            if self._undo:
+                self._version += 1
+            self._undo = None
+
+    @property
+    def data_version(self):
+        """A counter of the transactions that changed the data or were
+        rolled back, or None inside a transaction."""
+        if self._transaction_depth:
+            return None
+        return self._version
+
+    def is_active_session(self):
+        return self._session is not None
+
+    def get_most_recent_session(self):
+        if self._session is None:
+            return None
+        category_id, time_start = self._session
+        return Session(self._names[category_id],
+                       dt.datetime.fromtimestamp(time_start), False)
+
+    def get_record_span(self):
+        if not self._starts:
+            return None
+        return (dt.datetime.fromtimestamp(self._starts[0]),
+                dt.datetime.fromtimestamp(max(self._ends)))
+
+    def _get_range(self, start: dt.datetime, end: dt.datetime) \
+            -> Tuple[int, int]:
+        """Get the slice of the records starting between the two times."""
+        assert start < end, 'Invalid times'
+        lo = bisect_left(self._starts, start.timestamp())
+        return lo, bisect_left(self._starts, end.timestamp(), lo)
+
+    def get_records_between(self, start: dt.datetime, end: dt.datetime):
+        return list(self.iter_records_between(start, end))
+
+    def iter_records_between(self, start: dt.datetime, end: dt.datetime,
+                             chunk_size: int = None) -> Iterator[Record]:
+        lo, hi = self._get_range(start, end)
+        names = list(self._names)
+        for category_id, time_start, time_end in zip(
+                self._category_ids[lo:hi], self._starts[lo:hi],
+                self._ends[lo:hi]):
+            yield Record(names[category_id],
+                         dt.datetime.fromtimestamp(time_start),
+                         dt.datetime.fromtimestamp(time_end))
+
+    def get_record_batch(self, start: dt.datetime, end: dt.datetime) \
+            -> RecordBatch:
+        """Copy the slice of the arrays between the two times into a batch.
+
+        Category ids are already indices into the list of categories.
+        """
+        lo, hi = self._get_range(start, end)
+        return RecordBatch(list(self._names), self._category_ids[lo:hi],
+                           self._starts[lo:hi], self._ends[lo:hi])
+
+    def iter_record_batches(self, start: dt.datetime, end: dt.datetime,
+                            chunk_size: int = None) -> Iterator[RecordBatch]:
+        if chunk_size is None:
+            chunk_size = self.chunk_size
+        lo, hi = self._get_range(start, end)
+        names = list(self._names)
+        for i in range(lo, hi, chunk_size):
+            j = min(i + chunk_size, hi)
+            yield RecordBatch(names, self._category_ids[i:j],
+                              self._starts[i:j], self._ends[i:j])
+
+    def get_category_durations(self, start: dt.datetime, end: dt.datetime,
+                               bucket: str = 'day',
+                               day_start_time: dt.time = None) \
+            -> CategoryDurations:
+        """Sum the durations per bucket and category.
+
+        Windows made of whole rollup days are summed from the daily totals,
+        and other windows from the slice of the record arrays.
+        """
+        assert start < end, 'Invalid times'
+        if day_start_time is None:
+            day_start_time = DEFAULT_DAY_START_TIME
+        if bucket not in BUCKETS:
+            raise ValueError('Unknown bucket: {}'.format(bucket))
+        groups = self._sum_durations(start, end, bucket, day_start_time)
+        return CategoryDurations.from_rows(self._get_rows(groups), start, end,
+                                           bucket, day_start_time)
+
+    def iter_daily_totals(self, start: dt.datetime, end: dt.datetime,
+                          day_start_time: dt.time = None,
+                          chunk_size: int = None) -> Iterator[tuple]:
+        assert start < end, 'Invalid times'
+        if day_start_time is None:
+            day_start_time = DEFAULT_DAY_START_TIME
+        groups = self._sum_durations(start, end, 'day', day_start_time)
+        return iter(sorted(self._get_rows(groups),
+                           key=lambda row: (row[0], row[1])))
+
+    def _sum_durations(self, start: dt.datetime, end: dt.datetime,
+                       bucket: str, day_start_time: dt.time) -> dict:
+        """Map (bucket, category id) to (seconds, first start, last end)."""
+        groups = dict()
+        if day_start_time == ROLLUP_DAY_START_TIME \
+                and start.time() == end.time() == ROLLUP_DAY_START_TIME:
+            lo = bisect_left(self._days, start.date())
+            hi = bisect_left(self._days, end.date(), lo)
+            rows = ((get_bucket(dt.datetime.combine(day, day_start_time),
+                                bucket, day_start_time), category_id)
+                    + totals
+                    for day in self._days[lo:hi]
+                    for category_id, totals in self._totals[day].items())
+        else:
+            lo, hi = self._get_range(start, end)
+            rows = ((get_bucket(dt.datetime.fromtimestamp(time_start),
+                                bucket, day_start_time),
+                     category_id, time_end - time_start, time_start, time_end)
+                    for category_id, time_start, time_end in zip(
+                        self._category_ids[lo:hi], self._starts[lo:hi],
+                        self._ends[lo:hi]))
+        for date, category_id, seconds, first_start, last_end in rows:
+            key = (date, category_id)
+            if key in groups:
+                total, first, last = groups[key]
+                groups[key] = (total + seconds, min(first, first_start),
+                               max(last, last_end))
+            else:
+                groups[key] = (seconds, first_start, last_end)
+        return groups
+
+    def _get_rows(self, groups: dict) -> Iterator[tuple]:
+        for (date, category_id), (seconds, first, last) in groups.items():
+            yield (date, self._names[category_id], seconds,
+                   dt.datetime.fromtimestamp(first),
+                   dt.datetime.fromtimestamp(last))
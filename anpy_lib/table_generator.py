@@ -1,55 +1,140 @@
-from datetime import datetime, time, timedelta
+import sys
+from collections import defaultdict
+from datetime import date, datetime, time, timedelta
 
-from anpy import AbstractDataHandler, Day
-from anpy_lib.data_analysis import get_days, get_per_category_durations
-from anpy_lib.data_entry import get_most_recent_day
+from anpy import AbstractDataHandler, BUCKETS, CategoryDurations, Day, \
+    get_next_bucket
+from anpy_lib.data_analysis import DAYS_IN_A_WEEK, DaySummary, \
+    get_day_summaries, get_per_category_durations, get_window_start
+
+PLAIN_COLUMN_WIDTH = 10
+"""Minimum width of the columns printed by render_plain"""
 
 
 def create_table_iterable_and_headers(data_handler: AbstractDataHandler,
                                       reference_datetime: datetime = None,
-                                      day_start_time: time = None):
+                                      day_start_time: time = None,
+                                      num_days: int = DAYS_IN_A_WEEK,
+                                      bucket: str = 'day'):
+    """Build the status table of the num_days days ending with the current
+    day, with one row per bucket of the window.
+
+    The window is aggregated with one query at the requested granularity,
+    and the rows are generated as the returned iterable is consumed, ending
+    with a row of averages (of totals, for weeks and months).
+    """
     if reference_datetime is None:
         reference_datetime = datetime.now()
     if day_start_time is None:
         day_start_time = time(6, 0)
-
-    # 6 days prior
-    week_start_isoweekday = ((reference_datetime - timedelta(
-        hours=day_start_time.hour) + timedelta.resolution).isoweekday() + 1) % 7
-    week_start = get_most_recent_day(week_start_isoweekday, day_start_time,
-                                     reference_datetime)
-
-    days = get_days(data_handler, week_start, 7)
-
-    rows = []
-    for day in days:
-        rows.append(Row(day))
-
-    average_row = AverageRow(rows)
-
-    headers = ['date',
-               'time started',
-               'time ended',
-               'time total (h)',
+    if bucket not in BUCKETS:
+        raise ValueError('Unknown bucket: {}'.format(bucket))
+
+    first_day_start = get_window_start(num_days, reference_datetime,
+                                       day_start_time)
+
+    if bucket == 'day':
+        summaries = get_day_summaries(data_handler, first_day_start,
+                                      num_days, reference_datetime)
+        totals = defaultdict(int)
+        for summary in summaries:
+            for category, seconds in summary.durations.items():
+                totals[category] += seconds
+        ordered_categories = _order_categories(totals)
+        headers = ['date',
+                   'time started',
+                   'time ended',
+                   'time total (h)',
+                   'time working (h)',
+                   'efficiency'] + [c + ' (min)' for c in ordered_categories]
+        return _iter_day_rows(summaries, ordered_categories), headers
+
+    durations = data_handler.get_category_durations(
+        first_day_start, first_day_start + timedelta(days=num_days), bucket,
+        day_start_time)
+    ordered_categories = _order_categories(
+        {c: sum(row[i] or 0 for row in durations.seconds)
+         for i, c in enumerate(durations.categories)})
+    headers = [bucket,
+               'days',
                'time working (h)',
-               'efficiency'] + [c + ' (min)'
-                                for c in average_row.ordered_categories]
-
-    return [*rows, average_row], headers
+               'per day (h)'] + [c + ' (h)' for c in ordered_categories]
+    return _iter_period_rows(durations, bucket, first_day_start.date(),
+                             num_days, ordered_categories), headers
+
+
+def _order_categories(totals):
+    """Sort categories by decreasing time spent, then by name."""
+    return sorted(sorted(totals), key=lambda c: totals[c], reverse=True)
+
+
+def _iter_day_rows(summaries, ordered_categories):
+    rows = 0
+    time_total = time_working = 0
+    efficiencies = []
+    category_totals = defaultdict(int)
+    for summary in summaries:
+        row = Row.from_summary(summary)
+        row.sorted_categories = ordered_categories
+        yield row
+
+        rows += 1
+        time_total += row.time_total
+        time_working += row.time_working
+        if row.efficiency is not None:
+            efficiencies.append(row.efficiency)
+        for category, seconds in summary.durations.items():
+            category_totals[category] += seconds
+
+    average_efficiency = average(efficiencies)
+    yield (['averages:', None, None,
+            '{:.1f}'.format(time_total / rows),
+            '{:.1f}'.format(time_working / rows),
+            '{:.1%}'.format(
+                average_efficiency) if average_efficiency else None]
+           + ['{:.1f}'.format(category_totals[c] / rows / 60)
+              for c in ordered_categories])
+
+
+def _iter_period_rows(durations: CategoryDurations, bucket: str,
+                      first_date: date, num_days: int, ordered_categories):
+    end_date = first_date + timedelta(days=num_days)
+    category_totals = defaultdict(int)
+    for i, bucket_date in enumerate(durations.buckets):
+        days = (min(get_next_bucket(bucket_date, bucket), end_date)
+                - max(bucket_date, first_date)).days
+        row = PeriodRow(bucket_date, days, durations.get_bucket_durations(i))
+        row.sorted_categories = ordered_categories
+        yield row
+        for category, seconds in row.data.items():
+            category_totals[category] += seconds
+    totals = PeriodRow('totals:', num_days, category_totals)
+    totals.sorted_categories = ordered_categories
+    yield totals
 
 
 class Row:
-    def __init__(self, day: Day):
-        self.day = day
-        self.work_start: datetime = day.work_start
-        self.work_end: datetime = day.work_end
-        self.day_start_time = day.day_start
-        self.data = get_per_category_durations(day)
+    def __init__(self, day_start: datetime, work_start: datetime,
+                 work_end: datetime, data):
+        self.work_start: datetime = work_start
+        self.work_end: datetime = work_end
+        self.day_start_time = day_start
+        self.data = data
         self.sorted_categories = None
 
+    @classmethod
+    def from_day(cls, day: Day):
+        return cls(day.day_start, day.work_start, day.work_end,
+                   get_per_category_durations(day))
+
+    @classmethod
+    def from_summary(cls, summary: DaySummary):
+        return cls(summary.day_start, summary.work_start, summary.work_end,
+                   defaultdict(int, summary.durations))
+
     @property
     def date(self):
-        return self.day.day_start.date()
+        return self.day_start_time.date()
 
     @property
     def time_total(self):
@@ -92,7 +177,40 @@ class Row:
             data))
 
 
+class PeriodRow:
+    """A row summing the days of a week or month of the window."""
+
+    def __init__(self, label, num_days: int, data):
+        self.label = label
+        self.num_days = num_days
+        self.data = data
+        self.sorted_categories = None
+
+    @property
+    def time_working(self):
+        return sum(self.data.values()) / 3600
+
+    def __iter__(self):
+        if self.sorted_categories is None:
+            raise ValueError
+
+        return iter([self.label,
+                     self.num_days,
+                     '{:.1f}'.format(self.time_working),
+                     '{:.1f}'.format(self.time_working / self.num_days)]
+                    + ['{:.1f}'.format(self.data[c] / 3600)
+                       for c in self.sorted_categories])
+
+
 class AverageRow:
+    """The averages of a list of Rows, which it orders by category.
+
+    create_table_iterable_and_headers computes the same figures while it
+    streams the rows and no longer uses this class. It is kept for callers
+    that hold the rows in a list, and as the reference that the vectorized
+    analysis is checked against.
+    """
+
     def __init__(self, rows):
         self.rows = rows
         ordered_categories = self.ordered_categories
@@ -148,3 +266,19 @@ def average(iterable):
     if not iterable:
         return None
     return sum(iterable) / len(iterable)
+
+
+def render_plain(table, headers, file=None):
+    """Print the table row by row as it is generated.
+
+    Unlike tabulate, which needs every row to size the columns, the columns
+    are sized by the headers, so long tables start printing immediately.
+    """
+    if file is None:
+        file = sys.stdout
+    widths = [max(len(h), PLAIN_COLUMN_WIDTH) for h in headers]
+    print('  '.join(h.rjust(w) for h, w in zip(headers, widths)), file=file)
+    print('  '.join('-' * w for w in widths), file=file)
+    for row in table:
+        print('  '.join(('' if cell is None else str(cell)).rjust(w)
+                        for cell, w in zip(row, widths)), file=file)
@@ -0,0 +1,200 @@
+"""Vectorized analysis of records with NumPy.
+
+NumPy is optional; check AVAILABLE before calling anything in this module.
+The results are the same as those of data_analysis and table_generator, but
+the work per record is done by NumPy instead of a Python loop, which matters
+once a window holds hundreds of thousands of records.
+"""
+import datetime as dt
+import time
+from collections import defaultdict
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from anpy import AbstractDataHandler, RecordBatch
+from anpy_lib.data_analysis import DaySummary
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+AVAILABLE = np is not None
+"""Whether NumPy could be imported"""
+
+RECORD_DTYPE = [('name', 'u4'), ('start', 'f8'), ('end', 'f8')]
+"""Fields of a record array: the category index and epoch timestamps"""
+
+SECONDS_IN_A_DAY = 24 * 60 * 60
+
+
+def _require_numpy():
+    if np is None:
+        raise RuntimeError('NumPy is required for vectorized analysis')
+
+
+def to_array(batch: RecordBatch) -> 'np.ndarray':
+    """Copy the columns of the batch into a structured record array."""
+    _require_numpy()
+    records = np.empty(len(batch), dtype=RECORD_DTYPE)
+    records['name'] = np.frombuffer(batch.names, dtype=np.uint32)
+    records['start'] = np.frombuffer(batch.starts, dtype=np.float64)
+    records['end'] = np.frombuffer(batch.ends, dtype=np.float64)
+    return records
+
+
+def load_records(handler: AbstractDataHandler, start: dt.datetime,
+                 end: dt.datetime) -> Tuple[List[str], 'np.ndarray']:
+    """Load the records between start and end.
+
+    :return: the category names and a record array indexing into them
+    """
+    batch = handler.get_record_batch(start, end)
+    return batch.categories, to_array(batch)
+
+
+def get_per_category_durations(categories: List[str],
+                               records: 'np.ndarray') -> defaultdict:
+    """Sum the seconds per category like data_analysis does.
+
+    Categories appear in the order of their first record.
+    """
+    _require_numpy()
+    names = records['name']
+    seconds = np.bincount(names, weights=records['end'] - records['start'],
+                          minlength=len(categories))
+    _, first = np.unique(names, return_index=True)
+    durations = defaultdict(int)
+    for name in names[np.sort(first)].tolist():
+        durations[categories[name]] = float(seconds[name])
+    return durations
+
+
+def _wall_clock(timestamps: 'np.ndarray') -> 'np.ndarray':
+    """Shift epoch timestamps to local wall-clock seconds.
+
+    Subtracting these gives the same result as subtracting naive local
+    datetimes, including across daylight saving changes.
+    """
+    offsets = [time.localtime(t).tm_gmtoff if t == t else 0
+               for t in timestamps.tolist()]
+    return timestamps + np.array(offsets, dtype=np.float64)
+
+
+def _from_timestamp(timestamp: float) -> Optional[dt.datetime]:
+    if timestamp != timestamp:
+        return None
+    return dt.datetime.fromtimestamp(timestamp)
+
+
+class DayTable(NamedTuple):
+    """
+    The figures of consecutive days as arrays.
+
+    seconds is a day by category matrix and present marks the categories
+    that have records on a day. work_starts and work_ends are epoch
+    timestamps, NaN on days without records.
+    """
+    day_starts: List[dt.datetime]
+    categories: List[str]
+    seconds: 'np.ndarray'
+    present: 'np.ndarray'
+    work_starts: 'np.ndarray'
+    work_ends: 'np.ndarray'
+
+    @property
+    def time_totals(self) -> 'np.ndarray':
+        """Hours between work start and end, as Row.time_total."""
+        elapsed = (_wall_clock(self.work_ends)
+                   - _wall_clock(self.work_starts))
+        # timedelta.seconds: whole seconds, modulo a day
+        elapsed = np.floor(np.round(elapsed, 6)) % SECONDS_IN_A_DAY
+        return np.nan_to_num(elapsed) / 3600
+
+    @property
+    def time_working(self) -> 'np.ndarray':
+        """Hours spent on any category, as Row.time_working."""
+        return self.seconds.sum(axis=1) / 3600
+
+    @property
+    def efficiencies(self) -> 'np.ndarray':
+        """As Row.efficiency, with NaN where that is None."""
+        time_totals = self.time_totals
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(time_totals == 0, np.nan,
+                            self.time_working / time_totals / 0.75)
+
+    def get_day_durations(self, index: int) -> defaultdict:
+        durations = defaultdict(int)
+        for i in np.flatnonzero(self.present[index]).tolist():
+            durations[self.categories[i]] = float(self.seconds[index, i])
+        return durations
+
+    def get_summaries(self) -> List[DaySummary]:
+        return [DaySummary(day_start, _from_timestamp(work_start),
+                           _from_timestamp(work_end),
+                           dict(self.get_day_durations(i)))
+                for i, (day_start, work_start, work_end) in enumerate(
+                    zip(self.day_starts, self.work_starts.tolist(),
+                        self.work_ends.tolist()))]
+
+    def get_averages(self) -> Dict[str, Optional[float]]:
+        """The figures of table_generator.AverageRow.
+
+        :return: a dict of the average time_total, time_working and
+            efficiency, and of the average seconds per category that has
+            records on any of the days
+        """
+        efficiencies = self.efficiencies
+        efficiencies = efficiencies[~np.isnan(efficiencies)]
+        averages = {
+            'time_total': float(self.time_totals.mean()),
+            'time_working': float(self.time_working.mean()),
+            'efficiency': (float(efficiencies.mean())
+                           if len(efficiencies) else None)}
+        used = self.present.any(axis=0)
+        category_averages = self.seconds.mean(axis=0)
+        averages['categories'] = {
+            self.categories[i]: float(category_averages[i])
+            for i in np.flatnonzero(used).tolist()}
+        return averages
+
+
+def summarize_days(categories: List[str], records: 'np.ndarray',
+                   first_day_start: dt.datetime,
+                   num_days: int) -> DayTable:
+    """Aggregate records sorted by start time into consecutive days."""
+    _require_numpy()
+    one_day = dt.timedelta(days=1)
+    day_starts = [first_day_start + one_day * i for i in range(num_days + 1)]
+    boundaries = np.array([d.timestamp() for d in day_starts])
+    starts, ends = records['start'], records['end']
+
+    offsets = np.searchsorted(starts, boundaries, side='left')
+    counts = np.diff(offsets)
+    lo, hi = offsets[0], offsets[-1]
+    days = np.repeat(np.arange(num_days), counts)
+    cells = days * len(categories) + records['name'][lo:hi]
+    size = num_days * len(categories)
+    seconds = np.bincount(cells, weights=ends[lo:hi] - starts[lo:hi],
+                          minlength=size)
+    present = np.bincount(cells, minlength=size) > 0
+
+    occupied = counts > 0
+    work_starts = np.full(num_days, np.nan)
+    work_ends = np.full(num_days, np.nan)
+    work_starts[occupied] = starts[offsets[:-1][occupied]]
+    if hi > lo:
+        work_ends[occupied] = np.maximum.reduceat(
+            ends[lo:hi], offsets[:-1][occupied] - lo)
+    return DayTable(day_starts[:-1], list(categories),
+                    seconds.reshape(num_days, len(categories)),
+                    present.reshape(num_days, len(categories)),
+                    work_starts, work_ends)
+
+
+def get_day_table(handler: AbstractDataHandler, first_day_start: dt.datetime,
+                  num_days: int) -> DayTable:
+    """Load and aggregate num_days days beginning at first_day_start."""
+    window_end = first_day_start + dt.timedelta(days=num_days)
+    categories, records = load_records(handler, first_day_start, window_end)
+    return summarize_days(categories, records, first_day_start, num_days)
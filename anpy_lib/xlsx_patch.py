@@ -0,0 +1,455 @@
+"""Replace week sheets inside an existing xlsx file without loading it.
+
+An xlsx file is a zip archive of XML parts. Patching a sheet writes a new
+archive in which that sheet's part is regenerated, a few small parts
+(workbook.xml, its relationships, the content types and styles.xml) are
+edited when a sheet or number format is added, and every other part is
+copied through the zipfile API with its original compression. A sheet
+whose regenerated XML is the same as the stored one is not written at all.
+
+The XML of a sheet only depends on its rows and on the positions of the
+number formats in styles.xml, and formats that are missing are appended in
+the order the rows first use them, so exporting the same data twice gives
+the same bytes.
+"""
+import os
+import re
+import shutil
+import tempfile
+import zipfile
+import zlib
+from typing import Dict, List, Sequence, Tuple
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape, quoteattr
+
+from openpyxl.styles.numbers import BUILTIN_FORMATS_REVERSE
+from openpyxl.utils import get_column_letter
+from openpyxl.utils.datetime import CALENDAR_MAC_1904, \
+    CALENDAR_WINDOWS_1900, to_excel
+
+MAIN_NS = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+REL_NS = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+WORKSHEET_REL_TYPE = REL_NS + '/worksheet'
+WORKSHEET_CONTENT_TYPE = \
+    'application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml'
+
+WORKBOOK_PART = 'xl/workbook.xml'
+WORKBOOK_RELS_PART = 'xl/_rels/workbook.xml.rels'
+CONTENT_TYPES_PART = '[Content_Types].xml'
+STYLES_PART = 'xl/styles.xml'
+CALC_CHAIN_PART = 'xl/calcChain.xml'
+
+FIRST_CUSTOM_FORMAT_ID = 164
+"""Number format ids below this one are built into Excel"""
+
+ADDED_PART_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+"""Timestamp of parts added to an archive; replaced parts keep theirs"""
+
+
+class _Package:
+    """The parts of the archive that describe its sheets and styles."""
+
+    def __init__(self, archive: zipfile.ZipFile):
+        self.part_names = set(archive.namelist())
+        self.parts = {name: archive.read(name).decode('utf-8')
+                      for name in (WORKBOOK_PART, WORKBOOK_RELS_PART,
+                                   CONTENT_TYPES_PART, STYLES_PART)}
+        self.changed = set()
+
+        workbook = ElementTree.fromstring(self.parts[WORKBOOK_PART])
+        properties = workbook.find('{%s}workbookPr' % MAIN_NS)
+        date1904 = properties is not None and properties.get(
+            'date1904') in ('1', 'true')
+        self.epoch = CALENDAR_MAC_1904 if date1904 else CALENDAR_WINDOWS_1900
+
+        relationships = ElementTree.fromstring(
+            self.parts[WORKBOOK_RELS_PART])
+        targets = {r.get('Id'): _part_name(r.get('Target'))
+                   for r in relationships}
+        self.rel_ids = set(targets)
+        self.sheets = dict()
+        self.sheet_ids = [0]
+        for sheet in workbook.iter('{%s}sheet' % MAIN_NS):
+            rel_id = sheet.get('{%s}id' % REL_NS)
+            self.sheets[sheet.get('name')] = (
+                targets[rel_id], sheet.get('state', 'visible'), rel_id)
+            self.sheet_ids.append(int(sheet.get('sheetId')))
+        self.removed = set()
+
+        styles = ElementTree.fromstring(self.parts[STYLES_PART])
+        self.format_ids = dict(BUILTIN_FORMATS_REVERSE)
+        custom_ids = [FIRST_CUSTOM_FORMAT_ID - 1]
+        for number_format in styles.iter('{%s}numFmt' % MAIN_NS):
+            format_id = int(number_format.get('numFmtId'))
+            self.format_ids[number_format.get('formatCode')] = format_id
+            custom_ids.append(format_id)
+        self.next_format_id = max(custom_ids) + 1
+        cell_xfs = styles.find('{%s}cellXfs' % MAIN_NS)
+        self.num_xfs = len(cell_xfs)
+        self.xfs = dict()
+        for index, xf in enumerate(cell_xfs):
+            plain = all(xf.get(attribute, '0') == '0'
+                        for attribute in ('fontId', 'fillId', 'borderId'))
+            if plain:
+                self.xfs.setdefault(int(xf.get('numFmtId', '0')), index)
+
+    def get_style(self, number_format) -> int:
+        """Get the index of a plain cell style with the number format,
+        adding the format and the style if needed."""
+        if number_format is None:
+            return 0
+        if number_format not in self.format_ids:
+            self.format_ids[number_format] = self.next_format_id
+            self.next_format_id += 1
+            element = '<numFmt numFmtId="{}" formatCode={} />'.format(
+                self.format_ids[number_format], quoteattr(number_format))
+            styles = self.parts[STYLES_PART]
+            if '</numFmts>' in styles:
+                styles = _insert_before(styles, '</numFmts>', element)
+            else:
+                styles = re.sub(r'<numFmts\b[^>]*/>', '', styles)
+                styles = re.sub(r'(<styleSheet\b[^>]*>)',
+                                lambda m: m.group(1) + '<numFmts>' + element
+                                + '</numFmts>', styles, count=1)
+            self.parts[STYLES_PART] = _update_count(styles, 'numFmts')
+            self.changed.add(STYLES_PART)
+
+        format_id = self.format_ids[number_format]
+        if format_id not in self.xfs:
+            self.xfs[format_id] = self.num_xfs
+            self.num_xfs += 1
+            element = ('<xf numFmtId="{}" fontId="0" fillId="0" borderId="0" '
+                       'applyNumberFormat="1" xfId="0" />'.format(format_id))
+            styles = _insert_before(self.parts[STYLES_PART], '</cellXfs>',
+                                    element)
+            self.parts[STYLES_PART] = _update_count(styles, 'cellXfs')
+            self.changed.add(STYLES_PART)
+        return self.xfs[format_id]
+
+    def add_sheet(self, title, hidden) -> str:
+        """Add an empty sheet at the end and get the name of its part."""
+        number = 1
+        while 'xl/worksheets/sheet{}.xml'.format(number) in self.part_names:
+            number += 1
+        part = 'xl/worksheets/sheet{}.xml'.format(number)
+        self.part_names.add(part)
+        rel_number = len(self.rel_ids) + 1
+        while 'rId{}'.format(rel_number) in self.rel_ids:
+            rel_number += 1
+        rel_id = 'rId{}'.format(rel_number)
+        self.rel_ids.add(rel_id)
+        sheet_id = max(self.sheet_ids) + 1
+        self.sheet_ids.append(sheet_id)
+
+        self.parts[WORKBOOK_PART] = _insert_before(
+            self.parts[WORKBOOK_PART], '</sheets>',
+            '<sheet name={} sheetId="{}" state="{}" r:id="{}" />'.format(
+                quoteattr(title), sheet_id,
+                'hidden' if hidden else 'visible', rel_id))
+        self.parts[WORKBOOK_RELS_PART] = _insert_before(
+            self.parts[WORKBOOK_RELS_PART], '</Relationships>',
+            '<Relationship Type="{}" Target="/{}" Id="{}" />'.format(
+                WORKSHEET_REL_TYPE, part, rel_id))
+        self.parts[CONTENT_TYPES_PART] = _insert_before(
+            self.parts[CONTENT_TYPES_PART], '</Types>',
+            '<Override PartName="/{}" ContentType="{}" />'.format(
+                part, WORKSHEET_CONTENT_TYPE))
+        self.changed.update((WORKBOOK_PART, WORKBOOK_RELS_PART,
+                             CONTENT_TYPES_PART))
+        self.sheets[title] = (part, 'hidden' if hidden else 'visible',
+                              rel_id)
+        return part
+
+    def remove_sheet(self, title):
+        """Remove the sheet and drop its part.
+
+        Defined names and workbook views refer to sheets by position, so the
+        names local to the sheet are dropped, and the positions after it
+        are shifted down.
+        """
+        index = list(self.sheets).index(title)
+        part, _, rel_id = self.sheets.pop(title)
+        for name, pattern in (
+                (WORKBOOK_PART, r'<sheet\b[^>]*\br:id="{}"[^>]*/>'),
+                (WORKBOOK_RELS_PART,
+                 r'<Relationship\b[^>]*\bId="{}"[^>]*/>'),
+                (CONTENT_TYPES_PART,
+                 r'<Override\b[^>]*\bPartName="/{}"[^>]*/>')):
+            key = re.escape(part if name == CONTENT_TYPES_PART else rel_id)
+            self.parts[name] = re.sub(pattern.format(key), '',
+                                      self.parts[name], count=1)
+        self._shift_sheet_positions(index)
+        self.changed.update((WORKBOOK_PART, WORKBOOK_RELS_PART,
+                             CONTENT_TYPES_PART))
+        self.removed.add(part)
+        rels_part = '{0}/_rels/{1}.rels'.format(*part.rsplit('/', 1))
+        if rels_part in self.part_names:
+            self.removed.add(rels_part)
+
+    def _shift_sheet_positions(self, index):
+        """Update the references to sheet positions in workbook.xml after
+        the sheet at index was removed."""
+        def shift_name(match):
+            local = re.search(r'\blocalSheetId="(\d+)"', match.group(0))
+            if local is None or int(local.group(1)) < index:
+                return match.group(0)
+            if int(local.group(1)) == index:
+                return ''
+            return match.group(0).replace(
+                local.group(0),
+                'localSheetId="{}"'.format(int(local.group(1)) - 1), 1)
+
+        def shift_view(match):
+            element = match.group(0)
+            for attribute in ('activeTab', 'firstSheet'):
+                element = re.sub(
+                    r'\b{}="(\d+)"'.format(attribute),
+                    lambda m: '{}="{}"'.format(
+                        attribute, self._shifted_position(int(m.group(1)),
+                                                          index)),
+                    element)
+            return element
+
+        workbook = re.sub(r'<definedName\b[^>]*?(/>|>.*?</definedName>)',
+                          shift_name, self.parts[WORKBOOK_PART],
+                          flags=re.DOTALL)
+        workbook = re.sub(r'<definedNames\b[^>]*>\s*</definedNames>', '',
+                          workbook)
+        self.parts[WORKBOOK_PART] = re.sub(r'<workbookView\b[^>]*>',
+                                           shift_view, workbook)
+
+    def _shifted_position(self, position, index):
+        """Get the position of a tab once the sheet at index is removed,
+        moving off the removed sheet onto the nearest visible one."""
+        if position < index:
+            return position
+        if position > index:
+            return position - 1
+        states = [state for _, state, _ in self.sheets.values()]
+        position = min(position, len(states) - 1)
+        visible = [i for i, state in enumerate(states) if state == 'visible']
+        if not visible or position in visible:
+            return max(position, 0)
+        return min(visible, key=lambda i: (abs(i - position), i))
+
+    def invalidate_calculations(self):
+        """Make Excel recalculate the workbook when it is opened.
+
+        Sheets are written without cached formula values, and the
+        calculation chain may refer to cells that no longer exist, so it is
+        dropped; Excel rebuilds it.
+        """
+        workbook = self.parts[WORKBOOK_PART]
+        calc = re.search(r'<calcPr\b[^>]*?/?>', workbook)
+        if calc is None:
+            ends = [m.end() for m in re.finditer(
+                r'<definedNames\b[^>]*/>|</definedNames>|</sheets>',
+                workbook)]
+            workbook = (workbook[:ends[-1]]
+                        + '<calcPr calcId="124519" fullCalcOnLoad="1" />'
+                        + workbook[ends[-1]:])
+        elif 'fullCalcOnLoad="1"' not in calc.group(0):
+            element = re.sub(r'\s+fullCalcOnLoad="[^"]*"', '',
+                             calc.group(0))
+            element = element.replace('<calcPr', '<calcPr fullCalcOnLoad="1"',
+                                      1)
+            workbook = (workbook[:calc.start()] + element
+                        + workbook[calc.end():])
+        if workbook != self.parts[WORKBOOK_PART]:
+            self.parts[WORKBOOK_PART] = workbook
+            self.changed.add(WORKBOOK_PART)
+
+        if CALC_CHAIN_PART in self.part_names \
+                and CALC_CHAIN_PART not in self.removed:
+            self.parts[WORKBOOK_RELS_PART] = re.sub(
+                r'<Relationship\b[^>]*\bTarget="(/xl/)?calcChain.xml"[^>]*/>',
+                '', self.parts[WORKBOOK_RELS_PART])
+            self.parts[CONTENT_TYPES_PART] = re.sub(
+                r'<Override\b[^>]*\bPartName="/{}"[^>]*/>'.format(
+                    re.escape(CALC_CHAIN_PART)),
+                '', self.parts[CONTENT_TYPES_PART])
+            self.changed.update((WORKBOOK_RELS_PART, CONTENT_TYPES_PART))
+            self.removed.add(CALC_CHAIN_PART)
+
+    def set_state(self, title, hidden):
+        part, state, rel_id = self.sheets[title]
+        new_state = 'hidden' if hidden else 'visible'
+        if state == new_state:
+            return
+        pattern = re.compile(r'<sheet\b[^>]*\bname={}[^>]*>'.format(
+            re.escape(quoteattr(title))))
+        match = pattern.search(self.parts[WORKBOOK_PART])
+        element = re.sub(r'\s+state="[^"]*"', '', match.group(0))
+        element = element.replace('<sheet ', '<sheet state="{}" '.format(
+            new_state), 1)
+        workbook = self.parts[WORKBOOK_PART]
+        self.parts[WORKBOOK_PART] = (workbook[:match.start()] + element
+                                     + workbook[match.end():])
+        self.changed.add(WORKBOOK_PART)
+        self.sheets[title] = (part, new_state, rel_id)
+
+
+def _part_name(target):
+    return target[1:] if target.startswith('/') else 'xl/' + target
+
+
+def _insert_before(xml, closing_tag, element):
+    index = xml.rindex(closing_tag)
+    return xml[:index] + element + xml[index:]
+
+
+def _update_count(xml, tag):
+    """Set the count attribute of the tag to its number of children."""
+    start = xml.index('<' + tag)
+    end = xml.index('</' + tag + '>', start)
+    count = _count_children(xml[xml.index('>', start) + 1:end])
+    head = xml[start:xml.index('>', start)]
+    if 'count="' in head:
+        new_head = re.sub(r'count="\d+"', 'count="{}"'.format(count), head)
+    else:
+        new_head = head.rstrip(' /') + ' count="{}"'.format(count)
+    return xml[:start] + new_head + xml[start + len(head):]
+
+
+def _count_children(body):
+    depth = count = 0
+    for match in re.finditer(r'<(/?)[^>]*?(/?)>', body):
+        if match.group(1):
+            depth -= 1
+            continue
+        if depth == 0:
+            count += 1
+        if not match.group(2):
+            depth += 1
+    return count
+
+
+def sheet_xml(rows: Sequence[Sequence[Tuple[object, str]]],
+              get_style, epoch=CALENDAR_WINDOWS_1900) -> bytes:
+    """Generate the XML part of a sheet from rendered rows.
+
+    Rows are lists of (value, number format) pairs as rendered by
+    column_creation.SheetLayout. Strings are stored inline, so the shared
+    strings of the workbook are never touched.
+    """
+    parts = ['<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+             '<worksheet xmlns="{}"><sheetData>'.format(MAIN_NS)]
+    for row_num, row in enumerate(rows, 1):
+        parts.append('<row r="{}">'.format(row_num))
+        for col_num, (value, number_format) in enumerate(row, 1):
+            if value is None:
+                continue
+            reference = '{}{}'.format(get_column_letter(col_num), row_num)
+            style = get_style(number_format)
+            attributes = ' r="{}"'.format(reference)
+            if style:
+                attributes += ' s="{}"'.format(style)
+            if isinstance(value, str) and value.startswith('='):
+                parts.append('<c{}><f>{}</f></c>'.format(
+                    attributes, escape(value[1:])))
+            elif isinstance(value, str):
+                parts.append('<c{} t="inlineStr"><is><t>{}</t></is></c>'
+                             .format(attributes, escape(value)))
+            elif isinstance(value, bool):
+                parts.append('<c{} t="b"><v>{:d}</v></c>'.format(attributes,
+                                                                 value))
+            elif isinstance(value, (int, float)):
+                parts.append('<c{}><v>{!r}</v></c>'.format(attributes,
+                                                           value))
+            else:
+                parts.append('<c{}><v>{!r}</v></c>'.format(
+                    attributes, to_excel(value, epoch)))
+        parts.append('</row>')
+    parts.append('</sheetData></worksheet>')
+    return ''.join(parts).encode('utf-8')
+
+
+def _copy_member(source: zipfile.ZipFile, info: zipfile.ZipInfo,
+                 target: zipfile.ZipFile):
+    """Copy a member into the target archive, keeping its name, timestamp
+    and compression."""
+    member = zipfile.ZipInfo(info.filename, info.date_time)
+    member.compress_type = info.compress_type
+    member.comment = info.comment
+    member.create_system = info.create_system
+    member.external_attr = info.external_attr
+    with source.open(info) as stream, \
+            target.open(member, 'w',
+                        force_zip64=info.file_size > zipfile.ZIP64_LIMIT) \
+            as copied:
+        shutil.copyfileobj(stream, copied)
+
+
+def _write_member(archive: zipfile.ZipFile, part, data: bytes,
+                  date_time=ADDED_PART_DATE_TIME):
+    # A fixed timestamp keeps the archive the same for the same data
+    info = zipfile.ZipInfo(part, date_time)
+    info.compress_type = zipfile.ZIP_DEFLATED
+    archive.writestr(info, data)
+
+
+def _is_stored(archive: zipfile.ZipFile, part, data: bytes):
+    """Check whether the part holds exactly the given bytes."""
+    try:
+        info = archive.getinfo(part)
+    except KeyError:
+        return False
+    if info.file_size != len(data) or info.CRC != zlib.crc32(data):
+        return False
+    return archive.read(part) == data
+
+
+def patch_sheets(path, sheets: List[Tuple[str, list, bool]],
+                 remove: Sequence[str] = ()) -> bool:
+    """Replace or add the sheets in the xlsx file at path.
+
+    :param sheets: (title, rows, hidden) tuples, as rendered by
+        data_entry.render_week_sheets
+    :param remove: titles of sheets to remove if they exist
+    :return: whether the file had to be written
+    """
+    with zipfile.ZipFile(path) as archive:
+        package = _Package(archive)
+        for title in remove:
+            if title in package.sheets:
+                package.remove_sheet(title)
+        new_parts: Dict[str, bytes] = dict()
+        for title, rows, hidden in sheets:
+            data = sheet_xml(rows, package.get_style, package.epoch)
+            if title in package.sheets:
+                part = package.sheets[title][0]
+                package.set_state(title, hidden)
+                if _is_stored(archive, part, data):
+                    continue
+            else:
+                part = package.add_sheet(title, hidden)
+            new_parts[part] = data
+        if not (new_parts or package.changed or package.removed):
+            return False
+        package.invalidate_calculations()
+        for part in package.changed:
+            new_parts[part] = package.parts[part].encode('utf-8')
+
+        directory = os.path.dirname(os.path.abspath(path))
+        with tempfile.NamedTemporaryFile(dir=directory, suffix='.xlsx',
+                                         delete=False) as temp:
+            try:
+                with zipfile.ZipFile(temp, 'w', zipfile.ZIP_DEFLATED) \
+                        as patched:
+                    for info in archive.infolist():
+                        if info.filename in package.removed:
+                            continue
+                        elif info.filename in new_parts:
+                            _write_member(patched, info.filename,
+                                          new_parts.pop(info.filename),
+                                          info.date_time)
+                        else:
+                            _copy_member(archive, info, patched)
+                    for part, data in sorted(new_parts.items()):
+                        _write_member(patched, part, data)
+            except BaseException:
+                os.remove(temp.name)
+                raise
+    shutil.copymode(path, temp.name)
+    os.replace(temp.name, path)
+    return True
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+import argparse
+import contextlib
+import datetime as dt
+import io
+import signal
+import sqlite3
+from typing import List
+
+import cli
+from anpy import AbstractDataHandler, get_bucket
+from anpy_lib import daemon
+from anpy_lib import file_management
+from anpy_lib.data_handling import SQLDataHandler
+
+CACHED_COMMANDS = daemon.READ_ONLY_COMMANDS
+"""Commands whose output is kept until the data changes"""
+
+
+class AnpyDaemon:
+    """Runs CLI commands against a single long-lived data handler.
+
+    The handler's category cache stays warm between commands, and the output
+    of the status command is computed ahead of time and reused for as long as
+    the data and the current day stay the same.
+    """
+
+    def __init__(self, handler: AbstractDataHandler):
+        self.handler = handler
+        self.parser = cli.make_parser()
+        self._outputs = dict()
+
+    def respond(self, argv: List[str]) -> str:
+        # argparse prints usage, help and errors itself and then exits, so
+        # catch what it prints and send it to the client instead.
+        output = io.StringIO()
+        errors = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(output), \
+                    contextlib.redirect_stderr(errors):
+                args = self.parser.parse_args(argv)
+        except SystemExit as e:
+            if not e.code:
+                return output.getvalue()
+            lines = errors.getvalue().strip().splitlines()
+            raise ValueError(lines[-1] if lines
+                             else 'Invalid arguments: {}'.format(argv))
+
+        key = None
+        if args.command in CACHED_COMMANDS:
+            key = self._cache_key(argv)
+            if key in self._outputs:
+                return self._outputs[key]
+
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            args.func(args, self.handler)
+        if key is not None:
+            self._outputs = {key: output.getvalue()}
+        return output.getvalue()
+
+    def precompute(self):
+        """Compute the status output if the cached one is stale."""
+        if self._cache_key(['status']) not in self._outputs:
+            try:
+                self.respond(['status'])
+            except Exception:
+                # The error is reported when status is actually requested.
+                pass
+
+    def _cache_key(self, argv: List[str]):
+        return (tuple(argv), self.handler.data_version,
+                get_bucket(dt.datetime.now(), 'day'))
+
+
+def serve(socket_path: str, database_path: str):
+    handler = SQLDataHandler(sqlite3.Connection(database_path))
+    anpy_daemon = AnpyDaemon(handler)
+    server = daemon.DaemonServer(socket_path, anpy_daemon.respond,
+                                 anpy_daemon.precompute)
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        handler.db.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Keeps the AnPy database open and serves the start, end, '
+                    'cancel and status commands of cli.py over a Unix '
+                    'socket.')
+    parser.add_argument('--socket', default=file_management.SOCKET_PATH,
+                        help='Path of the Unix socket to listen on.')
+    parser.add_argument('--database', default=file_management.DATABASE_PATH,
+                        help='Path of the SQLite database.')
+    args = parser.parse_args()
+
+    file_management.create_anpy_dir_if_not_exist()
+    serve(args.socket, args.database)
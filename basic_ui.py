@@ -35,8 +35,9 @@ def create_categories(handler: AbstractDataHandler):
         if input_str == 'quit':
             return
         elif input_str:
-            for category in input_str.split(','):
-                handler.new_category(category)
+            with handler.batch():
+                for category in input_str.split(','):
+                    handler.new_category(category)
             print('Categories created.')
             return
 
@@ -106,7 +107,8 @@ def active_session(handler: AbstractDataHandler, path):
 def options(handler: AbstractDataHandler, path):
     print()
     action = prompt_menu(['Add Categories', 'Rename Category',
-                          'Archive Categories', 'Change Export Path'])
+                          'Archive Categories', 'Change Export Path',
+                          'Change Export Layout'])
     if action == 0:
         create_categories(handler)
     elif action == 1:
@@ -115,6 +117,8 @@ def options(handler: AbstractDataHandler, path):
         print('Action not available yet.')
     elif action == 3:
         create_config(path)
+    elif action == 4:
+        set_layout(file_management.CONFIG_PATH)
 
 
 def not_active_session(handler: AbstractDataHandler, path):
@@ -131,11 +135,9 @@ def not_active_session(handler: AbstractDataHandler, path):
             print('Session for {} started'.format(
                 handler.active_categories[sub_action]))
     elif action == 1:
-        wb = data_entry.load_excel_workbook(path)
-        ws, date = data_entry.get_relevant_worksheet(wb, None)
-        data_entry.enter_week_data(date, handler, ws)
-        wb.save(path)
-        print('Exported.\n')
+        layout = get_layout(file_management.CONFIG_PATH)
+        export_path = data_entry.export_week(handler, path, layout)
+        print('Exported to {}.\n'.format(export_path))
     elif action == 2:
         options(handler, path)
     elif action == 3:
@@ -145,6 +147,7 @@ def not_active_session(handler: AbstractDataHandler, path):
 
 def create_config(path):
     config = configparser.ConfigParser()
+    config.read(path)
     excel_path = get_input(message='Please enter path to write Excel file',
                            key=clean_excel_file)
     config['Paths'] = {'LogFile': excel_path}
@@ -152,6 +155,25 @@ def create_config(path):
         config.write(config_file)
 
 
+def get_layout(path):
+    config = configparser.ConfigParser()
+    config.read(path)
+    layout = config.get('Export', 'Layout', fallback='single')
+    return layout if layout in data_entry.LAYOUTS else 'single'
+
+
+def set_layout(path):
+    action = prompt_menu(['Every week in the log file',
+                          'One file per week',
+                          'One file per month'],
+                         'Please select where exported weeks are written.')
+    config = configparser.ConfigParser()
+    config.read(path)
+    config['Export'] = {'Layout': data_entry.LAYOUTS[action]}
+    with open(path, 'w') as config_file:
+        config.write(config_file)
+
+
 def clean_excel_file(excel_path):
     if os.path.isdir(excel_path):
         excel_path = os.path.join(excel_path, 'log.xlsx')
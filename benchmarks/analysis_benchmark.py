@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""Compare the Python and NumPy analysis of a large window of sessions.
+
+Run from the repository root:
+
+    python -m benchmarks.analysis_benchmark --sessions 1000000
+"""
+import argparse
+import datetime as dt
+import random
+import time
+from array import array
+
+from anpy import RecordBatch, partition_into_days
+from anpy_lib import vectorized
+from anpy_lib.data_analysis import get_per_category_durations
+from anpy_lib.table_generator import AverageRow, Row
+
+CATEGORIES = ['work', 'reading', 'exercise', 'email', 'meetings', 'study']
+
+
+def make_batch(sessions, first_day_start, seed=0):
+    """Sessions of 5 to 60 minutes with gaps of up to an hour."""
+    rng = random.Random(seed)
+    names, starts, ends = array('I'), array('d'), array('d')
+    timestamp = first_day_start.timestamp()
+    for _ in range(sessions):
+        duration = rng.randint(5, 60) * 60
+        names.append(rng.randrange(len(CATEGORIES)))
+        starts.append(timestamp)
+        ends.append(timestamp + duration)
+        timestamp += duration + rng.randint(0, 60) * 60
+    return RecordBatch(list(CATEGORIES), names, starts, ends)
+
+
+def analyse_rows(days):
+    rows = [Row.from_day(day) for day in days]
+    average_row = AverageRow(rows)
+    figures = [(row.time_total, row.time_working, row.efficiency)
+               for row in rows]
+    return figures, (average_row.average_time_total,
+                     average_row.average_time_working,
+                     average_row.average_efficiency,
+                     average_row.average_data)
+
+
+def time_it(label, function, sessions):
+    begin = time.perf_counter()
+    result = function()
+    elapsed = time.perf_counter() - begin
+    print('{:<36} {:8.3f} s {:12.0f} sessions/s'
+          .format(label, elapsed, sessions / elapsed))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sessions', type=int, default=1000000)
+    args = parser.parse_args()
+
+    first_day_start = dt.datetime(2000, 1, 1, 6, 0)
+    batch = make_batch(args.sessions, first_day_start)
+    last_end = dt.datetime.fromtimestamp(batch.ends[-1])
+    num_days = (last_end - first_day_start).days + 1
+    print('{} sessions over {} days'.format(len(batch), num_days))
+    records = time_it('decode records', lambda: list(batch), len(batch))
+
+    time_it('durations: record loop',
+            lambda: get_per_category_durations(records), len(batch))
+    time_it('durations: record batch',
+            lambda: get_per_category_durations(batch), len(batch))
+    time_it('durations: numpy',
+            lambda: vectorized.get_per_category_durations(
+                batch.categories, vectorized.to_array(batch)), len(batch))
+
+    time_it('daily rows: records',
+            lambda: analyse_rows(
+                partition_into_days(records, first_day_start, num_days)),
+            len(batch))
+    time_it('daily rows: record batch',
+            lambda: analyse_rows(
+                partition_into_days(batch, first_day_start, num_days)),
+            len(batch))
+
+    def vectorized_rows():
+        table = vectorized.summarize_days(
+            batch.categories, vectorized.to_array(batch), first_day_start,
+            num_days)
+        return (table.time_totals, table.time_working, table.efficiencies,
+                table.get_averages())
+
+    time_it('daily rows: numpy', vectorized_rows, len(batch))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+"""Measure concurrent reports against the asyncio data handler.
+
+Run from the repository root:
+
+    python -m benchmarks.async_benchmark --clients 300
+"""
+import argparse
+import asyncio
+import datetime as dt
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+
+from anpy_lib.async_handling import AsyncDataHandler
+from anpy_lib.data_handling import SQLDataHandler
+from benchmarks.analysis_benchmark import CATEGORIES, make_batch
+
+
+async def read(handler, rng, reports, latencies, first, last):
+    """Request reports of random windows within the recorded span."""
+    span = (last - first).days
+    for _ in range(reports):
+        reference = first + dt.timedelta(days=rng.randrange(30, span),
+                                         hours=rng.randrange(24))
+        num_days = rng.choice((7, 14, 30))
+        bucket = rng.choice(('day', 'day', 'week'))
+        begin = time.perf_counter()
+        await handler.report(num_days, bucket, reference)
+        latencies.append(time.perf_counter() - begin)
+
+
+async def write(handler, start, stop):
+    """Start and complete sessions until stop is set."""
+    sessions = 0
+    while not stop.is_set():
+        await handler.start(CATEGORIES[sessions % len(CATEGORIES)], start)
+        await handler.complete(start + dt.timedelta(minutes=10))
+        start += dt.timedelta(minutes=15)
+        sessions += 1
+    return sessions
+
+
+async def run(path, readers, clients, reports, first, last):
+    rng = random.Random(readers)
+    latencies = []
+    async with AsyncDataHandler(path, readers=readers) as handler:
+        stop = asyncio.Event()
+        writer = asyncio.ensure_future(
+            write(handler, last + dt.timedelta(days=1), stop))
+        begin = time.perf_counter()
+        await asyncio.gather(*(
+            read(handler, random.Random(rng.random()), reports, latencies,
+                 first, last)
+            for _ in range(clients)))
+        elapsed = time.perf_counter() - begin
+        stop.set()
+        sessions = await writer
+    latencies.sort()
+    print('{:3d} readers {:8.0f} reports/s  p50 {:7.1f} ms  p99 {:7.1f} ms  '
+          '{:6.0f} sessions written/s'
+          .format(readers, len(latencies) / elapsed,
+                  1000 * statistics.median(latencies),
+                  1000 * latencies[int(0.99 * len(latencies))],
+                  sessions / elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sessions', type=int, default=100000)
+    parser.add_argument('--clients', type=int, default=300,
+                        help='Number of coroutines requesting reports at '
+                             'the same time.')
+    parser.add_argument('--reports', type=int, default=10,
+                        help='Number of reports each client requests.')
+    parser.add_argument('--readers', type=int, nargs='+', default=[1, 4, 8])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'anpy.db')
+        handler = SQLDataHandler(sqlite3.Connection(path))
+        for category in CATEGORIES:
+            handler.new_category(category)
+        handler.import_records(make_batch(args.sessions,
+                                          dt.datetime(2000, 1, 1, 6, 0)))
+        first, last = handler.get_record_span()
+        handler.db.close()
+        print('{} sessions over {} days, {} clients x {} reports'
+              .format(args.sessions, (last - first).days, args.clients,
+                      args.reports))
+        for readers in args.readers:
+            asyncio.run(run(path, readers, args.clients, args.reports,
+                            first, last))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""Measure the throughput and memory of the streaming data export.
+
+Run from the repository root:
+
+    python -m benchmarks.export_benchmark --sessions 1000000
+"""
+import argparse
+import datetime as dt
+import os
+import sqlite3
+import tempfile
+import time
+import tracemalloc
+
+from anpy_lib import data_export
+from anpy_lib.data_handling import SQLDataHandler
+from anpy_lib.memory_handling import MemoryDataHandler
+from benchmarks.analysis_benchmark import CATEGORIES, make_batch
+
+
+def open_file(path, file_format):
+    if file_format == 'parquet':
+        return path
+    return open(path, 'w', newline='')
+
+
+def run(handler, path, file_format, table, chunk_size):
+    start, end = data_export.get_day_range(*handler.get_record_span())
+    file = open_file(path, file_format)
+    try:
+        return data_export.export_table(handler, file, file_format, table,
+                                        start, end, chunk_size)
+    finally:
+        if file is not path:
+            file.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sessions', type=int, default=1000000)
+    parser.add_argument('--chunk-size', type=int,
+                        default=data_export.DEFAULT_CHUNK_SIZE)
+    parser.add_argument('--backend', choices=('sqlite', 'memory'),
+                        default='sqlite',
+                        help='Export from a SQLDataHandler (default) or '
+                             'from a MemoryDataHandler.')
+    parser.add_argument('--memory', action='store_true',
+                        help='Also report the peak memory allocated while '
+                             'exporting, which slows the export down.')
+    args = parser.parse_args()
+
+    formats = [f for f in data_export.FORMATS if f != 'parquet']
+    try:
+        import pyarrow  # noqa: F401
+        formats.append('parquet')
+    except ImportError:
+        print('pyarrow is not installed; skipping parquet')
+
+    with tempfile.TemporaryDirectory() as directory:
+        if args.backend == 'memory':
+            handler = MemoryDataHandler()
+        else:
+            handler = SQLDataHandler(
+                sqlite3.Connection(os.path.join(directory, 'anpy.db')))
+        for category in CATEGORIES:
+            handler.new_category(category)
+        batch = make_batch(args.sessions, dt.datetime(2000, 1, 1, 6, 0))
+        begin = time.perf_counter()
+        handler.import_records(batch)
+        print('imported {} sessions in {:.2f} s'
+              .format(len(batch), time.perf_counter() - begin))
+        del batch
+
+        for table in data_export.TABLES:
+            for file_format in formats:
+                path = os.path.join(directory, table + '.' + file_format)
+                begin = time.perf_counter()
+                count = run(handler, path, file_format, table,
+                            args.chunk_size)
+                elapsed = time.perf_counter() - begin
+                line = '{:<8} {:<8} {:9d} rows {:8.3f} s {:10.0f} rows/s ' \
+                       '{:8.1f} MB'.format(table, file_format, count,
+                                           elapsed, count / elapsed,
+                                           os.path.getsize(path) / 1e6)
+                if args.memory:
+                    tracemalloc.start()
+                    run(handler, path, file_format, table, args.chunk_size)
+                    peak = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+                    line += ' peak {:6.1f} MB'.format(peak / 1e6)
+                print(line)
+        if args.backend == 'sqlite':
+            handler.db.close()
+
+
+if __name__ == '__main__':
+    main()
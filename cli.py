@@ -1,32 +1,42 @@
 import argparse
-import sqlite3
-
-from tabulate import tabulate
+import datetime as dt
+import io
+import sys
+import time
 
+from anpy import BUCKETS, DEFAULT_DAY_START_TIME, get_bucket
+from anpy_lib import daemon
+from anpy_lib import data_analysis
+from anpy_lib import data_export
+from anpy_lib import data_import
 from anpy_lib import file_management
-from anpy_lib import table_generator
-from anpy_lib.data_handling import SQLDataHandler
+
+# SQLite, tabulate and the reporting modules are imported where they are
+# used, so that quick commands such as start and end do not pay for loading
+# them, and not at all when the daemon serves the command.
 
 
 def set_up():
+    import sqlite3
+    from anpy_lib.data_handling import SQLDataHandler
+
     file_management.create_anpy_dir_if_not_exist()
     handler = SQLDataHandler(sqlite3.Connection(file_management.DATABASE_PATH))
     return handler
 
 
-def create_categories(args):
-    handler = set_up()
+def create_categories(args, handler):
     print('Creating...')
-    for category in args.categories:
-        try:
-            handler.new_category(category)
-        except ValueError:
-            print('{} is invalid... skipping.'.format(category))
+    with handler.batch():
+        for category in args.categories:
+            try:
+                handler.new_category(category)
+            except (ValueError, RuntimeError):
+                print('{} is invalid... skipping.'.format(category))
 
 
-def start(args):
+def start(args, handler):
     requested_category = args.category
-    handler = set_up()
 
     if handler.is_active_session():
         print('An active session is running!')
@@ -58,38 +68,213 @@ def start(args):
             return
         category = potential_matches[0]
     assert category
-    handler.start(category)
+    try:
+        handler.start(category)
+    except RuntimeError:
+        # Another invocation started a session since the check above.
+        print('An active session is running!')
 
 
-def end(_):
-    handler = set_up()
-    if handler.is_active_session():
+def end(args, handler):
+    try:
         handler.complete()
-    else:
+    except RuntimeError:
         print("There's no session running!")
 
 
-def cancel(_):
-    handler = set_up()
+def cancel(args, handler):
     if handler.is_active_session():
         handler.cancel()
     else:
         print('Cannot cancel: No active session.')
 
 
-def status(_):
-    handler = set_up()
+def status(args, handler):
+    from anpy_lib import table_generator
     table, headers = table_generator.create_table_iterable_and_headers(
-        data_handler=handler)
-    print(tabulate(table, headers=headers))
+        data_handler=handler, num_days=args.window, bucket=args.group_by)
+    if args.plain:
+        table_generator.render_plain(table, headers)
+    else:
+        from tabulate import tabulate
+        print(tabulate(table, headers=headers))
     print()
     print('Active categories: {}'.format(', '.join(handler.active_categories)))
 
 
-if __name__ == '__main__':
+def rebuild(args, handler):
+    handler.rebuild_daily_totals()
+    print('Rebuilt daily totals.')
+
+
+def import_records(args, handler):
+    file_format = args.format or data_import.guess_format(args.file)
+    try:
+        if file_format == 'xlsx':
+            # Workbooks are zip files, which need a seekable stream.
+            stream = io.BytesIO(sys.stdin.buffer.read()) \
+                if args.file == '-' else open(args.file, 'rb')
+        else:
+            stream = sys.stdin if args.file == '-' \
+                else open(args.file, newline='')
+    except OSError as e:
+        print('Import failed: {}'.format(e))
+        return
+    begin = time.perf_counter()
+    try:
+        if file_format == 'xlsx':
+            count = data_import.import_workbook(
+                handler, stream, create_categories=args.create)
+        else:
+            count = handler.import_records(
+                data_import.read_records(stream, file_format),
+                create_categories=args.create)
+    except (ValueError, KeyError) as e:
+        print('Import failed: {}'.format(e))
+        return
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+    elapsed = time.perf_counter() - begin
+    print('Imported {} records in {:.2f} s ({:.0f} records/s).'
+          .format(count, elapsed, count / elapsed if elapsed else 0))
+
+
+def export(args, handler):
+    file_format = args.format
+    if file_format is None and args.output:
+        file_format = data_export.guess_format(args.output)
+    if file_format in data_export.FORMATS:
+        export_data(args, handler, file_format)
+        return
+
+    from anpy_lib import column_creation, data_entry
+
+    config = file_management.read_config()
+    path = args.output or config.get('Paths', 'LogFile',
+                                     fallback=file_management.DEFAULT_LOG_PATH)
+    layout = args.layout or config.get('Export', 'Layout', fallback='single')
+
+    begin = time.perf_counter()
+    if not (args.all or args.since or args.until):
+        if args.rebuild:
+            print('--rebuild needs --all, --since or --until.')
+            return
+        path = data_entry.export_week(handler, path, layout,
+                                      mode=args.cells)
+        print('Exported the current week to {} in {:.2f} s.'
+              .format(path, time.perf_counter() - begin))
+        return
+
+    if args.all:
+        span = handler.get_record_span()
+        if span is None:
+            print('There are no records to export.')
+            return
+        since, until = span
+    else:
+        since = args.since or dt.datetime.now()
+        until = args.until or dt.datetime.now()
+    first = data_entry.get_most_recent_monday(since)
+    last = data_entry.get_most_recent_monday(until)
+    if last < first:
+        print('--since must not be after --until.')
+        return
+    first = data_entry.get_period_mondays(layout, first)[0]
+
+    num_weeks = (last - first).days // 7 + 1
+    if args.jobs > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(args.jobs) as executor:
+            data_entry.export_weeks(handler, path, first, num_weeks, layout,
+                                    args.rebuild, executor, args.cells)
+    else:
+        data_entry.export_weeks(handler, path, first, num_weeks, layout,
+                                rebuild=args.rebuild, mode=args.cells)
+    elapsed = time.perf_counter() - begin
+    rows = num_weeks * (column_creation.NUM_BODY_ITEMS + 2)
+    print('Exported {} weeks ({} rows) in {:.2f} s ({:.0f} rows/s).'
+          .format(num_weeks, rows, elapsed, rows / elapsed if elapsed else 0))
+
+
+def export_data(args, handler, file_format):
+    sheet_options = [option for option, given in (
+        ('--layout', args.layout), ('--cells', args.cells != 'formulas'),
+        ('--jobs', args.jobs != 1), ('--rebuild', args.rebuild)) if given]
+    if sheet_options:
+        print('{} only apply to xlsx exports.'
+              .format(', '.join(sheet_options)))
+        return
+    if args.all:
+        span = handler.get_record_span()
+        if span is None:
+            print('There are no records to export.')
+            return
+        since, until = span
+    elif args.since or args.until:
+        since = args.since or dt.datetime.now()
+        until = args.until or dt.datetime.now()
+    else:
+        until = dt.datetime.now()
+        since = dt.datetime.combine(get_bucket(until, 'week'),
+                                    DEFAULT_DAY_START_TIME)
+    start, end = data_export.get_day_range(since, until)
+    if end <= start:
+        print('--since must not be after --until.')
+        return
+
+    to_stdout = args.output in (None, '-')
+    if to_stdout and file_format == 'parquet':
+        print('Parquet files need an output path (-o).')
+        return
+    if to_stdout:
+        stream = sys.stdout
+    elif file_format == 'parquet':
+        stream = args.output
+    else:
+        try:
+            stream = open(args.output, 'w', newline='')
+        except OSError as e:
+            print('Export failed: {}'.format(e))
+            return
+
+    begin = time.perf_counter()
+    try:
+        count = data_export.export_table(handler, stream, file_format,
+                                         args.table, start, end)
+    except (RuntimeError, OSError) as e:
+        print('Export failed: {}'.format(e))
+        return
+    finally:
+        if not to_stdout and file_format != 'parquet':
+            stream.close()
+    elapsed = time.perf_counter() - begin
+    # Keep standard output clean when the rows are written to it.
+    print('Exported {} rows of {} in {:.2f} s ({:.0f} rows/s).'
+          .format(count, args.table, elapsed,
+                  count / elapsed if elapsed else 0),
+          file=sys.stderr if to_stdout else sys.stdout)
+
+
+def date(text):
+    try:
+        return dt.datetime.combine(dt.date.fromisoformat(text),
+                                   dt.time(12, 0))
+    except ValueError:
+        raise argparse.ArgumentTypeError('Invalid date: {}'.format(text))
+
+
+def window(text):
+    try:
+        return data_analysis.parse_window(text)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def make_parser():
     parser = argparse.ArgumentParser()
 
-    subparsers = parser.add_subparsers()
+    subparsers = parser.add_subparsers(dest='command')
     create_parser = subparsers.add_parser('create',
                                           help='Create new categories')
     create_parser.add_argument('categories', metavar='C', nargs='+',
@@ -115,9 +300,22 @@ if __name__ == '__main__':
 
     status_subparser = subparsers.add_parser('status',
                                              help='Displays the progress of '
-                                                  'the previous 7 days and '
-                                                  'displays the active '
-                                                  'categories.')
+                                                  'the last days, 7 unless '
+                                                  '--window is given, and '
+                                                  'the active categories.')
+    status_subparser.add_argument('-w', '--window', default='7d',
+                                  type=window,
+                                  help='Number of days to report, ending '
+                                       'with today, such as 30d, 12w or 1y. '
+                                       'Defaults to 7d.')
+    status_subparser.add_argument('-g', '--group-by', default='day',
+                                  choices=BUCKETS,
+                                  help='Show one row per day (default), '
+                                       'week or month of the window.')
+    status_subparser.add_argument('-p', '--plain', action='store_true',
+                                  help='Print rows as they are computed '
+                                       'instead of aligning the whole table '
+                                       'with tabulate.')
     status_subparser.set_defaults(func=status)
 
     end_subparser = subparsers.add_parser('end', help='Completes the current '
@@ -129,8 +327,128 @@ if __name__ == '__main__':
                                                   'tracking session.')
     cancel_subparser.set_defaults(func=cancel)
 
+    import_subparser = subparsers.add_parser('import',
+                                             help='Imports completed '
+                                                  'sessions from a CSV or '
+                                                  'JSONL file, or the week '
+                                                  'sheets of an Excel log '
+                                                  'file.',
+                                             epilog='Excel log files are '
+                                                    'imported in one '
+                                                    'transaction. Each day '
+                                                    'gets one session per '
+                                                    'category, and days that '
+                                                    'already have sessions '
+                                                    'are skipped.')
+    import_subparser.add_argument('file', nargs='?', default='-',
+                                  help='File to import. Reads standard input '
+                                       'if omitted or "-".')
+    import_subparser.add_argument('-f', '--format',
+                                  choices=data_import.FORMATS,
+                                  help='Format of the file. Guessed from the '
+                                       'file extension if not given, '
+                                       'defaulting to csv.')
+    import_subparser.add_argument('-c', '--create', action='store_true',
+                                  help='If flag is set, create categories '
+                                       'that do not exist yet instead of '
+                                       'failing.')
+    import_subparser.set_defaults(func=import_records)
+
+    rebuild_subparser = subparsers.add_parser('rebuild',
+                                              help='Recreates the daily '
+                                                   'totals used by reports '
+                                                   'from the recorded '
+                                                   'sessions.')
+    rebuild_subparser.set_defaults(func=rebuild)
+
+    export_subparser = subparsers.add_parser('export',
+                                             help='Exports weeks to the '
+                                                  'Excel log file, or '
+                                                  'records or daily totals '
+                                                  'to CSV, JSONL or Parquet. '
+                                                  'Only the current week is '
+                                                  'exported unless a range '
+                                                  'is given.')
+    export_subparser.add_argument('-a', '--all', action='store_true',
+                                  help='Export every week that has records.')
+    export_subparser.add_argument('--since', type=date,
+                                  help='Export the weeks from the one '
+                                       'containing this date (YYYY-MM-DD).')
+    export_subparser.add_argument('--until', type=date,
+                                  help='Export the weeks up to the one '
+                                       'containing this date (YYYY-MM-DD). '
+                                       'Defaults to today.')
+    export_subparser.add_argument('--rebuild', action='store_true',
+                                  help='With a range, write the single '
+                                       'log file from scratch with only the '
+                                       'exported weeks, deleting its other '
+                                       'sheets. By default the week sheets '
+                                       'are replaced and other sheets are '
+                                       'kept.')
+    export_subparser.add_argument('-f', '--format',
+                                  choices=('xlsx',) + data_export.FORMATS,
+                                  help='Write week sheets to the Excel log '
+                                       '(xlsx), or stream rows to a CSV, '
+                                       'JSONL or Parquet file. Guessed from '
+                                       'the output file extension if not '
+                                       'given, defaulting to xlsx. Parquet '
+                                       'needs pyarrow. --layout, --cells, '
+                                       '--jobs and --rebuild only apply to '
+                                       'xlsx.')
+    export_subparser.add_argument('-t', '--table', default='records',
+                                  choices=data_export.TABLES,
+                                  help='For csv, jsonl and parquet: export '
+                                       'every record (default) or the '
+                                       'seconds per day and category.')
+    export_subparser.add_argument('-l', '--layout',
+                                  choices=file_management.EXPORT_LAYOUTS,
+                                  help='Write every week to the log file '
+                                       '(single), or one file per week or '
+                                       'month. Defaults to the configured '
+                                       'layout.')
+    export_subparser.add_argument('-o', '--output',
+                                  help='Path of the log file. Defaults to '
+                                       'the configured one.')
+    export_subparser.add_argument('-c', '--cells', default='formulas',
+                                  choices=('formulas', 'values', 'both'),
+                                  help='Write formulas in derived cells '
+                                       '(default), the values they compute, '
+                                       'or values with the formulas on a '
+                                       'hidden sheet.')
+    export_subparser.add_argument('-j', '--jobs', type=int, default=1,
+                                  help='Number of processes rendering week '
+                                       'sheets when exporting a range.')
+    export_subparser.set_defaults(func=export)
+
     parser.add_argument('-i', '--interactive', action='store_true')
     # TODO: implement interactive
+    parser.add_argument('--no-daemon', action='store_true',
+                        help='Access the database directly even if the '
+                             'anpyd daemon is running.')
+    return parser
+
 
-    args = parser.parse_args()
-    args.func(args)
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    parser = make_parser()
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        return
+
+    if args.command in daemon.COMMANDS and not args.no_daemon:
+        try:
+            output = daemon.request(
+                argv, file_management.SOCKET_PATH,
+                read_only=args.command in daemon.READ_ONLY_COMMANDS)
+        except RuntimeError as e:
+            sys.exit(str(e))
+        if output is not None:
+            print(output, end='')
+            return
+    args.func(args, set_up())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+import asyncio
+import datetime as dt
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from anpy import Record
+from anpy_lib import table_generator
+from anpy_lib.async_handling import AsyncDataHandler
+from anpy_lib.data_handling import SQLDataHandler
+
+
+class AsyncHandlerTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'anpy.db')
+        self.handler = AsyncDataHandler(self.path, readers=3)
+
+    async def asyncTearDown(self):
+        await self.handler.close()
+        self.directory.cleanup()
+
+    async def test_sessions(self):
+        handler = self.handler
+        await handler.new_category('a')
+        self.assertEqual(await handler.get_active_categories(), ('a',))
+        start = dt.datetime(2010, 4, 5, 9, 0)
+        with self.assertRaises(ValueError):
+            await handler.start('b', start)
+        await handler.start('a', start)
+        self.assertTrue(await handler.is_active_session())
+        with self.assertRaises(RuntimeError):
+            await handler.start('a', start)
+        await handler.complete(start + dt.timedelta(hours=2))
+        await handler.start('a', start + dt.timedelta(hours=3))
+        await handler.cancel()
+        self.assertIsNone(await handler.get_most_recent_session())
+
+        await handler.rename_category('a', 'c')
+        self.assertEqual(await handler.get_all_categories(), ('c',))
+        self.assertEqual(
+            await handler.get_records_between(start,
+                                              start + dt.timedelta(days=1)),
+            [Record('c', start, start + dt.timedelta(hours=2))])
+        self.assertEqual(await handler.get_record_span(),
+                         (start, start + dt.timedelta(hours=2)))
+
+    async def test_concurrent_reports(self):
+        handler = self.handler
+        first = dt.datetime(2010, 4, 1, 8, 0)
+        records = [Record('ab'[i % 2], first + dt.timedelta(hours=7 * i),
+                          first + dt.timedelta(hours=7 * i, minutes=40))
+                   for i in range(200)]
+        self.assertEqual(await handler.import_records(
+            records, create_categories=True, batch_size=50), 200)
+        now = dt.datetime(2010, 5, 20, 12, 0)
+
+        other = SQLDataHandler(sqlite3.Connection(self.path))
+        self.addCleanup(other.db.close)
+        expected = []
+        for num_days in (7, 30):
+            table, headers = table_generator.create_table_iterable_and_headers(
+                other, now, num_days=num_days)
+            expected.append(([list(row) for row in table], headers))
+
+        reports = await asyncio.gather(*(
+            handler.report((7, 30)[i % 2], reference_datetime=now)
+            for i in range(200)))
+        for i, report in enumerate(reports):
+            self.assertEqual(report, expected[i % 2])
+        # Concurrent identical reports share one computation
+        self.assertIs(reports[0], reports[2])
+
+        # A report requested after a write is not shared with one from
+        # before it, and sees the write
+        pending = asyncio.ensure_future(
+            handler.report(7, reference_datetime=now))
+        await handler.start('a', dt.datetime(2010, 5, 20, 9, 0))
+        await handler.complete(dt.datetime(2010, 5, 20, 10, 0))
+        report = await handler.report(7, reference_datetime=now)
+        self.assertIsNot(report, await pending)
+        self.assertEqual(report[0][-2][0], dt.date(2010, 5, 20))
+        self.assertNotEqual(report, reports[0])
+
+    async def test_interleaved_reads_and_writes(self):
+        handler = self.handler
+        await handler.new_category('a')
+        writes = [handler.import_records(
+            [Record('a', dt.datetime(2011, 1, 1) + dt.timedelta(days=i),
+                    dt.datetime(2011, 1, 1, 1) + dt.timedelta(days=i))])
+            for i in range(20)]
+        reads = [handler.get_active_categories() for _ in range(20)]
+        results = await asyncio.gather(*writes, *reads)
+        self.assertEqual(results[:20], [1] * 20)
+        self.assertEqual(results[20:], [('a',)] * 20)
+        durations = await handler.get_category_durations(
+            dt.datetime(2011, 1, 1, 6, 0), dt.datetime(2011, 2, 1, 6, 0))
+        self.assertEqual(sum(s for row in durations.seconds for s in row
+                             if s), 19 * 3600)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+import datetime as dt
+import functools
+import multiprocessing
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from anpy_lib.data_handling import SQLDataHandler
+
+NUM_PROCESSES = 16
+
+
+def start_session(database_path, _):
+    handler = SQLDataHandler(sqlite3.Connection(database_path),
+                             busy_timeout=30)
+    try:
+        handler.start('Work')
+        return True
+    except RuntimeError:
+        return False
+    finally:
+        handler.db.close()
+
+
+def complete_session(database_path, _):
+    handler = SQLDataHandler(sqlite3.Connection(database_path),
+                             busy_timeout=30)
+    try:
+        handler.complete()
+        return True
+    except RuntimeError:
+        return False
+    finally:
+        handler.db.close()
+
+
+def read_status(database_path, _):
+    handler = SQLDataHandler(sqlite3.Connection(database_path),
+                             busy_timeout=30)
+    try:
+        now = dt.datetime.now()
+        handler.get_category_durations(now - dt.timedelta(days=7), now)
+        return handler.is_active_session()
+    finally:
+        handler.db.close()
+
+
+class ConcurrencyTest(unittest.TestCase):
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.database_path = os.path.join(self.directory.name, 'anpy.db')
+        handler = SQLDataHandler(sqlite3.Connection(self.database_path))
+        handler.new_category('Work')
+        handler.db.close()
+
+    def run_concurrently(self, *functions):
+        with multiprocessing.Pool(NUM_PROCESSES) as pool:
+            results = [pool.map_async(functools.partial(f, self.database_path),
+                                      range(NUM_PROCESSES))
+                       for f in functions]
+            return [r.get(timeout=60) for r in results]
+
+    def test_wal_mode(self):
+        handler = SQLDataHandler(sqlite3.Connection(self.database_path))
+        mode = handler.db.execute('PRAGMA journal_mode').fetchone()[0]
+        self.assertEqual(mode.lower(), 'wal')
+        handler.db.close()
+
+    def test_concurrent_start_and_complete(self):
+        for i in range(3):
+            with self.subTest(round=i):
+                started, statuses = self.run_concurrently(start_session,
+                                                          read_status)
+                self.assertEqual(started.count(True), 1)
+
+                completed, statuses = self.run_concurrently(complete_session,
+                                                            read_status)
+                self.assertEqual(completed.count(True), 1)
+
+        handler = SQLDataHandler(sqlite3.Connection(self.database_path))
+        self.assertFalse(handler.is_active_session())
+        count = handler.db.execute('SELECT COUNT(*) FROM records').fetchone()
+        self.assertEqual(count[0], 3)
+        handler.db.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+import contextlib
+import io
+import os
+import socket
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+import anpyd
+import cli
+from anpy_lib import daemon, file_management
+from anpy_lib.data_handling import SQLDataHandler
+
+
+class DaemonTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.socket_path = os.path.join(self.directory.name, 'anpyd.sock')
+        self.database_path = os.path.join(self.directory.name, 'data.db')
+        self.handler = SQLDataHandler(
+            sqlite3.Connection(self.database_path, check_same_thread=False))
+        self.daemon = anpyd.AnpyDaemon(self.handler)
+        self.server = daemon.DaemonServer(self.socket_path,
+                                          self.daemon.respond,
+                                          self.daemon.precompute,
+                                          client_timeout=0.5)
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       kwargs={'poll_interval': 0.05})
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        self.handler.db.close()
+        self.directory.cleanup()
+
+    def run_directly(self, argv):
+        handler = SQLDataHandler(sqlite3.Connection(self.database_path))
+        args = cli.make_parser().parse_args(argv)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            args.func(args, handler)
+        handler.db.close()
+        return output.getvalue()
+
+    def test_commands(self):
+        self.assertTrue(daemon.is_running(self.socket_path))
+        self.assertEqual(daemon.request(['start', '-c', 'work'],
+                                        self.socket_path), '')
+        self.assertIn('running',
+                      daemon.request(['start', 'work'], self.socket_path))
+        self.assertEqual(daemon.request(['end'], self.socket_path), '')
+        self.assertIn('no session',
+                      daemon.request(['end'], self.socket_path))
+
+        status = daemon.request(['status'], self.socket_path)
+        self.assertIn('Active categories: work', status)
+        self.assertEqual(status, self.run_directly(['status']))
+        self.assertEqual(daemon.request(['status'], self.socket_path),
+                         status)
+
+    def test_sees_external_writes(self):
+        daemon.request(['start', '-c', 'work'], self.socket_path)
+        daemon.request(['end'], self.socket_path)
+        daemon.request(['status'], self.socket_path)
+
+        self.run_directly(['create', 'play'])
+        status = daemon.request(['status'], self.socket_path)
+        self.assertIn('Active categories: work, play', status)
+
+    def test_errors(self):
+        errors = io.StringIO()
+        with contextlib.redirect_stderr(errors):
+            with self.assertRaisesRegex(RuntimeError,
+                                        "invalid choice: 'bogus'"):
+                daemon.request(['bogus'], self.socket_path)
+            self.assertIn('usage:',
+                          daemon.request(['status', '-h'], self.socket_path))
+        self.assertEqual(errors.getvalue(), '')
+        self.assertIsNone(daemon.request(
+            ['status'], os.path.join(self.directory.name, 'missing.sock')))
+
+    def test_stuck_client(self):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(self.socket_path)
+            status = daemon.request(['status'], self.socket_path, timeout=5)
+        self.assertIn('Active categories', status)
+
+    def listen(self, name):
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(server.close)
+        server.bind(os.path.join(self.directory.name, name))
+        server.listen()
+        return server
+
+    def test_unresponsive_daemon(self):
+        # Never accepted, so no answer comes
+        server = self.listen('hung.sock')
+        path = server.getsockname()
+        self.assertIsNone(daemon.request(['status'], path, timeout=0.1,
+                                         read_only=True))
+        # The daemon may still start the session later
+        with self.assertRaises(RuntimeError):
+            daemon.request(['start', 'work'], path, timeout=0.1)
+
+        server = self.listen('dying.sock')
+
+        def hang_up():
+            for _ in range(3):
+                connection, _ = server.accept()
+                with connection:
+                    connection.recv(1024)
+
+        thread = threading.Thread(target=hang_up)
+        thread.start()
+        self.assertIsNone(daemon.request(['status'], server.getsockname(),
+                                         timeout=5, read_only=True))
+        with self.assertRaises(RuntimeError):
+            daemon.request(['end'], server.getsockname(), timeout=5)
+        # The CLI reports that instead of ending the session itself
+        socket_path = file_management.SOCKET_PATH
+        self.addCleanup(setattr, file_management, 'SOCKET_PATH', socket_path)
+        file_management.SOCKET_PATH = server.getsockname()
+        with self.assertRaises(SystemExit) as raised:
+            cli.main(['end'])
+        self.assertIn('anpyd did not answer', str(raised.exception.code))
+        thread.join()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,26 +1,19 @@
 import datetime as dt
-import os
+import io
+import itertools as it
 import random
 import sqlite3
 import unittest
 
-from anpy import Record
-from anpy_lib import data_analysis
+from anpy import AbstractDataHandler, Day, Record, RecordBatch
+from anpy_lib import data_analysis, table_generator
 from anpy_lib.data_handling import SQLDataHandler
 
-DATABASE_PATH = 'anpy_test_database.db'
-
 
 class DataAnalysisTest(unittest.TestCase):
 
-    def tearDown(self):
-        os.remove(DATABASE_PATH)
-
-    def setUp(self):
-        pass
-
     def test_get_records_week(self):
-        handler = SQLDataHandler(sqlite3.Connection(DATABASE_PATH))
+        handler = SQLDataHandler(sqlite3.Connection(':memory:'))
         subjects = 'a b c d e'.split(' ')
 
         for s in subjects:
@@ -30,12 +23,14 @@ class DataAnalysisTest(unittest.TestCase):
 
         start_date = dt.datetime(2000, 5, 1, 4, 30)
 
+        records = []
         for i in range(500):
-            handler.start(random.choice(list(categories)), start_date)
             duration = dt.timedelta(seconds=random.randint(30, 60) * 60)
-            handler.complete(start_date + duration)
+            records.append(Record(random.choice(list(categories)),
+                                  start_date, start_date + duration))
             advance = dt.timedelta(seconds=random.randint(0, 60) * 60)
             start_date = start_date + advance + duration
+        handler.import_records(records)
 
         day = dt.datetime(2000, 5, 1, 6, 0)
         tuesday = data_analysis.get_records_on_day(handler,
@@ -49,8 +44,292 @@ class DataAnalysisTest(unittest.TestCase):
         self.assertEqual(actuals[1], tuesday)
         self.assertEqual(actuals[3], thursday)
 
+    def test_get_days_single_query(self):
+        handler = SQLDataHandler(sqlite3.Connection(':memory:'))
+        handler.new_category('a')
+        handler.new_category('b')
+
+        start_date = dt.datetime(2001, 2, 3, 5, 0)
+        for i in range(60):
+            handler.start(random.choice(['a', 'b']), start_date)
+            handler.complete(start_date + dt.timedelta(hours=2))
+            start_date += dt.timedelta(hours=5)
+
+        first = dt.datetime(2001, 2, 3, 6, 0)
+        expected = [data_analysis.get_records_on_day(
+            handler, first + dt.timedelta(days=i)) for i in range(14)]
+
+        statements = []
+        handler.db.set_trace_callback(statements.append)
+        days = data_analysis.get_days(handler, first, 14)
+        handler.db.set_trace_callback(None)
+
+        self.assertEqual(len([s for s in statements
+                              if 'FROM categories as c' in s]), 1)
+        self.assertEqual(days, expected)
+        self.assertEqual([day.day_start for day in days],
+                         [first + dt.timedelta(days=i) for i in range(14)])
+        handler.db.close()
+
+    def test_iter_days(self):
+        handler = SQLDataHandler(sqlite3.Connection(':memory:'),
+                                 chunk_size=4)
+        handler.new_category('a')
+
+        start_date = dt.datetime(2001, 2, 3, 5, 0)
+        for i in range(40):
+            handler.start('a', start_date)
+            handler.complete(start_date + dt.timedelta(hours=1))
+            start_date += dt.timedelta(hours=random.randint(2, 30))
+
+        first = dt.datetime(2001, 2, 2, 6, 0)
+        last = first + dt.timedelta(days=40)
+        self.assertEqual(list(handler.iter_records_between(first, last)),
+                         handler.get_records_between(first, last))
+        self.assertEqual(
+            list(handler.iter_records_between(first, last, chunk_size=1)),
+            handler.get_records_between(first, last))
+
+        days = list(data_analysis.iter_days(handler, first, 40))
+        self.assertEqual(days, data_analysis.get_days(handler, first, 40))
+        self.assertEqual([day.day_start for day in days],
+                         [first + dt.timedelta(days=i) for i in range(40)])
+        handler.db.close()
+
+    def test_record_batch(self):
+        handler = SQLDataHandler(sqlite3.Connection(':memory:'),
+                                 chunk_size=7)
+        for s in 'a b c'.split(' '):
+            handler.new_category(s)
+        handler.set_category_activation('b', False)
+
+        start_date = dt.datetime(2006, 8, 1, 4, 0)
+        records = []
+        for i in range(100):
+            duration = dt.timedelta(minutes=random.randint(10, 120))
+            records.append(Record(random.choice('abc'), start_date,
+                                  start_date + duration))
+            start_date += duration + dt.timedelta(minutes=30)
+        handler.import_records(records)
+
+        first = dt.datetime(2006, 8, 1)
+        last = start_date
+        batch = handler.get_record_batch(first, last)
+        self.assertEqual(len(batch), 100)
+        self.assertEqual(batch, records)
+        self.assertEqual(list(batch), records)
+        self.assertEqual(batch[10], records[10])
+        self.assertEqual(batch[-1], records[-1])
+        self.assertEqual(batch[20:30], records[20:30])
+        self.assertEqual(RecordBatch.from_records(records), batch)
+        self.assertEqual(
+            AbstractDataHandler.get_record_batch(handler, first, last), batch)
+
+        day = Day(first, batch[5:15])
+        self.assertEqual(day, records[5:15])
+        self.assertEqual(day.work_start, records[5].start)
+        self.assertEqual(day.work_end, records[14].end)
+        self.assertEqual(
+            data_analysis.get_per_category_durations(day),
+            data_analysis.get_per_category_durations(records[5:15]))
+        handler.db.close()
+
+    def test_get_category_durations(self):
+        handler = SQLDataHandler(sqlite3.Connection(':memory:'))
+        for s in 'a b c'.split(' '):
+            handler.new_category(s)
+
+        start_date = dt.datetime(2003, 1, 20, 4, 0)
+        for i in range(300):
+            handler.start(random.choice(['a', 'b', 'c']), start_date)
+            duration = dt.timedelta(minutes=random.randint(10, 120))
+            handler.complete(start_date + duration)
+            start_date += duration + dt.timedelta(
+                minutes=random.randint(0, 600))
+
+        handler.import_records([Record('b', start_date,
+                                        start_date + dt.timedelta(hours=1))])
+
+        windows = [(dt.datetime(2003, 1, 22, 6, 0),
+                    dt.datetime(2003, 4, 1, 6, 0), None),
+                   (dt.datetime(2003, 1, 22, 4, 0),
+                    dt.datetime(2003, 4, 1, 4, 0), dt.time(4, 0))]
+        for (first, last, day_start), bucket in it.product(
+                windows, ('day', 'week', 'month')):
+            with self.subTest(bucket=bucket, day_start=day_start):
+                actual = handler.get_category_durations(first, last, bucket,
+                                                        day_start)
+                expected = AbstractDataHandler.get_category_durations(
+                    handler, first, last, bucket, day_start)
+                self.assertEqual(actual.buckets, expected.buckets)
+                self.assertEqual(actual.categories, expected.categories)
+                self.assertEqual(actual.work_starts, expected.work_starts)
+                self.assertEqual(actual.work_ends, expected.work_ends)
+                for a_row, e_row in zip(actual.seconds, expected.seconds):
+                    for a, e in zip(a_row, e_row):
+                        if e is None:
+                            self.assertIsNone(a)
+                        else:
+                            self.assertAlmostEqual(a, e, places=3)
+
+        first = dt.datetime(2003, 1, 22, 6, 0)
+        days = data_analysis.get_days(handler, first, 10)
+        durations = handler.get_category_durations(
+            first, first + dt.timedelta(days=10))
+        for i, day in enumerate(days):
+            expected = data_analysis.get_per_category_durations(day)
+            actual = durations.get_bucket_durations(i)
+            self.assertEqual(durations.buckets[i], day.day_start.date())
+            self.assertEqual(durations.work_starts[i], day.work_start)
+            self.assertEqual(set(actual), set(expected))
+            for name in expected:
+                self.assertAlmostEqual(actual[name], expected[name], places=3)
+        handler.db.close()
+
+    def test_daily_totals(self):
+        handler = SQLDataHandler(sqlite3.Connection(':memory:'))
+        for s in 'a b c'.split(' '):
+            handler.new_category(s)
+
+        start_date = dt.datetime(2004, 6, 1, 4, 0)
+        records = []
+        for i in range(200):
+            duration = dt.timedelta(minutes=random.randint(10, 120))
+            records.append(Record(random.choice('abc'), start_date,
+                                  start_date + duration))
+            start_date += duration + dt.timedelta(
+                minutes=random.randint(0, 600))
+        handler.import_records(records[:100], batch_size=30)
+        for record in records[100:]:
+            handler.start(record.name, record.start)
+            handler.complete(record.end)
+
+        def totals():
+            return handler.db.execute(
+                'SELECT day, category_id, ROUND(seconds, 3), first_start, '
+                'last_end FROM daily_totals ORDER BY day, category_id'
+            ).fetchall()
+
+        incremental = totals()
+        handler.rebuild_daily_totals()
+        self.assertEqual(totals(), incremental)
+        self.assertEqual(round(sum(row[2] for row in incremental)),
+                         round(sum((r.end - r.start).total_seconds()
+                                   for r in records)))
+        handler.db.close()
+
+    def test_memoized_days(self):
+        handler = SQLDataHandler(sqlite3.Connection(':memory:'))
+        handler.new_category('a')
+        first = dt.datetime(2005, 3, 1, 6, 0)
+        handler.import_records(
+            [Record('a', first + dt.timedelta(hours=h),
+                    first + dt.timedelta(hours=h, minutes=30))
+             for h in range(0, 24 * 7, 5)])
+        now = first + dt.timedelta(days=6, hours=3)
+
+        def count_queries(f, *args):
+            statements = []
+            handler.db.set_trace_callback(statements.append)
+            result = f(handler, *args)
+            handler.db.set_trace_callback(None)
+            return result, len([s for s in statements
+                                if s.startswith('SELECT')
+                                and 'FROM categories as c' in s])
+
+        summaries, queries = count_queries(
+            data_analysis.get_day_summaries, first, 7, now)
+        self.assertEqual(queries, 1)
+        again, queries = count_queries(
+            data_analysis.get_day_summaries, first, 7, now)
+        self.assertEqual(queries, 1)
+        self.assertEqual(again, summaries)
+        for summary in summaries:
+            self.assertEqual(
+                summary.durations,
+                data_analysis.get_per_category_durations(
+                    data_analysis.get_records_on_day(handler,
+                                                     summary.day_start)))
+
+        day, queries = count_queries(data_analysis.get_day, first, now)
+        self.assertEqual(queries, 1)
+        self.assertIs(count_queries(data_analysis.get_day, first, now)[0],
+                      day)
+        durations, queries = count_queries(
+            data_analysis.get_day_durations, first, now)
+        self.assertEqual(queries, 0)
+        self.assertEqual(durations, summaries[0].durations)
+
+        handler.start('a', first + dt.timedelta(minutes=40))
+        handler.complete(first + dt.timedelta(minutes=50))
+        summaries, queries = count_queries(
+            data_analysis.get_day_summaries, first, 7, now)
+        self.assertEqual(queries, 1)
+        self.assertAlmostEqual(summaries[0].durations['a'], 5 * 1800 + 600)
+        self.assertIsNot(count_queries(data_analysis.get_day, first, now)[0],
+                         day)
+        handler.db.close()
+
+    def test_parse_window(self):
+        self.assertEqual(data_analysis.parse_window('30d'), 30)
+        self.assertEqual(data_analysis.parse_window('12w'), 84)
+        self.assertEqual(data_analysis.parse_window('1Y'), 365)
+        for window in ('', '0d', '7', 'd', '3h', '1.5y'):
+            with self.subTest(window=window):
+                with self.assertRaises(ValueError):
+                    data_analysis.parse_window(window)
+
+    def test_window_table(self):
+        handler = SQLDataHandler(sqlite3.Connection(':memory:'))
+        handler.new_category('a')
+        handler.new_category('b')
+        now = dt.datetime(2010, 3, 20, 12, 0)
+        first = dt.datetime(2010, 1, 1, 6, 0)
+        handler.import_records(
+            [Record('ab'[h % 2], first + dt.timedelta(hours=h),
+                    first + dt.timedelta(hours=h, minutes=45))
+             for h in range(0, 24 * 78, 7)])
+
+        table, headers = table_generator.create_table_iterable_and_headers(
+            handler, now, num_days=30)
+        rows = [list(row) for row in table]
+        self.assertEqual(len(rows), 31)
+        self.assertEqual(rows[0][0], dt.date(2010, 2, 19))
+        self.assertEqual(rows[-2][0], dt.date(2010, 3, 20))
+        self.assertEqual(rows[-1][0], 'averages:')
+        self.assertEqual(headers[6:], ['a (min)', 'b (min)'])
+        minutes = sum(float(row[6]) + float(row[7]) for row in rows[:-1])
+
+        statements = []
+        handler.db.set_trace_callback(statements.append)
+        table, headers = table_generator.create_table_iterable_and_headers(
+            handler, now, num_days=30, bucket='week')
+        rows = [list(row) for row in table]
+        handler.db.set_trace_callback(None)
+        self.assertEqual(len([s for s in statements
+                              if 'FROM categories as c' in s]), 1)
+
+        self.assertEqual(headers[:4], ['week', 'days', 'time working (h)',
+                                       'per day (h)'])
+        self.assertEqual([row[0] for row in rows],
+                         [dt.date(2010, 2, 15), dt.date(2010, 2, 22),
+                          dt.date(2010, 3, 1), dt.date(2010, 3, 8),
+                          dt.date(2010, 3, 15), 'totals:'])
+        self.assertEqual([row[1] for row in rows], [3, 7, 7, 7, 6, 30])
+        self.assertAlmostEqual(float(rows[-1][2]), minutes / 60, places=0)
+
+        output = io.StringIO()
+        table, headers = table_generator.create_table_iterable_and_headers(
+            handler, now, num_days=365, bucket='month')
+        table_generator.render_plain(table, headers, output)
+        lines = output.getvalue().splitlines()
+        self.assertEqual(len(lines), 2 + 13 + 1)
+        self.assertEqual(lines[2].split()[0], '2009-03-01')
+        self.assertEqual(lines[-1].split()[:2], ['totals:', '365'])
+        handler.db.close()
+
     def test_get_records_day(self):
-        handler = SQLDataHandler(sqlite3.Connection(DATABASE_PATH))
+        handler = SQLDataHandler(sqlite3.Connection(':memory:'))
         subjects = 'a b c'.split(' ')
         for s in subjects:
             handler.new_category(s)
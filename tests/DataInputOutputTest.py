@@ -1,25 +1,31 @@
 import datetime as dt
+import io
 import os
 import sqlite3
+import tempfile
 import unittest
 
 from anpy import Record
+from anpy_lib import data_handling
+from anpy_lib import data_import
 from anpy_lib.data_handling import SQLDataHandler
 
-DATABASE_PATH = 'anpy_test_database.db'
-
 
 class DataInputOutputTest(unittest.TestCase):
+    """Tests that need a database file, to open several connections to
+    it, create it in a temporary directory of their own; the others use
+    in-memory databases."""
 
     def tearDown(self):
-        os.remove(DATABASE_PATH)
+        self.directory.cleanup()
 
     def setUp(self):
-        pass
+        self.directory = tempfile.TemporaryDirectory()
+        self.database_path = os.path.join(self.directory.name, 'anpy.db')
 
     def test_cancel(self):
         start = dt.datetime(2002, 4, 6, 5, 6)
-        handler = SQLDataHandler(sqlite3.Connection(DATABASE_PATH))
+        handler = SQLDataHandler(sqlite3.Connection(':memory:'))
         handler.new_category('Test')
         handler.start('Test', start)
         self.assertTrue(handler.is_active_session())
@@ -36,7 +42,7 @@ class DataInputOutputTest(unittest.TestCase):
         start2 = dt.datetime(2010, 1, 1, 13, 0)
         end2 = dt.datetime(2010, 1, 1, 15, 0)
 
-        handler = SQLDataHandler(sqlite3.Connection(DATABASE_PATH))
+        handler = SQLDataHandler(sqlite3.Connection(':memory:'))
         categories = 'AP Bio,AP Chem,Physics 2,Biology 101,CS 61A'.split(',')
 
         for cat in categories:
@@ -80,7 +86,7 @@ class DataInputOutputTest(unittest.TestCase):
         start = dt.datetime(2015, 4, 5, 2, 0)
         end = dt.datetime(2015, 4, 5, 3, 30)
 
-        handler = SQLDataHandler(sqlite3.Connection(DATABASE_PATH))
+        handler = SQLDataHandler(sqlite3.Connection(':memory:'))
         categories = 'AP Bio,AP Chem,Physics 2,Biology 101,CS 61A'.split(',')
 
         for cat in categories:
@@ -122,7 +128,7 @@ class DataInputOutputTest(unittest.TestCase):
                     self.assertEqual(result, [])
 
     def test_category_activation(self):
-        handler = SQLDataHandler(sqlite3.Connection(DATABASE_PATH))
+        handler = SQLDataHandler(sqlite3.Connection(':memory:'))
         categories = 'AP Bio,AP Chem,Physics 2,Biology 101,CS 61A'.split(',')
         for subject in categories:
             handler.new_category(subject)
@@ -143,7 +149,7 @@ class DataInputOutputTest(unittest.TestCase):
             handler.set_category_activation(-1, False)
 
     def test_rename(self):
-        handler = SQLDataHandler(sqlite3.Connection(DATABASE_PATH))
+        handler = SQLDataHandler(sqlite3.Connection(':memory:'))
         handler.new_category('AP Bio')
         handler.new_category('AP French')
         handler.new_category('CS 50')
@@ -159,11 +165,63 @@ class DataInputOutputTest(unittest.TestCase):
         with self.assertRaises(ValueError):
             handler.rename_category('apple', 'banana')
 
+    def test_rename_keeps_history(self):
+        handler = SQLDataHandler(sqlite3.Connection(':memory:'))
+        handler.new_category('AP Bio')
+        start = dt.datetime(2016, 2, 1, 9, 0)
+        end = dt.datetime(2016, 2, 1, 10, 0)
+        handler.start('AP Bio', start)
+        handler.complete(end)
+        handler.start('AP Bio', end)
+
+        handler.rename_category('AP Bio', 'AP Biology')
+        self.assertEqual(handler.get_most_recent_session().name, 'AP Biology')
+        handler.complete(end + dt.timedelta(hours=1))
+        self.assertEqual(
+            handler.get_records_between(start, start + dt.timedelta(days=1)),
+            [Record('AP Biology', start, end),
+             Record('AP Biology', end, end + dt.timedelta(hours=1))])
+
+        handler.set_category_activation('AP Biology', False)
+        handler.new_category('AP Biology')
+        self.assertEqual(handler.all_categories, ('AP Biology',))
+        self.assertEqual(len(handler.get_records_between(
+            start, start + dt.timedelta(days=1))), 2)
+        handler.db.close()
+
+    def test_category_cache(self):
+        handler = SQLDataHandler(sqlite3.Connection(self.database_path))
+        other = SQLDataHandler(sqlite3.Connection(self.database_path))
+        handler.new_category('a')
+
+        info = handler.cache_info()
+        for i in range(3):
+            self.assertEqual(handler.active_categories, ('a',))
+        self.assertEqual(handler.cache_info().misses, info.misses + 1)
+        self.assertEqual(handler.cache_info().hits, info.hits + 2)
+
+        handler.set_category_activation('a', False)
+        self.assertEqual(handler.active_categories, ())
+
+        other.new_category('b')
+        self.assertEqual(handler.active_categories, ('b',))
+        other.rename_category('b', 'c')
+        self.assertEqual(handler.all_categories, ('a', 'c'))
+
+        with self.assertRaises(RuntimeError):
+            with handler.transaction():
+                handler.new_category('d')
+                self.assertIn('d', handler.active_categories)
+                raise RuntimeError
+        self.assertEqual(handler.all_categories, ('a', 'c'))
+        handler.db.close()
+        other.db.close()
+
     def test_category_persistence(self):
-        handler = SQLDataHandler(sqlite3.Connection(DATABASE_PATH))
+        handler = SQLDataHandler(sqlite3.Connection(self.database_path))
         self.assertEqual(handler.active_categories, ())
 
-        handler = SQLDataHandler(sqlite3.Connection(DATABASE_PATH))
+        handler = SQLDataHandler(sqlite3.Connection(self.database_path))
         self.assertEqual(handler.active_categories, ())
 
         categories = 'AP Bio,AP Chem,Physics 2,Biology 101,CS 61A'.split(',')
@@ -171,11 +229,11 @@ class DataInputOutputTest(unittest.TestCase):
             handler.new_category(subject)
         self.assertEqual(set(handler.active_categories), set(categories))
 
-        handler = SQLDataHandler(sqlite3.Connection(DATABASE_PATH))
+        handler = SQLDataHandler(sqlite3.Connection(self.database_path))
         self.assertEqual(set(handler.active_categories), set(categories))
 
     def test_category_creation(self):
-        handler = SQLDataHandler(sqlite3.Connection(DATABASE_PATH))
+        handler = SQLDataHandler(sqlite3.Connection(':memory:'))
         self.assertEqual(handler.active_categories, ())
         with self.assertRaises(ValueError):
             handler.new_category('')
@@ -200,6 +258,139 @@ class DataInputOutputTest(unittest.TestCase):
         handler.new_category('    decal     \t')
         self.assertTrue('decal' in handler.active_categories)
 
+    def test_import_records(self):
+        handler = SQLDataHandler(sqlite3.Connection(':memory:'))
+        handler.new_category('Math')
+        start = dt.datetime(2011, 6, 1, 8, 0)
+        records = [Record('Math', start + dt.timedelta(hours=i),
+                          start + dt.timedelta(hours=i, minutes=45))
+                   for i in range(25)]
+
+        self.assertEqual(handler.import_records(records, batch_size=10), 25)
+        self.assertEqual(
+            handler.get_records_between(start, start + dt.timedelta(days=2)),
+            records)
+
+        later = start + dt.timedelta(days=7)
+        with self.assertRaises(ValueError):
+            handler.import_records([Record('Math', later, later),
+                                    Record('Art', later, later)])
+        self.assertEqual(
+            handler.get_records_between(later, later + dt.timedelta(days=1)),
+            [])
+
+        self.assertEqual(handler.import_records(
+            [Record('Art', later, later + dt.timedelta(hours=1))],
+            create_categories=True), 1)
+        self.assertIn('Art', handler.active_categories)
+        handler.db.close()
+
+    def test_transaction(self):
+        handler = SQLDataHandler(sqlite3.Connection(self.database_path))
+        other = SQLDataHandler(sqlite3.Connection(self.database_path))
+
+        with handler.transaction():
+            for name in 'abc':
+                handler.new_category(name)
+            self.assertEqual(other.all_categories, ())
+        self.assertEqual(set(other.all_categories), {'a', 'b', 'c'})
+
+        with self.assertRaises(RuntimeError):
+            with handler.batch():
+                handler.new_category('d')
+                handler.new_category('a')
+        self.assertEqual(set(handler.all_categories), {'a', 'b', 'c'})
+
+        start = dt.datetime(2011, 6, 1, 8, 0)
+        with handler.transaction():
+            handler.start('a', start)
+            handler.complete(start + dt.timedelta(hours=1))
+            handler.start('b', start + dt.timedelta(hours=2))
+        self.assertTrue(other.is_active_session())
+        self.assertEqual(len(other.get_records_between(
+            start, start + dt.timedelta(days=1))), 1)
+        handler.db.close()
+        other.db.close()
+
+    def test_read_records(self):
+        start = dt.datetime(2011, 6, 1, 8, 0)
+        end = dt.datetime(2011, 6, 1, 9, 30)
+        expected = [Record('Math', start, end), Record('Art', start, end)]
+
+        csv_file = io.StringIO(
+            'name,start,end\n'
+            'Math,2011-06-01T08:00:00,2011-06-01T09:30:00\n'
+            'Art,{},{}\n'.format(start.timestamp(), end.timestamp()))
+        self.assertEqual(list(data_import.read_records(csv_file, 'csv')),
+                         expected)
+
+        toggl_file = io.StringIO(
+            'Project,Start date,Start time,End date,End time\n'
+            'Math,2011-06-01,08:00:00,2011-06-01,09:30:00\n')
+        self.assertEqual(list(data_import.read_records(toggl_file, 'csv')),
+                         expected[:1])
+
+        jsonl_file = io.StringIO(
+            '{"name": "Math", "start": "2011-06-01T08:00:00", '
+            '"end": "2011-06-01T09:30:00"}\n\n'
+            '{"category": "Art", "start": %s, "end": %s}\n'
+            % (start.timestamp(), end.timestamp()))
+        self.assertEqual(list(data_import.read_records(jsonl_file, 'jsonl')),
+                         expected)
+
+    def test_legacy_schema_migration(self):
+        db = sqlite3.Connection(self.database_path)
+        db.execute('CREATE TABLE categories(name UNIQUE, active DEFAULT 1)')
+        db.execute('CREATE TABLE beginnings(name, time_start, '
+                   'done_or_canceled DEFAULT 0)')
+        db.execute('CREATE TABLE records(name, time_start, time_end, '
+                   'ignored DEFAULT 0)')
+        start = dt.datetime(2012, 3, 4, 9, 0)
+        end = dt.datetime(2012, 3, 4, 10, 30)
+        db.execute("INSERT INTO categories(name) VALUES ('Math')")
+        db.execute("INSERT INTO categories(name, active) VALUES ('Art', 0)")
+        db.execute('INSERT INTO records(name, time_start, time_end) '
+                   "VALUES ('Math', ?, ?)", [start.timestamp(),
+                                             end.timestamp()])
+        # A record whose category was deleted by hand
+        db.execute('INSERT INTO records(name, time_start, time_end) '
+                   "VALUES ('Gone', ?, ?)", [start.timestamp(),
+                                             end.timestamp()])
+        db.commit()
+        db.close()
+
+        handler = SQLDataHandler(sqlite3.Connection(self.database_path))
+        self.assertEqual(handler.schema_version,
+                         data_handling.SCHEMA_VERSION)
+        self.assertEqual(handler.active_categories, ('Math',))
+        self.assertEqual(set(handler.all_categories), {'Math', 'Art'})
+        self.assertEqual(
+            handler.get_records_between(dt.datetime(2012, 3, 4),
+                                        dt.datetime(2012, 3, 5)),
+            [Record('Math', start, end)])
+        durations = handler.get_category_durations(
+            dt.datetime(2012, 3, 4, 6, 0), dt.datetime(2012, 3, 5, 6, 0))
+        self.assertEqual(durations.categories, ['Math'])
+        self.assertEqual(durations.seconds, [[5400]])
+
+        indexes = {tup[0] for tup in handler.db.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index'")}
+        self.assertIn('records_time_start', indexes)
+        self.assertIn('records_category_time_start', indexes)
+        self.assertIn('categories_active_name', indexes)
+        handler.db.close()
+
+    def test_current_schema_skips_migration(self):
+        SQLDataHandler(sqlite3.Connection(self.database_path)).db.close()
+        db = sqlite3.Connection(self.database_path)
+        statements = []
+        db.set_trace_callback(statements.append)
+        SQLDataHandler(db)
+        db.close()
+        self.assertIn('PRAGMA user_version', statements)
+        self.assertEqual([s for s in statements if not s.startswith('PRAGMA')],
+                         [])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,492 @@
+import contextlib
+import datetime as dt
+import io
+import json
+import os
+import sqlite3
+import tempfile
+import unittest
+import warnings
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+from openpyxl import load_workbook
+
+import cli
+from anpy import Record
+from anpy_lib import column_creation, data_entry, data_export, \
+    data_import, xlsx_patch
+from anpy_lib.data_handling import SQLDataHandler
+
+
+class ExportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'log.xlsx')
+        self.handler = SQLDataHandler(sqlite3.Connection(':memory:'))
+        self.handler.new_category('a')
+        self.handler.new_category('b')
+        first = dt.datetime(2003, 9, 1, 6, 0)
+        self.handler.import_records(
+            [Record('ab'[h % 2], first + dt.timedelta(hours=h),
+                    first + dt.timedelta(hours=h, minutes=50))
+             for h in range(1, 24 * 21, 9)])
+        self.now = dt.datetime(2003, 9, 17, 12, 0)
+
+    def tearDown(self):
+        self.handler.db.close()
+        self.directory.cleanup()
+
+    @staticmethod
+    def sheet_values(ws):
+        return [[(cell.value, cell.number_format) for cell in row]
+                for row in ws.iter_rows()]
+
+    def run_cli(self, *argv):
+        args = cli.make_parser().parse_args(argv)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            args.func(args, self.handler)
+        return output.getvalue()
+
+    def test_streamed_week_matches_log_file(self):
+        path = data_entry.export_week(self.handler, self.path, 'single',
+                                      self.now)
+        self.assertEqual(path, self.path)
+        expected = self.sheet_values(load_workbook(path)['2003-09-15'])
+
+        path = data_entry.export_week(self.handler, self.path, 'week',
+                                      self.now)
+        self.assertEqual(path, os.path.join(self.directory.name,
+                                            'log-2003-09-15.xlsx'))
+        wb = load_workbook(path)
+        self.assertEqual(wb.sheetnames, ['2003-09-15'])
+        self.assertEqual(self.sheet_values(wb['2003-09-15']), expected)
+
+    def test_month_layout(self):
+        path = data_entry.export_week(self.handler, self.path, 'month',
+                                      self.now)
+        self.assertEqual(path, os.path.join(self.directory.name,
+                                            'log-2003-09.xlsx'))
+        wb = load_workbook(path)
+        self.assertEqual(wb.sheetnames, ['2003-09-01', '2003-09-08',
+                                         '2003-09-15'])
+        self.assertEqual(wb['2003-09-01']['A2'].value,
+                         dt.datetime(2003, 9, 1, 6, 0))
+        self.assertEqual(wb['2003-09-01']['D1'].value, 'Time Total (H)')
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_export_weeks(self):
+        expected = dict()
+        for day in (3, 10, 17):
+            now = dt.datetime(2003, 9, day, 12, 0)
+            data_entry.export_week(self.handler, self.path, 'single', now)
+            monday = str(data_entry.get_most_recent_monday(now).date())
+            expected[monday] = self.sheet_values(
+                load_workbook(self.path)[monday])
+        os.remove(self.path)
+
+        span = self.handler.get_record_span()
+        self.assertEqual(span[0], dt.datetime(2003, 9, 1, 7, 0))
+        first = data_entry.get_most_recent_monday(span[0])
+        statements = []
+        self.handler.db.set_trace_callback(statements.append)
+        data_entry.export_weeks(self.handler, self.path, first, 3,
+                                rebuild=True)
+        self.handler.db.set_trace_callback(None)
+        self.assertEqual(len([s for s in statements
+                              if s.startswith('SELECT')]), 1)
+
+        wb = load_workbook(self.path)
+        self.assertEqual(wb.sheetnames, list(expected))
+        for monday, values in expected.items():
+            self.assertEqual(self.sheet_values(wb[monday]), values)
+
+        # Exporting a range into an existing log replaces only its weeks
+        wb['2003-09-08']['A1'] = 'changed'
+        wb['2003-09-15']['A1'] = 'changed'
+        wb.save(self.path)
+        data_entry.export_weeks(self.handler, self.path,
+                                dt.datetime(2003, 9, 15, 6, 0), 1)
+        wb = load_workbook(self.path)
+        self.assertEqual(wb['2003-09-08']['A1'].value, 'changed')
+        self.assertEqual(self.sheet_values(wb['2003-09-15']),
+                         expected['2003-09-15'])
+
+    def test_sheet_layout(self):
+        layout = column_creation.SheetLayout.for_categories(('a', 'b'))
+        self.assertIs(column_creation.SheetLayout.for_categories(('a', 'b')),
+                      layout)
+        self.assertEqual(layout.find_column_of_type(
+            column_creation.CategoryTimeColumn), 7)
+        self.assertEqual(layout.find_column_of_type(
+            column_creation.DataColumn), 2)
+
+        first = dt.datetime(2003, 9, 1, 6, 0)
+        weeks = [column_creation.WeekData(
+            first + dt.timedelta(weeks=i), [dt.time(7, i)] * 7,
+            [dt.time(20, 0)] * 7, {'a': [i] * 7, 'b': [None] * 7})
+            for i in range(20)]
+        expected = [layout.render(week) for week in weeks]
+        with ThreadPoolExecutor(4) as executor:
+            self.assertEqual(list(executor.map(layout.render, weeks)),
+                             expected)
+        self.assertEqual(expected[3][2][:2],
+                         [('=A2 + 1', 'YYYY-MM-DD'), (dt.time(7, 3),
+                                                      'h:mm AM/PM')])
+        self.assertEqual(expected[3][2][4][0],
+                         '=IF(SUM(G3:H3)=0,"N/A",SUM(G3:H3)/60)')
+        self.assertEqual(expected[3][2][7], (0, '0'))
+
+        empty = column_creation.SheetLayout.for_categories(())
+        rows = empty.render(column_creation.WeekData(first, [None] * 7,
+                                                     [None] * 7, {}))
+        self.assertEqual(rows[1][4][0], '=IF(SUM(G2)=0,"N/A",SUM(G2)/60)')
+
+    def test_export_weeks_in_parallel(self):
+        data_entry.export_weeks(self.handler, self.path,
+                                dt.datetime(2003, 9, 1, 6, 0), 3,
+                                rebuild=True)
+        expected = load_workbook(self.path)
+        os.remove(self.path)
+        with ThreadPoolExecutor(3) as executor:
+            data_entry.export_weeks(self.handler, self.path,
+                                    dt.datetime(2003, 9, 1, 6, 0), 3,
+                                    rebuild=True, executor=executor)
+        wb = load_workbook(self.path)
+        self.assertEqual(wb.sheetnames, expected.sheetnames)
+        for name in wb.sheetnames:
+            self.assertEqual(self.sheet_values(wb[name]),
+                             self.sheet_values(expected[name]))
+
+    def test_values_mode(self):
+        layout = column_creation.SheetLayout.for_categories(('a', 'b'))
+        nothing = [None] * 6
+        week = column_creation.WeekData(
+            dt.datetime(2003, 9, 1, 6, 0),
+            [dt.time(8, 30), dt.time(22, 0)] + nothing[:5],
+            [dt.time(17, 15), dt.time(2, 30)] + nothing[:5],
+            {'a': [300, 90] + nothing[:5], 'b': [30, None] + nothing[:5]})
+        values = [[value for value, _ in row]
+                  for row in layout.render(week, values=True)]
+        formats = [[number_format for _, number_format in row]
+                   for row in layout.render(week, values=True)]
+
+        self.assertEqual(values[0], [title for title, _ in
+                                     layout.render(week)[0]])
+        self.assertEqual(formats, [[number_format for _, number_format in row]
+                                   for row in layout.render(week)])
+        self.assertEqual([row[0] for row in values[1:]],
+                         [dt.datetime(2003, 9, d, 6, 0) for d in range(1, 8)]
+                         + ['Averages:'])
+        self.assertEqual(values[1][1:], [dt.time(8, 30), dt.time(17, 15),
+                                         8.75, 5.5, 5.5 / (8.75 * 0.75),
+                                         300, 30])
+        self.assertEqual(values[2][1:], [dt.time(22, 0), dt.time(2, 30),
+                                         4.5, 1.5, 1.5 / (4.5 * 0.75), 90, 0])
+        self.assertEqual(values[3][1:], ['N/A', 'N/A', 'N/A', 'N/A', 'N/A',
+                                         0, 0])
+        self.assertEqual(values[-1][1:3], ['N/A', 'N/A'])
+        self.assertAlmostEqual(values[-1][3], (8.75 + 4.5) / 2)
+        self.assertAlmostEqual(values[-1][4], (5.5 + 1.5) / 2)
+        self.assertAlmostEqual(values[-1][5], (5.5 / 0.75 + 1.5 / 0.75)
+                               / (8.75 + 4.5))
+        self.assertAlmostEqual(values[-1][6], 390 / 7)
+
+    def test_export_values_with_hidden_formulas(self):
+        path = data_entry.export_week(self.handler, self.path, 'single',
+                                      self.now, mode='both')
+        wb = load_workbook(path, data_only=True)
+        self.assertEqual(wb.sheetnames, ['2003-09-15',
+                                         '2003-09-15 formulas'])
+        self.assertEqual(wb['2003-09-15 formulas'].sheet_state, 'hidden')
+        self.assertIsInstance(wb['2003-09-15']['E2'].value, float)
+        self.assertTrue(load_workbook(path)['2003-09-15 formulas']['E2']
+                        .value.startswith('=IF(SUM('))
+
+        data_entry.export_week(self.handler, self.path, 'single', self.now,
+                               mode='values')
+        self.assertEqual(load_workbook(path).sheetnames, ['2003-09-15'])
+
+    def test_patch_week_sheet(self):
+        data_entry.export_weeks(self.handler, self.path,
+                                dt.datetime(2003, 9, 1, 6, 0), 2,
+                                rebuild=True)
+        full_path = os.path.join(self.directory.name, 'full.xlsx')
+        copy_path = os.path.join(self.directory.name, 'copy.xlsx')
+        for other in (full_path, copy_path):
+            with open(self.path, 'rb') as source, open(other, 'wb') as target:
+                target.write(source.read())
+
+        data_entry.export_week(self.handler, full_path, 'single', self.now,
+                               patch=False)
+        for path in (self.path, copy_path):
+            data_entry.export_week(self.handler, path, 'single', self.now)
+        with open(self.path, 'rb') as patched, open(copy_path, 'rb') as copy:
+            self.assertEqual(patched.read(), copy.read())
+
+        expected = load_workbook(full_path)
+        wb = load_workbook(self.path)
+        self.assertEqual(wb.sheetnames, expected.sheetnames)
+        for name in wb.sheetnames:
+            self.assertEqual(self.sheet_values(wb[name]),
+                             self.sheet_values(expected[name]))
+
+        # Unchanged data leaves the file alone
+        week = data_entry.get_week(self.handler,
+                                   dt.datetime(2003, 9, 15, 6, 0))
+        sheets = data_entry.render_week_sheets(week)
+        modified = os.stat(self.path).st_mtime_ns
+        self.assertFalse(xlsx_patch.patch_sheets(self.path, sheets))
+        self.assertEqual(os.stat(self.path).st_mtime_ns, modified)
+
+        self.handler.start('a', dt.datetime(2003, 9, 16, 23, 0))
+        self.handler.complete(dt.datetime(2003, 9, 16, 23, 30))
+        week = data_entry.get_week(self.handler,
+                                   dt.datetime(2003, 9, 15, 6, 0))
+        self.assertTrue(xlsx_patch.patch_sheets(
+            self.path, data_entry.render_week_sheets(week, 'both')))
+        wb = load_workbook(self.path)
+        self.assertEqual(wb.sheetnames[-2:], ['2003-09-15',
+                                              '2003-09-15 formulas'])
+        self.assertEqual(wb['2003-09-15 formulas'].sheet_state, 'hidden')
+        self.assertEqual(wb['2003-09-01']['A1'].value, 'Date')
+
+        # Only the state of a sheet changes
+        title, rows, _ = data_entry.render_week_sheets(week)[0]
+        for hidden, state in ((True, 'hidden'), (False, 'visible')):
+            self.assertTrue(xlsx_patch.patch_sheets(self.path,
+                                                    [(title, rows, hidden)]))
+            self.assertEqual(load_workbook(self.path)[title].sheet_state,
+                             state)
+
+    def test_patch_copies_other_members(self):
+        data_entry.export_weeks(self.handler, self.path,
+                                dt.datetime(2003, 9, 1, 6, 0), 3,
+                                rebuild=True)
+        with zipfile.ZipFile(self.path) as archive:
+            members = {info.filename: (archive.read(info), info.date_time,
+                                       info.compress_type)
+                       for info in archive.infolist()}
+        week = data_entry.get_week(self.handler,
+                                   dt.datetime(2003, 9, 15, 6, 0))
+        title, rows, _ = data_entry.render_week_sheets(week)[0]
+        rows[0] = [('changed', 'General')] + rows[0][1:]
+        sheet_part = 'xl/worksheets/sheet3.xml'
+
+        self.assertTrue(xlsx_patch.patch_sheets(self.path,
+                                                [(title, rows, False)]))
+        with zipfile.ZipFile(self.path) as archive:
+            self.assertIsNone(archive.testzip())
+            self.assertEqual(set(archive.namelist()), set(members))
+            for info in archive.infolist():
+                if info.filename in (sheet_part, xlsx_patch.WORKBOOK_PART):
+                    continue
+                with self.subTest(member=info.filename):
+                    self.assertEqual((archive.read(info), info.date_time,
+                                      info.compress_type),
+                                     members[info.filename])
+        self.assertEqual(load_workbook(self.path)[title]['A1'].value,
+                         'changed')
+
+    def test_remove_sheet_before_others(self):
+        data_entry.export_week(self.handler, self.path, 'single', self.now,
+                               mode='both')
+        wb = load_workbook(self.path)
+        notes = wb.create_sheet('notes')
+        notes.print_area = 'A1:B2'
+        wb.active = notes
+        wb['2003-09-15 formulas']['Z1'].hyperlink = 'http://example.com'
+        wb.save(self.path)
+        with zipfile.ZipFile(self.path) as archive:
+            self.assertIn('xl/worksheets/_rels/sheet2.xml.rels',
+                          archive.namelist())
+
+        data_entry.export_week(self.handler, self.path, 'single', self.now,
+                               mode='values')
+        with zipfile.ZipFile(self.path) as archive:
+            self.assertNotIn('xl/worksheets/_rels/sheet2.xml.rels',
+                             archive.namelist())
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            wb = load_workbook(self.path)
+        self.assertEqual(wb.sheetnames, ['2003-09-15', 'notes'])
+        self.assertEqual(wb.active.title, 'notes')
+        self.assertEqual(wb['notes'].print_area, "'notes'!$A$1:$B$2")
+
+        # The active sheet moves to its neighbour when it is removed
+        wb.active = wb['2003-09-15']
+        wb.save(self.path)
+        xlsx_patch.patch_sheets(self.path, [], ['2003-09-15'])
+        wb = load_workbook(self.path)
+        self.assertEqual(wb.active.title, 'notes')
+        self.assertEqual(wb['notes'].print_area, "'notes'!$A$1:$B$2")
+
+    def test_export_all_keeps_other_sheets(self):
+        data_entry.export_week(self.handler, self.path, 'single', self.now)
+        wb = load_workbook(self.path)
+        wb.create_sheet('notes')['A1'] = 'by hand'
+        wb.save(self.path)
+
+        def export(*argv):
+            self.run_cli('export', '-o', self.path, '-l', 'single', *argv)
+            return load_workbook(self.path)
+
+        wb = export('--all')
+        self.assertEqual(wb['notes']['A1'].value, 'by hand')
+        self.assertEqual(len(wb.sheetnames), 4)
+        wb = export('--all', '--rebuild')
+        self.assertEqual(wb.sheetnames,
+                         ['2003-09-01', '2003-09-08', '2003-09-15'])
+
+    def test_export_records(self):
+        start, end = data_export.get_day_range(dt.datetime(2003, 9, 2),
+                                               dt.datetime(2003, 9, 16))
+        self.assertEqual((start, end), (dt.datetime(2003, 9, 1, 6, 0),
+                                        dt.datetime(2003, 9, 16, 6, 0)))
+        expected = self.handler.get_records_between(start, end)
+        self.assertEqual(
+            sum(len(batch) for batch in self.handler.iter_record_batches(
+                start, end, chunk_size=7)), len(expected))
+
+        for file_format in ('csv', 'jsonl'):
+            with self.subTest(file_format=file_format):
+                stream = io.StringIO(newline='')
+                self.assertEqual(data_export.export_table(
+                    self.handler, stream, file_format, 'records', start, end,
+                    chunk_size=7), len(expected))
+                stream.seek(0)
+                self.assertEqual(
+                    list(data_import.read_records(stream, file_format)),
+                    expected)
+
+    def test_export_days(self):
+        start = dt.datetime(2003, 9, 1, 6, 0)
+        end = dt.datetime(2003, 9, 22, 6, 0)
+        durations = self.handler.get_category_durations(start, end)
+        rows = list(self.handler.iter_daily_totals(start, end, chunk_size=4))
+        self.assertEqual(rows, sorted(rows))
+        self.assertEqual(
+            [(day, name, seconds) for day, name, seconds, _, _ in rows],
+            [(day, name, seconds)
+             for day, row in zip(durations.buckets, durations.seconds)
+             for name, seconds in zip(durations.categories, row)
+             if seconds is not None])
+        # Windows that do not align with the rollup are summed from records
+        self.assertEqual(
+            list(self.handler.iter_daily_totals(
+                start - dt.timedelta(hours=1), end - dt.timedelta(hours=1),
+                dt.time(5, 0)))[0][1:],
+            rows[0][1:])
+
+        stream = io.StringIO()
+        data_export.export_table(self.handler, stream, 'jsonl', 'days',
+                                 start, end, chunk_size=4)
+        lines = stream.getvalue().splitlines()
+        self.assertEqual(len(lines), len(rows))
+        self.assertEqual(json.loads(lines[0]), {
+            'day': '2003-09-01', 'name': rows[0][1], 'seconds': rows[0][2],
+            'first_start': rows[0][3].isoformat(),
+            'last_end': rows[0][4].isoformat()})
+
+    def test_export_parquet(self):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            self.skipTest('pyarrow is not installed')
+        start = dt.datetime(2003, 9, 1, 6, 0)
+        end = dt.datetime(2003, 9, 22, 6, 0)
+        path = os.path.join(self.directory.name, 'records.parquet')
+        count = data_export.export_table(self.handler, path, 'parquet',
+                                         'records', start, end, chunk_size=7)
+        table = pq.read_table(path)
+        self.assertEqual(table.num_rows, count)
+        self.assertEqual(
+            [Record(*row.values()) for row in table.to_pylist()],
+            self.handler.get_records_between(start, end))
+
+    def test_import_workbook(self):
+        start = dt.datetime(2003, 9, 1, 6, 0)
+        end = dt.datetime(2003, 9, 22, 6, 0)
+        data_entry.export_weeks(self.handler, self.path, start, 2,
+                                rebuild=True)
+        data_entry.export_week(self.handler, self.path, 'single', self.now,
+                               mode='both')
+        expected = self.handler.get_category_durations(start, end)
+
+        handler = SQLDataHandler(sqlite3.Connection(':memory:'))
+        self.addCleanup(handler.db.close)
+        handler.new_category('a')
+        # Days that already have records are left alone
+        handler.start('a', dt.datetime(2003, 9, 3, 9, 0))
+        handler.complete(dt.datetime(2003, 9, 3, 9, 5))
+        statements = []
+        handler.db.set_trace_callback(statements.append)
+        with open(self.path, 'rb') as stream:
+            with self.assertRaises(ValueError):
+                data_import.import_workbook(handler, stream)
+            self.assertEqual(handler.get_record_span()[0],
+                             dt.datetime(2003, 9, 3, 9, 0))
+            stream.seek(0)
+            count = data_import.import_workbook(handler, stream,
+                                                create_categories=True)
+        handler.db.set_trace_callback(None)
+        self.assertEqual(statements.count('BEGIN IMMEDIATE'), 2)
+        self.assertEqual(statements.count('COMMIT'), 1)
+        skipped = expected.buckets.index(dt.date(2003, 9, 3))
+        self.assertEqual(count, sum(
+            seconds is not None for i, row in enumerate(expected.seconds)
+            if i != skipped for seconds in row))
+
+        durations = handler.get_category_durations(start, end)
+        self.assertEqual(durations.buckets, expected.buckets)
+        self.assertEqual(durations.categories, expected.categories)
+        self.assertEqual(durations.seconds[skipped], [300, None])
+        for i, day in enumerate(expected.buckets):
+            if i == skipped:
+                continue
+            with self.subTest(day=day):
+                for seconds, other in zip(durations.seconds[i],
+                                          expected.seconds[i]):
+                    if other is None:
+                        self.assertIsNone(seconds)
+                    else:
+                        self.assertAlmostEqual(seconds, other, places=3)
+                self.assertAlmostEqual(durations.work_starts[i],
+                                       expected.work_starts[i],
+                                       delta=dt.timedelta(seconds=1))
+                self.assertAlmostEqual(durations.work_ends[i],
+                                       expected.work_ends[i],
+                                       delta=dt.timedelta(seconds=1))
+
+        with open(self.path, 'rb') as stream:
+            self.assertEqual(data_import.import_workbook(handler, stream), 0)
+
+
+    def test_import_errors(self):
+        missing = os.path.join(self.directory.name, 'missing.csv')
+        self.assertIn('Import failed', self.run_cli('import', missing))
+        text = os.path.join(self.directory.name, 'notes.txt')
+        with open(text, 'w') as f:
+            f.write('not a workbook')
+        self.assertIn('Import failed: Not an xlsx workbook',
+                      self.run_cli('import', '-f', 'xlsx', text))
+
+    def test_export_data_errors(self):
+        missing = os.path.join(self.directory.name, 'missing', 'rows.csv')
+        self.assertIn('Export failed',
+                      self.run_cli('export', '--all', '-o', missing))
+        rows = os.path.join(self.directory.name, 'rows.csv')
+        for argv in (('--layout', 'week'), ('--cells', 'values'),
+                     ('--jobs', '2'), ('--rebuild',)):
+            with self.subTest(argv=argv):
+                self.assertIn('{} only apply to xlsx exports.'
+                              .format(argv[0]),
+                              self.run_cli('export', '--all', '-o', rows,
+                                           *argv))
+        self.assertFalse(os.path.exists(rows))
+
+
+if __name__ == '__main__':
+    unittest.main()
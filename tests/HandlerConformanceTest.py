@@ -0,0 +1,326 @@
+import datetime as dt
+import random
+import sqlite3
+import unittest
+
+from anpy import BUCKETS, Record, RecordBatch, Session
+from anpy_lib import data_analysis
+from anpy_lib.data_handling import SQLDataHandler
+from anpy_lib.memory_handling import MemoryDataHandler
+
+
+def make_records(seed=0, count=300):
+    """Sessions of whole minutes, some of them starting at the same time."""
+    rng = random.Random(seed)
+    start = dt.datetime(2001, 2, 26, 4, 0)
+    records = []
+    for _ in range(count):
+        duration = dt.timedelta(minutes=rng.randint(5, 90))
+        records.append(Record(rng.choice('abcd'), start, start + duration))
+        start += rng.choice([dt.timedelta(0), duration,
+                             duration + dt.timedelta(hours=5)])
+    return records
+
+
+class HandlerConformance:
+    """Behaviour that every AbstractDataHandler backend must share.
+
+    Subclasses also derive from unittest.TestCase and must define
+    make_handler, which returns a new, empty backend as self.handler.
+    """
+
+    def setUp(self):
+        self.handler = self.make_handler()
+
+    def test_categories(self):
+        handler = self.handler
+        self.assertEqual(handler.active_categories, ())
+        for name in ['b', 'a', '  c \t']:
+            handler.new_category(name)
+        self.assertEqual(handler.all_categories, ('b', 'a', 'c'))
+        with self.assertRaises(ValueError):
+            handler.new_category(' ')
+        with self.assertRaises(RuntimeError):
+            handler.new_category('a')
+
+        handler.set_category_activation('b', False)
+        self.assertEqual(handler.active_categories, ('a', 'c'))
+        handler.new_category('b')
+        self.assertEqual(handler.active_categories, ('b', 'a', 'c'))
+        self.assertEqual(handler.all_categories, ('b', 'a', 'c'))
+        with self.assertRaises(ValueError):
+            handler.set_category_activation('d', True)
+
+        handler.rename_category('a', 'z')
+        self.assertEqual(handler.active_categories, ('b', 'z', 'c'))
+        with self.assertRaises(ValueError):
+            handler.rename_category('a', 'y')
+        with self.assertRaises(ValueError):
+            handler.rename_category('z', 'b')
+        self.assertEqual(handler.all_categories, ('b', 'z', 'c'))
+        handler.rename_category('z', 'z')
+        self.assertEqual(handler.active_categories, ('b', 'z', 'c'))
+
+    def test_sessions(self):
+        handler = self.handler
+        handler.new_category('a')
+        handler.new_category('b')
+        handler.set_category_activation('b', False)
+        start = dt.datetime(2005, 6, 7, 8, 9, 10, 500000)
+        self.assertIsNone(handler.get_most_recent_session())
+        with self.assertRaises(RuntimeError):
+            handler.complete(start)
+        with self.assertRaises(ValueError):
+            handler.start('b', start)
+        with self.assertRaises(ValueError):
+            handler.start(-5, start)
+
+        handler.start('a', start)
+        self.assertTrue(handler.is_active_session())
+        self.assertEqual(handler.get_most_recent_session(),
+                         Session('a', start, False))
+        with self.assertRaises(RuntimeError):
+            handler.start('a', start)
+        handler.cancel()
+        self.assertFalse(handler.is_active_session())
+        with self.assertRaises(AssertionError):
+            handler.cancel()
+
+        handler.start('a', start)
+        handler.rename_category('a', 'c')
+        self.assertEqual(handler.get_most_recent_session().name, 'c')
+        handler.complete(start + dt.timedelta(hours=1))
+        self.assertIsNone(handler.get_most_recent_session())
+        self.assertEqual(
+            handler.get_records_between(start, start + dt.timedelta(days=1)),
+            [Record('c', start, start + dt.timedelta(hours=1))])
+
+    def test_range_queries(self):
+        handler = self.handler
+        records = make_records()
+        handler.import_records(records, batch_size=64, create_categories=True)
+        records.sort(key=lambda record: record.start)
+        start = records[40].start
+        end = records[200].start
+        expected = [r for r in records if start <= r.start < end]
+
+        self.assertEqual(handler.get_records_between(start, end), expected)
+        self.assertEqual(list(handler.iter_records_between(start, end, 7)),
+                         expected)
+        batch = handler.get_record_batch(start, end)
+        self.assertEqual(list(batch), expected)
+        self.assertEqual(batch.categories, list(handler.all_categories))
+        batches = list(handler.iter_record_batches(start, end, 50))
+        self.assertEqual([len(b) for b in batches][:-1],
+                         [50] * (len(batches) - 1))
+        self.assertEqual([r for b in batches for r in b], expected)
+        self.assertEqual(handler.get_records_between(
+            end, end + dt.timedelta.resolution),
+            [r for r in records if r.start == end])
+        with self.assertRaises(AssertionError):
+            handler.get_records_between(end, start)
+
+        self.assertEqual(handler.get_record_span(),
+                         (records[0].start, max(r.end for r in records)))
+        days = handler.get_days(dt.datetime(2001, 3, 1, 6, 0), 5)
+        self.assertEqual(
+            [list(day) for day in days],
+            [[r for r in records if day.day_start <= r.start
+              < day.day_start + dt.timedelta(days=1)] for day in days])
+
+    def test_category_durations(self):
+        handler = self.handler
+        records = make_records(1)
+        handler.import_records(records, create_categories=True)
+        windows = [(dt.datetime(2001, 2, 26, 6, 0),
+                    dt.datetime(2001, 4, 2, 6, 0), None),
+                   (dt.datetime(2001, 2, 27, 3, 0),
+                    dt.datetime(2001, 3, 20, 3, 0), dt.time(3, 0)),
+                   (dt.datetime(2001, 3, 1, 12, 0),
+                    dt.datetime(2001, 3, 9, 6, 0), None)]
+        for start, end, day_start_time in windows:
+            for bucket in BUCKETS:
+                with self.subTest(start=start, bucket=bucket):
+                    durations = handler.get_category_durations(
+                        start, end, bucket, day_start_time)
+                    expected = RecordBatch.from_records(
+                        r for r in records if start <= r.start < end)
+                    self.assertEqual(
+                        sum(s or 0 for row in durations.seconds for s in row),
+                        sum(expected.ends) - sum(expected.starts))
+                    self.assertEqual(durations.categories,
+                                     sorted(set(map(expected.categories
+                                                    .__getitem__,
+                                                    expected.names))))
+
+            rows = list(handler.iter_daily_totals(start, end, day_start_time,
+                                                  chunk_size=3))
+            durations = handler.get_category_durations(start, end, 'day',
+                                                       day_start_time)
+            self.assertEqual(rows, sorted(rows, key=lambda r: r[:2]))
+            self.assertEqual(
+                [(day, name, seconds) for day, name, seconds, _, _ in rows],
+                [(day, name, seconds)
+                 for day, row in zip(durations.buckets, durations.seconds)
+                 for name, seconds in zip(durations.categories, row)
+                 if seconds is not None])
+        with self.assertRaises(ValueError):
+            handler.get_category_durations(*windows[0][:2], 'year')
+
+        before = handler.get_category_durations(*windows[0][:2])
+        handler.rebuild_daily_totals()
+        self.assertEqual(handler.get_category_durations(*windows[0][:2]),
+                         before)
+
+    def test_import_records(self):
+        handler = self.handler
+        handler.new_category('a')
+        records = make_records(2, 25)
+        with self.assertRaises(ValueError):
+            handler.import_records(records, batch_size=10)
+        # Batches before the failing one stay imported
+        imported = handler.get_records_between(dt.datetime(2001, 1, 1),
+                                               dt.datetime(2002, 1, 1))
+        self.assertEqual(len(imported) % 10, 0)
+        handler.set_category_activation('a', False)
+        late = dt.datetime(2003, 1, 1)
+        self.assertEqual(handler.import_records(
+            [Record('a', late, late + dt.timedelta(hours=1))]), 1)
+        with self.assertRaises(ValueError):
+            handler.import_records(
+                [Record('a', late, late - dt.timedelta(hours=1))])
+        with self.assertRaises(ValueError):
+            handler.import_records([Record(' ', late, late)],
+                                   create_categories=True)
+        self.assertEqual(handler.all_categories, ('a',))
+
+    def test_transaction(self):
+        handler = self.handler
+        handler.new_category('a')
+        version = handler.data_version
+        start = dt.datetime(2004, 1, 1, 9, 0)
+        window = (dt.datetime(2004, 1, 1, 6, 0), dt.datetime(2004, 1, 2, 6, 0))
+        with self.assertRaises(KeyError):
+            with handler.transaction():
+                handler.new_category('b')
+                handler.rename_category('a', 'c')
+                handler.set_category_activation('b', False)
+                handler.start('c', start)
+                handler.complete(start + dt.timedelta(hours=1))
+                handler.import_records(
+                    make_records(3, 40) + [Record('c', start, start)],
+                    batch_size=7, create_categories=True)
+                with handler.batch():
+                    handler.start('c', start)
+                self.assertEqual(len(handler.get_records_between(*window)),
+                                 2)
+                self.assertIsNone(handler.data_version)
+                raise KeyError
+        self.assertNotEqual(handler.data_version, version)
+        self.assertEqual(handler.all_categories, ('a',))
+        self.assertEqual(handler.active_categories, ('a',))
+        self.assertFalse(handler.is_active_session())
+        self.assertIsNone(handler.get_record_span())
+        self.assertEqual(handler.get_category_durations(*window).seconds,
+                         [[]])
+
+        with handler.transaction():
+            handler.start('a', start)
+            handler.complete(start + dt.timedelta(minutes=30))
+        self.assertNotEqual(handler.data_version, version)
+        self.assertEqual(handler.get_category_durations(*window).seconds,
+                         [[1800]])
+
+    def test_rolled_back_writes_are_not_cached(self):
+        handler = self.handler
+        handler.new_category('a')
+        day_start = dt.datetime(2004, 1, 1, 6, 0)
+        start = dt.datetime(2004, 1, 1, 9, 0)
+        with self.assertRaises(KeyError):
+            with handler.transaction():
+                handler.import_records(
+                    [Record('a', start, start + dt.timedelta(hours=1))])
+                summary, = data_analysis.get_day_summaries(handler,
+                                                           day_start, 1)
+                self.assertEqual(summary.durations, {'a': 3600})
+                data_analysis.get_day(handler, day_start)
+                data_analysis.get_day_durations(handler, day_start)
+                raise KeyError
+        summary, = data_analysis.get_day_summaries(handler, day_start, 1)
+        self.assertEqual(summary.durations, {})
+        self.assertEqual(len(data_analysis.get_day(handler, day_start)), 0)
+        self.assertEqual(data_analysis.get_day_durations(handler, day_start),
+                         {})
+
+
+class SQLHandlerConformanceTest(HandlerConformance, unittest.TestCase):
+
+    def make_handler(self):
+        handler = SQLDataHandler(sqlite3.Connection(':memory:'))
+        self.addCleanup(handler.db.close)
+        return handler
+
+
+class MemoryHandlerConformanceTest(HandlerConformance, unittest.TestCase):
+
+    def make_handler(self):
+        return MemoryDataHandler()
+
+    def test_matches_sql_handler(self):
+        other = SQLDataHandler(sqlite3.Connection(':memory:'))
+        self.addCleanup(other.db.close)
+        rng = random.Random(4)
+        records = make_records(5, 400)
+        rng.shuffle(records)
+        for handler in (self.handler, other):
+            handler.import_records(records[:150], create_categories=True)
+            handler.import_records(records[150:], batch_size=33,
+                                   create_categories=True)
+            handler.set_category_activation('b', False)
+            handler.start('a', dt.datetime(2001, 3, 3, 23, 0))
+            handler.complete(dt.datetime(2001, 3, 4, 1, 0))
+
+        start = dt.datetime(2001, 2, 20, 6, 0)
+        end = dt.datetime(2001, 5, 1, 6, 0)
+        for method in ('get_records_between', 'get_record_batch',
+                       'get_category_durations', 'iter_daily_totals'):
+            with self.subTest(method=method):
+                self.assertEqual(
+                    list(getattr(self.handler, method)(start, end)),
+                    list(getattr(other, method)(start, end)))
+        for name in ('all_categories', 'active_categories',
+                     'get_record_span'):
+            with self.subTest(name=name):
+                value = getattr(self.handler, name)
+                expected = getattr(other, name)
+                if callable(value):
+                    value, expected = value(), expected()
+                self.assertEqual(value, expected)
+
+    def test_copy_of_sql_handler(self):
+        other = SQLDataHandler(sqlite3.Connection(':memory:'))
+        self.addCleanup(other.db.close)
+        other.import_records(make_records(6), create_categories=True)
+        other.set_category_activation('c', False)
+        other.start('a', dt.datetime(2002, 1, 1, 9, 0))
+
+        copy = MemoryDataHandler.from_handler(other, chunk_size=16)
+        self.assertEqual(copy.all_categories, other.all_categories)
+        self.assertEqual(copy.active_categories, other.active_categories)
+        self.assertEqual(copy.get_most_recent_session(),
+                         other.get_most_recent_session())
+        start, end = other.get_record_span()
+        self.assertEqual(copy.get_records_between(start, end),
+                         other.get_records_between(start, end))
+        window = (dt.datetime(2001, 2, 26, 6, 0),
+                  dt.datetime(2001, 4, 2, 6, 0))
+        self.assertEqual(copy.get_category_durations(*window, 'week'),
+                         other.get_category_durations(*window, 'week'))
+
+        # Changes to the copy leave the original alone
+        copy.complete(dt.datetime(2002, 1, 1, 10, 0))
+        self.assertTrue(other.is_active_session())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_BUDGET_US = 100000
+"""Cumulative microseconds that importing cli may take"""
+
+HEAVY_MODULES = ('openpyxl', 'tabulate', 'pyarrow')
+"""Modules that only the export and status paths may load"""
+
+
+def import_times(statement):
+    """Run the statement in a fresh interpreter with -X importtime.
+
+    :return: a dict of module name to cumulative import time in microseconds
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                             statement],
+                            cwd=REPO_PATH, stderr=subprocess.PIPE,
+                            universal_newlines=True, check=True)
+    times = dict()
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+class StartupTest(unittest.TestCase):
+
+    def test_cli_import_is_light(self):
+        times = import_times('import cli')
+        for module in HEAVY_MODULES:
+            with self.subTest(module=module):
+                self.assertFalse(
+                    [m for m in times if m.split('.')[0] == module])
+        self.assertLess(times['cli'], IMPORT_BUDGET_US)
+
+    def test_start_and_end_do_not_load_heavy_modules(self):
+        statement = ('import sys, cli; '
+                     'cli.main(["start", "-c", "w"]); '
+                     'cli.main(["end"]); '
+                     'print(",".join(sys.modules))')
+        with tempfile.TemporaryDirectory() as home:
+            env = dict(os.environ, HOME=home)
+            result = subprocess.run([sys.executable, '-c', statement],
+                                    cwd=REPO_PATH, env=env,
+                                    stdout=subprocess.PIPE,
+                                    universal_newlines=True, check=True)
+        modules = result.stdout.strip().splitlines()[-1].split(',')
+        for module in HEAVY_MODULES:
+            with self.subTest(module=module):
+                self.assertNotIn(module, modules)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+import datetime as dt
+import random
+import sqlite3
+import unittest
+
+from anpy import Record
+from anpy_lib import data_analysis, table_generator, vectorized
+from anpy_lib.data_handling import SQLDataHandler
+from anpy_lib.table_generator import AverageRow, Row
+
+
+@unittest.skipUnless(vectorized.AVAILABLE, 'NumPy is not installed')
+class VectorizedTest(unittest.TestCase):
+
+    def tearDown(self):
+        self.handler.db.close()
+
+    def setUp(self):
+        self.handler = SQLDataHandler(sqlite3.Connection(':memory:'))
+        for category in 'a b c d e'.split(' '):
+            self.handler.new_category(category)
+
+        start_date = dt.datetime(2000, 5, 1, 4, 30)
+        records = []
+        for i in range(400):
+            duration = dt.timedelta(seconds=random.randint(30, 60) * 60)
+            records.append(Record(random.choice('abcd'), start_date,
+                                  start_date + duration))
+            # Leave a few days without records
+            advance = dt.timedelta(minutes=random.choice([0, 30, 60, 3000]))
+            start_date = start_date + advance + duration
+        self.handler.import_records(records)
+        self.first = dt.datetime(2000, 4, 29, 6, 0)
+        self.num_days = 40
+
+    def test_per_category_durations(self):
+        end = self.first + dt.timedelta(days=self.num_days)
+        categories, records = vectorized.load_records(self.handler,
+                                                      self.first, end)
+        self.assertEqual(
+            vectorized.get_per_category_durations(categories, records),
+            data_analysis.get_durations_between(self.handler, self.first,
+                                                end))
+
+    def test_summaries(self):
+        table = vectorized.get_day_table(self.handler, self.first,
+                                         self.num_days)
+        days = data_analysis.get_days(self.handler, self.first, self.num_days)
+        summaries = table.get_summaries()
+        self.assertEqual(len(summaries), self.num_days)
+        for day, summary in zip(days, summaries):
+            with self.subTest(day=day.day_start):
+                self.assertEqual(summary.day_start, day.day_start)
+                self.assertEqual(summary.work_start, day.work_start)
+                self.assertEqual(summary.work_end, day.work_end)
+                self.assertEqual(
+                    summary.durations,
+                    dict(data_analysis.get_per_category_durations(day)))
+
+    def test_rows_and_averages(self):
+        table = vectorized.get_day_table(self.handler, self.first,
+                                         self.num_days)
+        rows = [Row.from_summary(s) for s in data_analysis.get_day_summaries(
+            self.handler, self.first, self.num_days)]
+        average_row = AverageRow(rows)
+
+        for i, row in enumerate(rows):
+            with self.subTest(day=row.date):
+                self.assertEqual(table.time_totals[i], row.time_total)
+                self.assertAlmostEqual(table.time_working[i],
+                                       row.time_working)
+                if row.efficiency is None:
+                    self.assertNotEqual(table.efficiencies[i],
+                                        table.efficiencies[i])
+                else:
+                    self.assertAlmostEqual(table.efficiencies[i],
+                                           row.efficiency)
+
+        averages = table.get_averages()
+        self.assertAlmostEqual(averages['time_total'],
+                               average_row.average_time_total)
+        self.assertAlmostEqual(averages['time_working'],
+                               average_row.average_time_working)
+        self.assertAlmostEqual(averages['efficiency'],
+                               average_row.average_efficiency)
+        expected = average_row.average_data
+        self.assertEqual(averages['categories'].keys(), expected.keys())
+        for category, seconds in expected.items():
+            self.assertAlmostEqual(averages['categories'][category], seconds)
+
+        # The status table streams the same averages
+        status, _ = table_generator.create_table_iterable_and_headers(
+            self.handler, self.first + dt.timedelta(days=self.num_days - 1),
+            num_days=self.num_days)
+        self.assertEqual(list(status)[-1], list(average_row))
+
+    def test_empty_window(self):
+        first = dt.datetime(1990, 1, 1, 6, 0)
+        table = vectorized.get_day_table(self.handler, first, 3)
+        self.assertEqual(table.get_summaries(),
+                         data_analysis.get_day_summaries(self.handler, first,
+                                                         3))
+        averages = table.get_averages()
+        self.assertEqual(averages['time_total'], 0)
+        self.assertIsNone(averages['efficiency'])
+        self.assertEqual(averages['categories'], {})
+
+
+if __name__ == '__main__':
+    unittest.main()